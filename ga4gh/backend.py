@@ -6,7 +6,11 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import json
+
 import ga4gh.datamodel as datamodel
+import ga4gh.datamodel.reads as reads
+import ga4gh.datamodel.sequenceAnnotations as sequenceAnnotations
 import ga4gh.exceptions as exceptions
 import ga4gh.protocol as protocol
 
@@ -30,6 +34,22 @@ def _parseIntegerArgument(args, key, defaultValue):
     return ret
 
 
+def _parseFloatArgument(args, key, defaultValue):
+    """
+    Attempts to parse the specified key in the specified argument
+    dictionary into a float. If the argument cannot be parsed,
+    raises a BadRequestFloatException. If the key is not present,
+    return the specified default value.
+    """
+    ret = defaultValue
+    if key in args:
+        try:
+            ret = float(args[key])
+        except ValueError:
+            raise exceptions.BadRequestFloatException(key, args[key])
+    return ret
+
+
 def _parsePageToken(pageToken, numValues):
     """
     Parses the specified pageToken and returns a list of the specified
@@ -50,6 +70,93 @@ def _parsePageToken(pageToken, numValues):
     return values
 
 
+def _parseBooleanExtension(value):
+    """
+    Returns the specified JSON value of a request extension if it is a
+    boolean, and raises a ValueError otherwise.
+    """
+    if not isinstance(value, bool):
+        raise ValueError(value)
+    return value
+
+
+def _parseIntegerExtension(value):
+    """
+    Returns the specified JSON value of a request extension as an integer.
+    Booleans, strings and numbers with a fractional part raise a
+    ValueError rather than being converted.
+    """
+    if isinstance(value, bool) or not isinstance(value, (int, long, float)):
+        raise ValueError(value)
+    if isinstance(value, float) and not value.is_integer():
+        raise ValueError(value)
+    return int(value)
+
+
+def _parseFloatExtension(value):
+    """
+    Returns the specified JSON value of a request extension as a float.
+    Booleans and strings raise a ValueError.
+    """
+    if isinstance(value, bool) or not isinstance(value, (int, long, float)):
+        raise ValueError(value)
+    return float(value)
+
+
+def _parseStringExtension(value):
+    """
+    Returns the specified JSON value of a request extension if it is a
+    string, and raises a ValueError otherwise.
+    """
+    if not isinstance(value, basestring):
+        raise ValueError(value)
+    return value
+
+
+def _getReadFilter(excludeFlags, requireFlags, minMappingQuality):
+    """
+    Returns a ReadFilter for the specified arguments of a reads search,
+    or None if they select all the reads.
+    """
+    if excludeFlags or requireFlags or minMappingQuality:
+        return reads.ReadFilter(excludeFlags, requireFlags, minMappingQuality)
+    return None
+
+
+# The server's extensions of the protocol search requests. These arguments
+# are not part of the GA4GH schemas, and are given alongside the fields of
+# a request in its JSON body. Backend._parseSearchRequest removes them from
+# the request and validates them before it is parsed, and the values are
+# handed to the object generator of the search as keyword arguments. Each
+# extension is a (name, parser, default value, validator) tuple; the
+# parser raises a ValueError for values of the wrong type, and extensions
+# that are not given take their default value.
+_searchRequestExtensions = {
+    protocol.SearchFeaturesRequest: [
+        # How name and gene_symbol are matched, as one of
+        # sequenceAnnotations.NAME_MATCHES
+        ("nameMatch", _parseStringExtension,
+         sequenceAnnotations.NAME_MATCH_EXACT,
+         lambda x: x in sequenceAnnotations.NAME_MATCHES)],
+    protocol.SearchReadsRequest: [
+        # The arguments of the ReadFilter selecting the reads
+        ("excludeFlags", _parseIntegerExtension, 0, lambda x: x >= 0),
+        ("requireFlags", _parseIntegerExtension, 0, lambda x: x >= 0),
+        ("minMappingQuality", _parseIntegerExtension, 0, lambda x: x >= 0),
+        # The arguments of the ReadDownsampler thinning out the reads
+        ("downsampleFraction", _parseFloatExtension, 1.0,
+         lambda x: 0 < x <= 1),
+        ("maxReadsPerWindow", _parseIntegerExtension, None, lambda x: x > 0),
+        ("windowSize", _parseIntegerExtension, 1, lambda x: x > 0),
+        # Restricts a search without a reference to the unplaced unmapped
+        # reads
+        ("unmappedOnly", _parseBooleanExtension, False, lambda x: True),
+        # Adds the mates of the reads of each page placed outside of the
+        # searched region to a "mates" list of the response
+        ("includeMates", _parseBooleanExtension, False, lambda x: True)],
+}
+
+
 class IntervalIterator(object):
     """
     Implements generator logic for types which accept a start/end
@@ -163,13 +270,18 @@ class ReadsIntervalIterator(IntervalIterator):
     """
     An interval iterator for reads
     """
-    def __init__(self, request, parentContainer, reference):
+    def __init__(
+            self, request, parentContainer, reference, downsampler=None,
+            readFilter=None):
         self._reference = reference
+        self._downsampler = downsampler
+        self._readFilter = readFilter
         super(ReadsIntervalIterator, self).__init__(request, parentContainer)
 
     def _search(self, start, end):
         return self._parentContainer.getReadAlignments(
-            self._reference, start, end)
+            self._reference, start, end, self._downsampler,
+            self._readFilter)
 
     @classmethod
     def _getStart(cls, readAlignment):
@@ -315,6 +427,7 @@ class Backend(object):
         self._responseValidation = False
         self._defaultPageSize = 100
         self._maxResponseLength = 2**20  # 1 MiB
+        self._defaultCoverageBinCount = 1000
         self._dataRepository = dataRepository
 
     def getDataRepository(self):
@@ -519,8 +632,17 @@ class Backend(object):
         Returns a generator over the (referenceSet, nextPageToken) pairs
         defined by the specified request.
         """
+        dataRepository = self.getDataRepository()
+        if request.md5checksum:
+            candidates = dataRepository.getReferenceSetsByMd5Checksum(
+                request.md5checksum)
+        elif request.accession:
+            candidates = dataRepository.getReferenceSetsByAccession(
+                request.accession)
+        else:
+            candidates = dataRepository.getReferenceSets()
         results = []
-        for obj in self.getDataRepository().getReferenceSets():
+        for obj in candidates:
             include = True
             if request.md5checksum:
                 if request.md5checksum != obj.getMd5Checksum():
@@ -542,8 +664,16 @@ class Backend(object):
         """
         referenceSet = self.getDataRepository().getReferenceSet(
             request.reference_set_id)
+        if request.md5checksum:
+            candidates = referenceSet.getReferencesByMd5Checksum(
+                request.md5checksum)
+        elif request.accession:
+            candidates = referenceSet.getReferencesByAccession(
+                request.accession)
+        else:
+            candidates = referenceSet.getReferences()
         results = []
-        for obj in referenceSet.getReferences():
+        for obj in candidates:
             include = True
             if request.md5checksum:
                 if request.md5checksum != obj.getMd5Checksum():
@@ -578,55 +708,109 @@ class Backend(object):
             request, variantSet.getNumVariantAnnotationSets(),
             variantSet.getVariantAnnotationSetByIndex)
 
-    def readsGenerator(self, request):
+    def readsGenerator(
+            self, request, excludeFlags=0, requireFlags=0,
+            minMappingQuality=0, downsampleFraction=1.0,
+            maxReadsPerWindow=None, windowSize=1, unmappedOnly=False,
+            includeMates=False):
         """
         Returns a generator over the (read, nextPageToken) pairs defined
-        by the specified request
-        """
-        if not request.reference_id:
-            raise exceptions.UnmappedReadsNotSupported()
+        by the specified request, selected by a ReadFilter and thinned out
+        by a ReadDownsampler with the specified arguments if they exclude
+        any reads. If the request gives no reference, all the reads are
+        returned, across all references followed by the unplaced unmapped
+        reads, or only the unplaced unmapped reads if unmappedOnly is True.
+        The mates of the reads are added by _addMateAlignments if
+        includeMates is True, which requires a reference.
+        """
+        readFilter = _getReadFilter(
+            excludeFlags, requireFlags, minMappingQuality)
+        downsampler = None
+        if downsampleFraction < 1 or maxReadsPerWindow is not None:
+            downsampler = reads.ReadDownsampler(
+                downsampleFraction, maxReadsPerWindow, windowSize)
         if len(request.read_group_ids) < 1:
             raise exceptions.BadRequestException(
                 "At least one readGroupId must be specified")
-        elif len(request.read_group_ids) == 1:
-            return self._readsGeneratorSingle(request)
+        if request.reference_id and unmappedOnly:
+            raise exceptions.BadRequestException(
+                "A reference cannot be specified for unmapped reads")
+        if not request.reference_id and downsampler is not None:
+            raise exceptions.BadRequestException(
+                "A reference must be specified to downsample reads")
+        if not request.reference_id and includeMates:
+            raise exceptions.BadRequestException(
+                "A reference must be specified to include mates")
+        if len(request.read_group_ids) == 1:
+            return self._readsGeneratorSingle(
+                request, downsampler, readFilter, unmappedOnly)
         else:
-            return self._readsGeneratorMultiple(request)
+            return self._readsGeneratorMultiple(
+                request, downsampler, readFilter, unmappedOnly)
 
-    def _readsGeneratorSingle(self, request):
+    def _readsGeneratorSingle(
+            self, request, downsampler, readFilter, unmappedOnly=False):
         compoundId = datamodel.ReadGroupCompoundId.parse(
             request.read_group_ids[0])
         dataset = self.getDataRepository().getDataset(compoundId.dataset_id)
         readGroupSet = dataset.getReadGroupSet(compoundId.read_group_set_id)
+        readGroup = readGroupSet.getReadGroup(compoundId.read_group_id)
+        if not request.reference_id:
+            return self._readsScanGenerator(
+                request, readGroup, unmappedOnly, readFilter)
         referenceSet = readGroupSet.getReferenceSet()
         if referenceSet is None:
             raise exceptions.ReadGroupSetNotMappedToReferenceSetException(
                     readGroupSet.getId())
         reference = referenceSet.getReference(request.reference_id)
-        readGroup = readGroupSet.getReadGroup(compoundId.read_group_id)
         intervalIterator = ReadsIntervalIterator(
-            request, readGroup, reference)
+            request, readGroup, reference, downsampler, readFilter)
         return intervalIterator
 
-    def _readsGeneratorMultiple(self, request):
+    def _readsGeneratorMultiple(
+            self, request, downsampler, readFilter, unmappedOnly=False):
         compoundId = datamodel.ReadGroupCompoundId.parse(
             request.read_group_ids[0])
         dataset = self.getDataRepository().getDataset(compoundId.dataset_id)
         readGroupSet = dataset.getReadGroupSet(compoundId.read_group_set_id)
-        referenceSet = readGroupSet.getReferenceSet()
-        if referenceSet is None:
-            raise exceptions.ReadGroupSetNotMappedToReferenceSetException(
-                    readGroupSet.getId())
-        reference = referenceSet.getReference(request.reference_id)
         readGroupIds = readGroupSet.getReadGroupIds()
         if set(readGroupIds) != set(request.read_group_ids):
             raise exceptions.BadRequestException(
                 "If multiple readGroupIds are specified, "
                 "they must be all of the readGroupIds in a ReadGroupSet")
+        if not request.reference_id:
+            return self._readsScanGenerator(
+                request, readGroupSet, unmappedOnly, readFilter)
+        referenceSet = readGroupSet.getReferenceSet()
+        if referenceSet is None:
+            raise exceptions.ReadGroupSetNotMappedToReferenceSetException(
+                    readGroupSet.getId())
+        reference = referenceSet.getReference(request.reference_id)
         intervalIterator = ReadsIntervalIterator(
-            request, readGroupSet, reference)
+            request, readGroupSet, reference, downsampler, readFilter)
         return intervalIterator
 
+    def _readsScanGenerator(
+            self, request, container, unmappedOnly, readFilter):
+        """
+        Returns a generator over the (read, nextPageToken) pairs of a scan
+        of the reads of the specified read group or read group set. The
+        page tokens hold the file offset from which the scan is resumed.
+        """
+        offset = None
+        if request.page_token:
+            offset = _parsePageToken(
+                request.page_token, len(request.page_token.split(":")))
+        scan = container.scanReadAlignments(unmappedOnly, offset, readFilter)
+        current = next(scan, None)
+        while current is not None:
+            following = next(scan, None)
+            nextPageToken = None
+            if following is not None:
+                nextPageToken = ":".join(str(value) for value in current[1])
+            yield current[0], nextPageToken
+            current = following
+
     def variantsGenerator(self, request):
         """
         Returns a generator over the (variant, nextPageToken) pairs defined
@@ -654,10 +838,12 @@ class Backend(object):
             request, variantAnnotationSet)
         return intervalIterator
 
-    def featuresGenerator(self, request):
+    def featuresGenerator(
+            self, request, nameMatch=sequenceAnnotations.NAME_MATCH_EXACT):
         """
         Returns a generator over the (features, nextPageToken) pairs
-        defined by the (JSON string) request.
+        defined by the (JSON string) request, matching its name and
+        gene_symbol in the specified way.
         """
         compoundId = None
         parentId = None
@@ -698,7 +884,8 @@ class Backend(object):
         return featureSet.getFeatures(
             request.reference_name, start, end,
             request.page_token, request.page_size,
-            request.feature_types, parentId, request.name, request.gene_symbol)
+            request.feature_types, parentId, request.name, request.gene_symbol,
+            nameMatch)
 
     def callSetsGenerator(self, request):
         """
@@ -775,36 +962,11 @@ class Backend(object):
         rnaQuantSet = dataset.getRnaQuantificationSet(
             compoundId.rna_quantification_set_id)
         rnaQuant = rnaQuantSet.getRnaQuantification(rnaQuantificationId)
-        rnaQuantificationId = rnaQuant.getLocalId()
-        startIndex = request.page_token
-        maxResults = request.page_size
-        # we need to determine if another expressionLevel follows the one
-        # that is last returned from this method to set nextPageToken
-        # correctly, so request an additional expressionLevel from
-        # the database in all cases
-        if maxResults:
-            maxResults += 1
-        expressionLevels = list(rnaQuant.getExpressionLevels(
+        return rnaQuant.searchExpressionLevels(
             threshold=request.threshold,
             featureIds=request.feature_ids,
-            startIndex=startIndex,
-            maxResults=maxResults))
-        # initialize loop
-        nextPageTokenIndex = 0
-        expressionLevelIndex = 0
-        if request.page_token:
-            nextPageTokenIndex, = _parsePageToken(request.page_token, 1)
-        numToReturn = request.page_size
-        # execute loop
-        while numToReturn > 0 and expressionLevelIndex < len(expressionLevels):
-            expressionLevel = expressionLevels[expressionLevelIndex]
-            nextPageTokenIndex += 1
-            nextPageToken = str(nextPageTokenIndex)
-            if expressionLevelIndex == len(expressionLevels) - 1:
-                nextPageToken = None
-            yield expressionLevel.toProtocolElement(), nextPageToken
-            expressionLevelIndex += 1
-            numToReturn -= 1
+            pageToken=request.page_token,
+            pageSize=request.page_size)
 
     ###########################################################
     #
@@ -824,7 +986,8 @@ class Backend(object):
         return jsonString
 
     def runSearchRequest(
-            self, requestStr, requestClass, responseClass, objectGenerator):
+            self, requestStr, requestClass, responseClass, objectGenerator,
+            responseExtender=None):
         """
         Runs the specified request. The request is a string containing
         a JSON representation of an instance of the specified requestClass.
@@ -833,12 +996,15 @@ class Backend(object):
         using the specified object generator, which must return
         (object, nextPageToken) pairs, and be able to resume iteration from
         any point using the nextPageToken attribute of the request object.
+        The values of the extensions of the request are passed to the
+        object generator as keyword arguments, and to the responseExtender
+        if it is given, which is called with the request and the
+        SearchResponseBuilder once the page is filled, to add extension
+        values to the response.
         """
         self.startProfile()
-        try:
-            request = protocol.fromJson(requestStr, requestClass)
-        except protocol.json_format.ParseError:
-            raise exceptions.InvalidJsonException(requestStr)
+        request, extensions = self._parseSearchRequest(
+            requestStr, requestClass)
         # TODO How do we detect when the page size is not set?
         if not request.page_size:
             request.page_size = self._defaultPageSize
@@ -847,15 +1013,54 @@ class Backend(object):
         responseBuilder = protocol.SearchResponseBuilder(
             responseClass, request.page_size, self._maxResponseLength)
         nextPageToken = None
-        for obj, nextPageToken in objectGenerator(request):
+        for obj, nextPageToken in objectGenerator(request, **extensions):
             responseBuilder.addValue(obj)
             if responseBuilder.isFull():
                 break
         responseBuilder.setNextPageToken(nextPageToken)
+        if responseExtender is not None:
+            responseExtender(request, responseBuilder, **extensions)
         responseString = responseBuilder.getSerializedResponse()
         self.endProfile()
         return responseString
 
+    def _parseSearchRequest(self, requestStr, requestClass):
+        """
+        Parses the specified JSON request string into an instance of the
+        specified requestClass, returning it together with the dictionary
+        of the values of the extensions of the request listed in
+        _searchRequestExtensions. Invalid extension values raise a
+        BadRequestExtensionException.
+        """
+        extensions = _searchRequestExtensions.get(requestClass, [])
+        values = {}
+        if len(extensions) > 0:
+            try:
+                requestDict = json.loads(requestStr)
+            except ValueError:
+                raise exceptions.InvalidJsonException(requestStr)
+            if not isinstance(requestDict, dict):
+                raise exceptions.InvalidJsonException(requestStr)
+            for name, parse, defaultValue, isValid in extensions:
+                value = requestDict.pop(name, None)
+                if value is None:
+                    values[name] = defaultValue
+                    continue
+                try:
+                    values[name] = parse(value)
+                    valid = isValid(values[name])
+                except ValueError:
+                    valid = False
+                if not valid:
+                    raise exceptions.BadRequestExtensionException(
+                        name, value)
+            requestStr = json.dumps(requestDict)
+        try:
+            request = protocol.fromJson(requestStr, requestClass)
+        except protocol.json_format.ParseError:
+            raise exceptions.InvalidJsonException(requestStr)
+        return request, values
+
     def runListReferenceBases(self, id_, requestArgs):
         """
         Runs a listReferenceBases request for the specified ID and
@@ -889,6 +1094,188 @@ class Backend(object):
             response.next_page_token = nextPageToken
         return protocol.toJson(response)
 
+    def runListReferenceBasesBatch(self, requestStr):
+        """
+        Runs a batch listReferenceBases request. The request is a JSON
+        object whose intervals list holds objects with referenceId, start
+        and end fields. Returns a JSON object whose sequences list holds
+        the bases of each interval, in request order. The intervals are
+        read in order of reference and position, so that each reference is
+        looked up once and its file is read sequentially. All the intervals
+        are checked against their references before the total length is
+        compared with the maximum response length and any bases are read.
+        """
+        try:
+            intervals = [
+                (interval["referenceId"], int(interval["start"]),
+                 int(interval["end"]))
+                for interval in json.loads(requestStr)["intervals"]]
+        except (ValueError, KeyError, TypeError):
+            raise exceptions.InvalidJsonException(requestStr)
+        references = {}
+        for referenceId, start, end in intervals:
+            if referenceId not in references:
+                compoundId = datamodel.ReferenceCompoundId.parse(referenceId)
+                referenceSet = self.getDataRepository().getReferenceSet(
+                    compoundId.reference_set_id)
+                references[referenceId] = referenceSet.getReference(
+                    referenceId)
+            references[referenceId].checkQueryRange(start, end)
+        totalLength = sum(end - start for _, start, end in intervals)
+        if totalLength > self._maxResponseLength:
+            raise exceptions.BasesBatchTooLargeException(
+                totalLength, self._maxResponseLength)
+        sequences = [None] * len(intervals)
+        for index in sorted(
+                range(len(intervals)), key=intervals.__getitem__):
+            referenceId, start, end = intervals[index]
+            sequences[index] = references[referenceId].getBases(start, end)
+        return json.dumps({"sequences": sequences})
+
+    def getReferenceRegion(self, id_, requestArgs):
+        """
+        Returns the reference with the specified ID together with the
+        start and end of the region given by the request arguments, which
+        default to the whole reference.
+        """
+        compoundId = datamodel.ReferenceCompoundId.parse(id_)
+        referenceSet = self.getDataRepository().getReferenceSet(
+            compoundId.reference_set_id)
+        reference = referenceSet.getReference(id_)
+        return self._getReferenceRegion(reference, requestArgs)
+
+    def getSequenceRegion(self, checksum, requestArgs):
+        """
+        Returns the reference with the specified MD5 checksum together with
+        the start and end of the region given by the request arguments, as
+        getReferenceRegion does.
+        """
+        reference = self.getDataRepository().getReferenceByMd5Checksum(
+            checksum)
+        return self._getReferenceRegion(reference, requestArgs)
+
+    def _getReferenceRegion(self, reference, requestArgs):
+        start = _parseIntegerArgument(requestArgs, 'start', 0)
+        end = _parseIntegerArgument(requestArgs, 'end', reference.getLength())
+        reference.checkQueryRange(start, end)
+        return reference, start, end
+
+    def iterReferenceBases(self, reference, start, end):
+        """
+        Yields the bases of the specified reference between start and end
+        in chunks of at most the maximum response length, so that
+        arbitrarily large regions can be streamed in bounded memory.
+        """
+        for chunkStart in range(start, end, self._maxResponseLength):
+            chunkEnd = min(chunkStart + self._maxResponseLength, end)
+            yield reference.getBases(chunkStart, chunkEnd)
+
+    def runListFeatureSubtree(self, id_, requestArgs):
+        """
+        Runs a listFeatureSubtree request for the specified feature ID and
+        request arguments, returning the feature and all its descendants
+        as a SearchFeaturesResponse.
+        """
+        compoundId = datamodel.FeatureCompoundId.parse(id_)
+        dataset = self.getDataRepository().getDataset(compoundId.dataset_id)
+        featureSet = dataset.getFeatureSet(compoundId.feature_set_id)
+        pageSize = _parseIntegerArgument(
+            requestArgs, 'pageSize', self._defaultPageSize)
+        if pageSize <= 0:
+            raise exceptions.BadPageSizeException(pageSize)
+        pageToken = 0
+        if requestArgs.get('pageToken', "") != "":
+            pageToken, = _parsePageToken(requestArgs['pageToken'], 1)
+        responseBuilder = protocol.SearchResponseBuilder(
+            protocol.SearchFeaturesResponse, pageSize,
+            self._maxResponseLength)
+        nextPageToken = None
+        for gaFeature, nextPageToken in featureSet.getFeatureSubtree(
+                compoundId, pageToken, pageSize):
+            responseBuilder.addValue(gaFeature)
+            if responseBuilder.isFull():
+                break
+        responseBuilder.setNextPageToken(nextPageToken)
+        return responseBuilder.getSerializedResponse()
+
+    def runGetExpressionMatrix(self, id_, requestArgs):
+        """
+        Runs a getExpressionMatrix request for the specified
+        RnaQuantificationSet ID and request arguments, returning the
+        expression values of the requested features (the repeated
+        featureId argument, or all features if none are given) across
+        every RnaQuantification in the set. Features without a value over
+        the optional threshold argument in any RnaQuantification are left
+        out. Missing values are returned as null.
+        """
+        compoundId = datamodel.RnaQuantificationSetCompoundId.parse(id_)
+        dataset = self.getDataRepository().getDataset(compoundId.dataset_id)
+        rnaQuantificationSet = dataset.getRnaQuantificationSet(id_)
+        featureIds = requestArgs.getlist('featureId')
+        threshold = _parseFloatArgument(requestArgs, 'threshold', None)
+        featureIds, rnaQuantifications, rows = \
+            rnaQuantificationSet.getExpressionMatrix(featureIds, threshold)
+        return json.dumps({
+            "featureIds": featureIds,
+            "rnaQuantificationIds": [
+                rnaQuantification.getId()
+                for rnaQuantification in rnaQuantifications],
+            "expression": rows}, separators=(',', ':'))
+
+    def runGetReadGroupSetCoverage(self, id_, requestArgs):
+        """
+        Runs a getCoverage request for the specified ReadGroupSet ID and
+        request arguments, as _runGetCoverage does.
+        """
+        compoundId = datamodel.ReadGroupSetCompoundId.parse(id_)
+        dataset = self.getDataRepository().getDataset(compoundId.dataset_id)
+        readGroupSet = dataset.getReadGroupSet(id_)
+        return self._runGetCoverage(readGroupSet, readGroupSet, requestArgs)
+
+    def runGetReadGroupCoverage(self, id_, requestArgs):
+        """
+        Runs a getCoverage request for the specified ReadGroup ID and
+        request arguments, as _runGetCoverage does.
+        """
+        compoundId = datamodel.ReadGroupCompoundId.parse(id_)
+        dataset = self.getDataRepository().getDataset(compoundId.dataset_id)
+        readGroupSet = dataset.getReadGroupSet(compoundId.read_group_set_id)
+        readGroup = readGroupSet.getReadGroup(id_)
+        return self._runGetCoverage(readGroupSet, readGroup, requestArgs)
+
+    def _runGetCoverage(self, readGroupSet, readsObject, requestArgs):
+        """
+        Returns the mean read depth of the specified ReadGroupSet or
+        ReadGroup in about numBins bins (1000 by default) covering the
+        region between the start and end arguments (the whole reference
+        by default) of the reference given by the referenceId argument.
+        The bins are merged from the precomputed coverage tiles when
+        there are any, and may then be up to twice as large as requested,
+        but never smaller, so that there are no more bins than requested.
+        """
+        referenceSet = readGroupSet.getReferenceSet()
+        if referenceSet is None:
+            raise exceptions.ReadGroupSetNotMappedToReferenceSetException(
+                readGroupSet.getId())
+        reference = referenceSet.getReference(
+            requestArgs.get('referenceId', ""))
+        reference, start, end = self._getReferenceRegion(
+            reference, requestArgs)
+        numBins = _parseIntegerArgument(
+            requestArgs, 'numBins', self._defaultCoverageBinCount)
+        maxNumBins = self._maxResponseLength // 8
+        if not 0 < numBins <= maxNumBins:
+            raise exceptions.BadCoverageBinCountException(
+                numBins, maxNumBins)
+        binSize = max(1, -(-(end - start) // numBins))
+        binSize, binStart, depths = readsObject.getCoverage(
+            reference, start, end, binSize)
+        return json.dumps({
+            "referenceId": reference.getId(),
+            "start": binStart,
+            "binSize": binSize,
+            "depths": depths}, separators=(',', ':'))
+
     # Get requests.
 
     def runGetCallSet(self, id_):
@@ -954,6 +1341,22 @@ class Backend(object):
         readGroupSet = dataset.getReadGroupSet(id_)
         return self.runGetRequest(readGroupSet)
 
+    def runGetReadAlignments(self, id_):
+        """
+        Returns the alignments of the reads of the fragment with the given
+        read alignment id_, found through the read name index of its read
+        group set, as a SearchReadsResponse.
+        """
+        compoundId = datamodel.ReadAlignmentCompoundId.parse(id_)
+        dataset = self.getDataRepository().getDataset(compoundId.dataset_id)
+        readGroupSet = dataset.getReadGroupSet(compoundId.read_group_set_id)
+        response = protocol.SearchReadsResponse()
+        response.alignments.extend(readGroupSet.getReadAlignmentsByName(
+            compoundId.read_alignment))
+        if len(response.alignments) == 0:
+            raise exceptions.ReadAlignmentNotFoundException(id_)
+        return protocol.toJson(response)
+
     def runGetReadGroup(self, id_):
         """
         Returns a read group with the given id_
@@ -1080,12 +1483,53 @@ class Backend(object):
 
     def runSearchReads(self, request):
         """
-        Runs the specified SearchReadsRequest.
+        Runs the specified SearchReadsRequest. Besides the fields of the
+        protocol request, the request may hold the extensions listed in
+        _searchRequestExtensions, which are the excludeFlags, requireFlags
+        and minMappingQuality arguments of a ReadFilter, the
+        downsampleFraction, maxReadsPerWindow and windowSize arguments of
+        a ReadDownsampler, a boolean unmappedOnly argument restricting a
+        search without a reference to the unplaced unmapped reads and a
+        boolean includeMates argument. These must be given again with each
+        page. If includeMates is True, the mates of the reads of each page
+        which are placed outside of the searched region, and selected by
+        the same ReadFilter, are returned in an additional "mates" list of
+        the response.
         """
         return self.runSearchRequest(
             request, protocol.SearchReadsRequest,
-            protocol.SearchReadsResponse,
-            self.readsGenerator)
+            protocol.SearchReadsResponse, self.readsGenerator,
+            self._addMateAlignments)
+
+    def _addMateAlignments(
+            self, request, responseBuilder, includeMates=False,
+            excludeFlags=0, requireFlags=0, minMappingQuality=0,
+            **extensions):
+        """
+        Sets the "mates" list of the response being built by the specified
+        SearchResponseBuilder for the specified SearchReadsRequest to the
+        mates of the reads of the page which are placed outside of the
+        searched region and selected by a ReadFilter with the specified
+        arguments, if includeMates is True. The other extensions of the
+        request do not apply to the mates.
+        """
+        if not includeMates:
+            return
+        compoundId = datamodel.ReadGroupCompoundId.parse(
+            request.read_group_ids[0])
+        dataset = self.getDataRepository().getDataset(compoundId.dataset_id)
+        readGroupSet = dataset.getReadGroupSet(compoundId.read_group_set_id)
+        container = readGroupSet
+        if len(request.read_group_ids) == 1:
+            container = readGroupSet.getReadGroup(compoundId.read_group_id)
+        reference = readGroupSet.getReferenceSet().getReference(
+            request.reference_id)
+        responseBuilder.setExtensionValues(
+            "mates", container.getMateAlignments(
+                responseBuilder.getValues(), reference, request.start,
+                request.end if request.end != 0 else None,
+                _getReadFilter(
+                    excludeFlags, requireFlags, minMappingQuality)))
 
     def runSearchReferenceSets(self, request):
         """
@@ -1172,7 +1616,10 @@ class Backend(object):
     def runSearchFeatures(self, request):
         """
         Returns a SearchFeaturesResponse for the specified
-        SearchFeaturesRequest object.
+        SearchFeaturesRequest object. Besides the fields of the protocol
+        request, the request may hold a nameMatch argument, one of "exact"
+        (the default), "prefix" or "substring", giving how its name and
+        gene_symbol are matched against those of the features.
 
         :param request: JSON string representing searchFeaturesRequest
         :return: JSON string representing searchFeatureResponse
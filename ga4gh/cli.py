@@ -31,6 +31,7 @@ import ga4gh.configtest as configtest
 import ga4gh.exceptions as exceptions
 import ga4gh.datarepo as datarepo
 import ga4gh.protocol as protocol
+import ga4gh.rnaseqLoader as rnaseqLoader
 import ga4gh.datamodel.reads as reads
 import ga4gh.datamodel.variants as variants
 import ga4gh.datamodel.references as references
@@ -1976,7 +1977,9 @@ class RepoManager(object):
         if name is None:
             name = getNameFromPath(self._args.filePath)
         referenceSet = references.HtslibReferenceSet(name)
-        referenceSet.populateFromFile(filePath)
+        referenceSet.populateFromFile(filePath, self._args.numProcesses)
+        if self._args.packBases:
+            referenceSet.writePackedSequenceFile()
         referenceSet.setDescription(self._args.description)
         referenceSet.setNcbiTaxonId(self._args.ncbiTaxonId)
         referenceSet.setIsDerived(self._args.isDerived)
@@ -1994,31 +1997,47 @@ class RepoManager(object):
         """
         self._openRepo()
         dataset = self._repo.getDatasetByName(self._args.datasetName)
-        dataUrl = self._args.dataFile
-        indexFile = self._args.indexFile
-        parsed = urlparse.urlparse(dataUrl)
+        dataUrls = self._args.dataFiles
+        indexFiles = self._args.indexFiles
+        if indexFiles is not None and len(indexFiles) != len(dataUrls):
+            raise exceptions.RepoManagerException(
+                "One index file must be provided for each data file")
+        name = self._args.name
+        if name is None:
+            if len(dataUrls) > 1:
+                raise exceptions.RepoManagerException(
+                    "Cannot infer the intended name of the ReadGroupSet "
+                    "when more than one BAM or CRAM file is provided. "
+                    "Please provide a name argument using --name.")
+            name = getNameFromPath(dataUrls[0])
+        parsed = urlparse.urlparse(dataUrls[0])
         # TODO, add https support and others when they have been
         # tested.
         if parsed.scheme in ['http', 'ftp']:
-            if indexFile is None:
-                raise exceptions.MissingIndexException(dataUrl)
+            if indexFiles is None:
+                raise exceptions.MissingIndexException(dataUrls[0])
         else:
-            if indexFile is None:
-                indexFile = dataUrl + ".bai"
-            dataUrl = self._getFilePath(self._args.dataFile,
-                                        self._args.relativePath)
-            indexFile = self._getFilePath(indexFile, self._args.relativePath)
-        name = self._args.name
-        if self._args.name is None:
-            name = getNameFromPath(dataUrl)
+            if indexFiles is None:
+                indexFiles = [
+                    reads.getDefaultIndexFile(dataUrl) for dataUrl in dataUrls]
+            dataUrls = [
+                self._getFilePath(dataUrl, self._args.relativePath)
+                for dataUrl in dataUrls]
+            indexFiles = [
+                self._getFilePath(indexFile, self._args.relativePath)
+                for indexFile in indexFiles]
         readGroupSet = reads.HtslibReadGroupSet(dataset, name)
-        readGroupSet.populateFromFile(dataUrl, indexFile)
+        readGroupSet.populateFromFiles(dataUrls, indexFiles)
         referenceSetName = self._args.referenceSetName
         if referenceSetName is None:
             # Try to find a reference set name from the BAM header.
             referenceSetName = readGroupSet.getBamHeaderReferenceSetName()
         referenceSet = self._repo.getReferenceSetByName(referenceSetName)
         readGroupSet.setReferenceSet(referenceSet)
+        if self._args.coverageTiles:
+            readGroupSet.writeCoverageTileFile()
+        if self._args.nameIndex:
+            readGroupSet.writeReadNameIndexFile()
         self._updateRepo(self._repo.insertReadGroupSet, readGroupSet)
 
     def addVariantSet(self):
@@ -2272,6 +2291,41 @@ class RepoManager(object):
         self._updateRepo(
             self._repo.insertRnaQuantificationSet, rnaQuantificationSet)
 
+    def loadRnaQuantificationSet(self):
+        """
+        Loads the quantification files listed in a control file into a new
+        RNA quantification DB, and adds it to this repo as an
+        rnaQuantificationSet
+        """
+        self._openRepo()
+        dataset = self._repo.getDatasetByName(self._args.datasetName)
+        referenceSetName = self._args.referenceSetName
+        if referenceSetName is None:
+            raise exceptions.RepoManagerException(
+                "A reference set name must be provided")
+        referenceSet = self._repo.getReferenceSetByName(referenceSetName)
+        filePath = self._getFilePath(self._args.filePath,
+                                     self._args.relativePath)
+        if self._args.name is None:
+            name = getNameFromPath(self._args.filePath)
+        else:
+            name = self._args.name
+        rnaQuantifications = rnaseqLoader.readControlFile(
+            dataset, os.path.dirname(self._args.controlFile),
+            os.path.basename(self._args.controlFile))
+        loader = rnaseqLoader.RnaQuantificationLoader(
+            self._args.filePath, self._args.featureType,
+            self._args.numProcesses)
+        loader.load(rnaQuantifications)
+        rna_quantification.ExpressionMatrix.build(
+            self._args.filePath, self._args.filePath + ".matrix")
+        rnaQuantificationSet = rna_quantification.SqliteRnaQuantificationSet(
+            dataset, name)
+        rnaQuantificationSet.setReferenceSet(referenceSet)
+        rnaQuantificationSet.populateFromFile(filePath)
+        self._updateRepo(
+            self._repo.insertRnaQuantificationSet, rnaQuantificationSet)
+
     def removeRnaQuantificationSet(self):
         """
         Removes an rnaQuantificationSet from this repo
@@ -2467,6 +2521,13 @@ class RepoManager(object):
         addReferenceSetParser.add_argument(
             "--sourceUri", default=None,
             help="The source URI")
+        addReferenceSetParser.add_argument(
+            "-p", "--numProcesses", type=int, default=1,
+            help="the number of processes used to compute checksums")
+        addReferenceSetParser.add_argument(
+            "--packBases", action='store_true', default=False,
+            help="write a 2-bit packed copy of the bases next to the FASTA "
+            "file, from which they are served")
 
         removeReferenceSetParser = addSubparser(
             subparsers, "remove-referenceset",
@@ -2489,16 +2550,29 @@ class RepoManager(object):
         cls.addReferenceSetNameOption(addReadGroupSetParser, "ReadGroupSet")
         cls.addRelativePathOption(addReadGroupSetParser)
         addReadGroupSetParser.add_argument(
-            "dataFile",
-            help="The file path or URL of the BAM file for this ReadGroupSet")
+            "dataFiles", nargs="+",
+            help="The file paths or URLs of the BAM or CRAM files for this "
+            "ReadGroupSet, such as the files of the lanes of a sample. "
+            "Their reads are merged by position when served")
         addReadGroupSetParser.add_argument(
-            "-I", "--indexFile", default=None,
+            "-I", "--indexFiles", nargs="+", metavar="indexFiles",
+            default=None,
             help=(
-                "The file path of the BAM index for this ReadGroupSet. "
-                "If the dataFile argument is a local file, this will "
-                "be automatically inferred by appending '.bai' to the "
-                "file name. If the dataFile is a remote URL the path to "
-                "a local file containing the BAM index must be provided"))
+                "The file paths of the BAM or CRAM indexes for this "
+                "ReadGroupSet, in the same order as the dataFiles. If the "
+                "dataFiles are local files, these will be automatically "
+                "inferred by appending '.bai' (or '.crai' for a CRAM "
+                "file) to the file names. If the dataFiles are remote URLs "
+                "the paths to local files containing the indexes must be "
+                "provided"))
+        addReadGroupSetParser.add_argument(
+            "--coverageTiles", action='store_true', default=False,
+            help="write multi-resolution read coverage tiles next to each "
+            "BAM file, from which coverage is served")
+        addReadGroupSetParser.add_argument(
+            "--nameIndex", action='store_true', default=False,
+            help="write an index of the reads by name next to each BAM "
+            "file, through which reads are fetched by ID")
 
         addOntologyParser = addSubparser(
             subparsers, "add-ontology",
@@ -2647,6 +2721,33 @@ class RepoManager(object):
             addRnaQuantificationSetParser, objectType)
         cls.addNameOption(addRnaQuantificationSetParser, objectType)
 
+        loadRnaQuantificationSetParser = addSubparser(
+            subparsers, "load-rnaquantificationset",
+            "Load RNA quantification files into a new RNA quantification "
+            "set and add it to the data repo")
+        loadRnaQuantificationSetParser.set_defaults(
+            runner="loadRnaQuantificationSet")
+        cls.addRepoArgument(loadRnaQuantificationSetParser)
+        cls.addDatasetNameArgument(loadRnaQuantificationSetParser)
+        loadRnaQuantificationSetParser.add_argument(
+            "controlFile",
+            help="the tab delimited file listing the quantification files "
+            "to load, which are found relative to its directory")
+        cls.addFilePathArgument(
+            loadRnaQuantificationSetParser,
+            "The path of the SQLite database to create")
+        cls.addReferenceSetNameOption(
+            loadRnaQuantificationSetParser, objectType)
+        cls.addNameOption(loadRnaQuantificationSetParser, objectType)
+        cls.addRelativePathOption(loadRnaQuantificationSetParser)
+        loadRnaQuantificationSetParser.add_argument(
+            "-t", "--featureType", default="gene",
+            choices=["gene", "transcript"],
+            help="the type of feature quantified in RSEM files")
+        loadRnaQuantificationSetParser.add_argument(
+            "-p", "--numProcesses", type=int, default=1,
+            help="the number of processes used to parse files")
+
         removeRnaQuantificationSetParser = addSubparser(
             subparsers, "remove-rnaquantificationset",
             "Remove an RNA quantification set from the repo")
@@ -9,90 +9,255 @@ from __future__ import unicode_literals
 import json
 import base64
 import collections
+import contextlib
+import os
+import threading
+import time
 
 import ga4gh.exceptions as exceptions
 
 
 class PysamFileHandleCache(object):
     """
-    Cache for opened file handles. We use a deque which has the
-    advantage to have push/pop operations in O(1) We always add
-    elements on the left of the deque and pop elements from the right.
-    When a file is accessed via getFileHandle, its priority gets
-    updated, it is put at the "top" of the deque.
+    Pool of opened file handles. A handle is checked out by one user at a
+    time, so that a pysam handle is never used concurrently by two
+    threads, and checked back in when its user is done with it, so that
+    any thread can reuse it. The idle handles are kept in one least
+    recently used order of their files per type of file (such as
+    "reads", "variants" or "references"), each with its own maximum
+    size. Each order is an OrderedDict from files to their idle handles,
+    so that lookups, promotions and evictions are O(1), and all of them
+    are done under a lock.
+
+    When there are more idle handles of a type than its maximum size, the
+    least recently used ones are closed. Checked out handles are never
+    closed by the pool, and do not count towards its size.
+
+    Handles can also be preloaded as idle handles, for instance when
+    warming up the server.
+
+    A process forked from the one the handles were opened in does not
+    reuse them, as they share their file offsets with the parent process.
     """
 
     def __init__(self):
-        self._cache = collections.deque()
-        self._memoTable = dict()
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._idleHandles = collections.defaultdict(collections.OrderedDict)
+        self._numIdleHandles = collections.Counter()
+        self._numCheckedOutHandles = collections.Counter()
         # Initialize the value even if it will be set up by the config
         self._maxCacheSize = 50
+        self._maxCacheSizes = {}
+        self._metrics = collections.defaultdict(collections.Counter)
+        self._accessCounts = collections.Counter()
 
-    def setMaxCacheSize(self, size):
+    def setMaxCacheSize(self, size, handleType=None):
         """
-        Sets the maximum size of the cache
+        Sets the maximum number of idle handles kept for the specified
+        type of file, or the default maximum for all types if no type is
+        given
         """
         if size <= 0:
             raise ValueError(
                 "The size of the cache must be a strictly positive value")
-        self._maxCacheSize = size
+        if handleType is None:
+            self._maxCacheSize = size
+        else:
+            self._maxCacheSizes[handleType] = size
 
-    def _add(self, dataFile, handle):
+    def getMaxCacheSize(self, handleType=None):
         """
-        Add a file handle to the left of the deque
+        Returns the maximum number of idle handles kept for the specified
+        type of file.
         """
-        self._cache.appendleft((dataFile, handle))
+        return self._maxCacheSizes.get(handleType, self._maxCacheSize)
 
-    def _update(self, dataFile, handle):
+    def getCachedFiles(self):
         """
-        Update the priority of the file handle. The element is first
-        removed and then added to the left of the deque.
+        Returns all file names with idle handles in the cache.
         """
-        self._cache.remove((dataFile, handle))
-        self._add(dataFile, handle)
+        with self._lock:
+            return list(set(
+                dataFile for idleHandles in self._idleHandles.values()
+                for dataFile in idleHandles.keys()))
 
-    def _removeLru(self):
+    def getMetrics(self):
         """
-        Remove the least recently used file handle from the cache.
-        The pop method removes an element from the right of the deque.
-        Returns the name of the file that has been removed.
+        Returns a dictionary mapping each type of file to a dictionary of
+        the cache hits, misses and evictions for that type, the total
+        time in seconds spent opening files, the current number of idle
+        and checked out handles, and the maximum number of idle handles.
         """
-        (dataFile, handle) = self._cache.pop()
-        handle.close()
-        return dataFile
+        with self._lock:
+            metrics = {}
+            for handleType in set(
+                    self._idleHandles.keys() + self._metrics.keys()):
+                counters = self._metrics[handleType]
+                metrics[handleType] = {
+                    "hits": counters["hits"],
+                    "misses": counters["misses"],
+                    "evictions": counters["evictions"],
+                    "openSeconds": counters["openSeconds"],
+                    "size": self._numIdleHandles[handleType],
+                    "checkedOut": self._numCheckedOutHandles[handleType],
+                    "maxSize": self.getMaxCacheSize(handleType),
+                }
+            return metrics
 
-    def getCachedFiles(self):
+    def getAccessCounts(self):
         """
-        Returns all file names stored in the cache.
+        Returns a dictionary mapping the path of each file requested from
+        the cache to the number of times it was requested.
         """
-        return self._memoTable.keys()
+        with self._lock:
+            return dict(self._accessCounts)
 
-    def getFileHandle(self, dataFile, openMethod):
+    def _openFile(self, dataFile, openMethod, handleType):
         """
-        Returns handle associated to the filename. If the file is
-        already opened, update its priority in the cache and return
-        its handle. Otherwise, open the file using openMethod, store
-        it in the cache and return the corresponding handle.
+        Opens the specified file, recording the time taken.
         """
-        if dataFile in self._memoTable:
-            handle = self._memoTable[dataFile]
-            self._update(dataFile, handle)
-            return handle
-        else:
-            try:
-                handle = openMethod(dataFile)
-            except ValueError:
-                raise exceptions.FileOpenFailedException(dataFile)
+        openStart = time.time()
+        try:
+            handle = openMethod(dataFile)
+        except ValueError:
+            raise exceptions.FileOpenFailedException(dataFile)
+        with self._lock:
+            self._metrics[handleType]["openSeconds"] += (
+                time.time() - openStart)
+        return handle
+
+    def _addIdleHandle(self, dataFile, handle, handleType):
+        """
+        Adds the specified handle to the idle handles of its file, making
+        the file the most recently used one, and returns the list of the
+        least recently used handles evicted to keep the pool within its
+        size. Must be called with the lock held.
+        """
+        idleHandles = self._idleHandles[handleType]
+        handles = idleHandles.pop(dataFile, [])
+        handles.append(handle)
+        idleHandles[dataFile] = handles
+        self._numIdleHandles[handleType] += 1
+        evictedHandles = []
+        maxCacheSize = self.getMaxCacheSize(handleType)
+        while self._numIdleHandles[handleType] > maxCacheSize:
+            leastRecentFile, handles = next(idleHandles.iteritems())
+            evictedHandles.append(handles.pop(0))
+            if len(handles) == 0:
+                del idleHandles[leastRecentFile]
+            self._numIdleHandles[handleType] -= 1
+            self._metrics[handleType]["evictions"] += 1
+        return evictedHandles
+
+    def _closeHandles(self, handles):
+        """
+        Closes the specified handles, which must no longer be in the pool.
+        """
+        for handle in handles:
+            handle.close()
+
+    def _checkProcess(self):
+        """
+        Closes the idle handles inherited from the parent process if this
+        process was forked since they were opened. The lock is replaced,
+        as it may have been held by another thread at the time of the
+        fork.
+        """
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        inheritedHandles = [
+            handle for idleHandles in self._idleHandles.values()
+            for handles in idleHandles.values() for handle in handles]
+        self._idleHandles.clear()
+        self._numIdleHandles.clear()
+        self._numCheckedOutHandles.clear()
+        self._closeHandles(inheritedHandles)
+
+    def preloadFileHandle(self, dataFile, openMethod, handleType=None):
+        """
+        Opens the specified file and adds its handle to the idle handles
+        in the pool. Does nothing if the file already has an idle handle.
+        """
+        self._checkProcess()
+        with self._lock:
+            if dataFile in self._idleHandles[handleType]:
+                return
+        handle = self._openFile(dataFile, openMethod, handleType)
+        with self._lock:
+            evictedHandles = self._addIdleHandle(
+                dataFile, handle, handleType)
+        self._closeHandles(evictedHandles)
+
+    def checkoutFileHandle(self, dataFile, openMethod, handleType=None):
+        """
+        Returns a handle on the specified file for the exclusive use of
+        the caller, which must give it back with checkinFileHandle. An
+        idle handle on the file is reused if there is one, otherwise the
+        file is opened using openMethod.
+        """
+        self._checkProcess()
+        with self._lock:
+            self._accessCounts[getDataFilePath(dataFile)] += 1
+            idleHandles = self._idleHandles[handleType]
+            counters = self._metrics[handleType]
+            handles = idleHandles.get(dataFile)
+            if handles is not None:
+                handle = handles.pop()
+                if len(handles) == 0:
+                    del idleHandles[dataFile]
+                self._numIdleHandles[handleType] -= 1
+                self._numCheckedOutHandles[handleType] += 1
+                counters["hits"] += 1
+                return handle
+            counters["misses"] += 1
+        # Files are opened outside of the lock, so that a slow open does
+        # not hold up other threads.
+        handle = self._openFile(dataFile, openMethod, handleType)
+        with self._lock:
+            self._numCheckedOutHandles[handleType] += 1
+        return handle
+
+    def checkinFileHandle(self, dataFile, handle, handleType=None):
+        """
+        Gives back a handle on the specified file obtained from
+        checkoutFileHandle, making it available to other users.
+        """
+        with self._lock:
+            self._numCheckedOutHandles[handleType] -= 1
+            evictedHandles = self._addIdleHandle(
+                dataFile, handle, handleType)
+        self._closeHandles(evictedHandles)
+
+    @contextlib.contextmanager
+    def fileHandle(self, dataFile, openMethod, handleType=None):
+        """
+        Returns a context manager checking out a handle on the specified
+        file for the duration of the with block. Generators reading from
+        the handle must do so within the block, so that the handle is
+        checked back in when they are exhausted or closed.
+        """
+        handle = self.checkoutFileHandle(dataFile, openMethod, handleType)
+        try:
+            yield handle
+        finally:
+            self.checkinFileHandle(dataFile, handle, handleType)
 
-            self._memoTable[dataFile] = handle
-            self._add(dataFile, handle)
-            if len(self._memoTable) > self._maxCacheSize:
-                dataFile = self._removeLru()
-                del self._memoTable[dataFile]
-            return handle
+
+def getDataFilePath(dataFile):
+    """
+    Returns the path of the specified data file, as given to
+    PysamDatamodelMixin.fileHandle. Variant files are given as a
+    (dataUrl, indexFile) tuple.
+    """
+    if isinstance(dataFile, tuple):
+        return dataFile[0]
+    return dataFile
 
 
-# LRU cache of open file handles
+# Pool of open file handles
 fileHandleCache = PysamFileHandleCache()
 
 
@@ -515,6 +680,8 @@ class PysamDatamodelMixin(object):
     directories of files interpreted using pysam. This mixin is designed
     to work within the DatamodelObject hierarchy.
     """
+    fileHandleType = None
+
     samMin = 0
     samMaxStart = 2**30 - 1
     samMaxEnd = 2**30
@@ -597,5 +764,22 @@ class PysamDatamodelMixin(object):
             attr = attr[:cls.maxStringLength]
         return attr
 
-    def getFileHandle(self, dataFile):
-        return fileHandleCache.getFileHandle(dataFile, self.openFile)
+    def fileHandle(self, dataFile):
+        """
+        Returns a context manager checking out a handle on the specified
+        data file from the file handle pool for the duration of the with
+        block.
+        """
+        return fileHandleCache.fileHandle(
+            dataFile, self.openFile, self.fileHandleType)
+
+    def preloadFileHandle(self, dataFile):
+        fileHandleCache.preloadFileHandle(
+            dataFile, self.openFile, self.fileHandleType)
+
+    def getDataFiles(self):
+        """
+        Returns the list of data files opened by this object, as given to
+        fileHandle.
+        """
+        return []
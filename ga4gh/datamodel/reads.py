@@ -6,10 +6,20 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import array
+import collections
+import contextlib
 import datetime
+import hashlib
+import heapq
+import itertools
 import json
+import mmap
 import os.path
 import random
+import struct
+import tempfile
+import threading
 
 import pysam
 
@@ -20,6 +30,24 @@ import ga4gh.protocol as protocol
 import ga4gh.pb as pb
 
 
+def isCramFile(dataUrl):
+    """
+    Returns True if the specified alignment file is a CRAM file rather
+    than a BAM file.
+    """
+    return dataUrl.endswith(".cram")
+
+
+def getDefaultIndexFile(dataUrl):
+    """
+    Returns the usual path of the index of the specified BAM or CRAM
+    file.
+    """
+    if isCramFile(dataUrl):
+        return dataUrl + ".crai"
+    return dataUrl + ".bai"
+
+
 def parseMalformedBamHeader(headerDict):
     """
     Parses the (probably) intended values out of the specified
@@ -94,49 +122,891 @@ class SamFlags(object):
         return flagAttr | flag
 
 
+class ReadFilter(object):
+    """
+    Selects reads by their SAM flags and mapping quality, as the -F, -f
+    and -q options of samtools view do, so that unwanted reads are
+    dropped before they are converted.
+    """
+    def __init__(self, excludeFlags=0, requireFlags=0, minMappingQuality=0):
+        self._excludeFlags = excludeFlags
+        self._requireFlags = requireFlags
+        self._minMappingQuality = minMappingQuality
+
+    def isSelected(self, read):
+        """
+        Returns True if the specified pysam read passes this filter.
+        """
+        flag = read.flag
+        return (
+            flag & self._excludeFlags == 0 and
+            flag & self._requireFlags == self._requireFlags and
+            read.mapping_quality >= self._minMappingQuality)
+
+
+class ReadDownsampler(object):
+    """
+    Deterministically selects a subset of reads, so that deep regions
+    can be thinned out before the reads are converted. Each read is
+    given a key in [0, 1) from a hash of its name, so that mates are
+    kept or dropped together and the same query always yields the same
+    reads. Reads with a key of at least fraction are dropped and, if
+    maxReadsPerWindow is given, only that many reads with the smallest
+    keys are kept among the reads starting in each window of windowSize
+    bases.
+    """
+    def __init__(self, fraction=1.0, maxReadsPerWindow=None, windowSize=1):
+        self._fraction = fraction
+        self._maxReadsPerWindow = maxReadsPerWindow
+        self._windowSize = windowSize
+
+    @classmethod
+    def getKey(cls, readName):
+        """
+        Returns the key in [0, 1) of the read with the specified name.
+        """
+        digest = hashlib.md5(readName.encode("utf-8")).digest()
+        return struct.unpack(b">Q", digest[:8])[0] / 2**64
+
+    def getWindowedRange(self, start, end):
+        """
+        Returns the specified range widened to whole windows, which must
+        be fetched for the reads kept in a window not to depend on the
+        range searched.
+        """
+        if self._maxReadsPerWindow is None:
+            return start, end
+        if start is not None:
+            start -= start % self._windowSize
+        if end is not None:
+            end += -end % self._windowSize
+        return start, end
+
+    def _selectReads(self, heap):
+        return [read for _, _, read in sorted(heap, key=lambda x: x[1])]
+
+    def filterReads(
+            self, reads, getName=lambda read: read.query_name,
+            getStart=lambda read: read.reference_start):
+        """
+        Yields the selected reads from the specified reads, which must be
+        sorted by start position, in their original order.
+        """
+        window = None
+        heap = []
+        for index, read in enumerate(reads):
+            key = self.getKey(getName(read))
+            if key >= self._fraction:
+                continue
+            if self._maxReadsPerWindow is None:
+                yield read
+                continue
+            readWindow = getStart(read) // self._windowSize
+            if readWindow != window:
+                for selectedRead in self._selectReads(heap):
+                    yield selectedRead
+                heap = []
+                window = readWindow
+            # The heap holds the reads with the smallest keys in the window
+            item = (-key, index, read)
+            if len(heap) < self._maxReadsPerWindow:
+                heapq.heappush(heap, item)
+            else:
+                heapq.heappushpop(heap, item)
+        for selectedRead in self._selectReads(heap):
+            yield selectedRead
+
+
+def _overlaps(read, start, end):
+    """
+    Returns True if the specified pysam read overlaps the specified
+    range, as the reads returned by fetch do.
+    """
+    readStart = read.reference_start
+    readEnd = read.reference_end
+    if readEnd is None:
+        readEnd = readStart + 1
+    return ((start is None or readEnd > start) and
+            (end is None or readStart < end))
+
+
+def _getSortKeys(fileIndex, reads):
+    """
+    Yields a (start position, fileIndex, read) tuple for each of the
+    specified pysam reads, by which the sorted reads of several files
+    are merged.
+    """
+    for read in reads:
+        yield read.reference_start, fileIndex, read
+
+
+def _getReadNumber(flag):
+    """
+    Returns the GA4GH read number of a read with the specified SAM flag:
+    0 for the first read of a pair, 1 for the second, 2 for a read which
+    is both and -1 for a read which is neither.
+    """
+    readNumber = -1
+    if SamFlags.isFlagSet(flag, SamFlags.FIRST_IN_PAIR):
+        if SamFlags.isFlagSet(flag, SamFlags.SECOND_IN_PAIR):
+            readNumber = 2
+        else:
+            readNumber = 0
+    elif SamFlags.isFlagSet(flag, SamFlags.SECOND_IN_PAIR):
+        readNumber = 1
+    return readNumber
+
+
+def _isCountedInCoverage(read):
+    """
+    Returns True if the specified pysam read counts towards coverage.
+    As in samtools depth, unmapped, secondary, QC failed and duplicate
+    reads are left out.
+    """
+    return not (read.flag & (
+        SamFlags.READ_UNMAPPED | SamFlags.SECONDARY_ALIGNMENT |
+        SamFlags.FAILED_QUALITY_CHECK | SamFlags.DUPLICATE_READ))
+
+
+def _addAlignedBases(sums, binSize, origin, read):
+    """
+    Adds the number of bases of the specified read aligned to each bin
+    of the specified size, starting from origin, to the corresponding
+    element of sums. Bases outside of the bins are ignored.
+    """
+    end = origin + len(sums) * binSize
+    for blockStart, blockEnd in read.get_blocks():
+        blockStart = max(blockStart, origin)
+        blockEnd = min(blockEnd, end)
+        while blockStart < blockEnd:
+            binIndex = (blockStart - origin) // binSize
+            binEnd = min(origin + (binIndex + 1) * binSize, blockEnd)
+            sums[binIndex] += binEnd - blockStart
+            blockStart = binEnd
+
+
+def _getMeanDepths(sums, binSize, origin, length):
+    """
+    Returns the mean depths of the bins of the specified size starting
+    from origin, from the sums of their aligned bases. The bins are
+    clipped to the specified reference length.
+    """
+    depths = array.array(b"f", (binSum / binSize for binSum in sums))
+    lastBinStart = origin + (len(sums) - 1) * binSize
+    if len(sums) > 0 and lastBinStart < length < lastBinStart + binSize:
+        depths[-1] = sums[-1] / (length - lastBinStart)
+    return depths
+
+
+def _getAggregatedMeanDepths(depths, binSize, origin, length, factor):
+    """
+    Returns the mean depths of the bins factor times larger than the
+    bins of the specified size starting from origin, from the mean
+    depths of these bins. The bins are clipped to the specified
+    reference length.
+    """
+    sums = array.array(b"d", [0]) * (-(-len(depths) // factor))
+    for binIndex, depth in enumerate(depths):
+        binStart = origin + binIndex * binSize
+        sums[binIndex // factor] += depth * min(binSize, length - binStart)
+    return _getMeanDepths(sums, binSize * factor, origin, length)
+
+
+class CoverageTileFile(object):
+    """
+    The read coverage of a BAM file, precomputed as tiles of the mean
+    depth in bins at several resolutions, so that the coverage of any
+    region at any zoom level is read in a constant time.
+
+    The finest resolution has bins of minBinSize bases, and each of the
+    coarser ones has bins zoomFactor times larger than the previous one,
+    up to a single bin per reference. Coverage is stored for all the
+    reads in the file and for the reads of each read group. For each of
+    these tracks, the mean depths of the bins of each reference at each
+    resolution are stored as native 32 bit floats, which are memory
+    mapped and read in place. References without reads in a track are
+    left out of it. A JSON index giving the offsets of the tiles is
+    written at the end of the file, followed by its offset.
+    """
+    _magic = b"GA4GHCOV"
+    _offsetFormat = b"<Q"
+    _depthFormat = b"f"
+    allReadsTrackName = ""
+
+    def __init__(self, tileFile):
+        with open(tileFile, "rb") as tileFileHandle:
+            self._mmap = mmap.mmap(
+                tileFileHandle.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(self._magic)] != self._magic:
+            raise exceptions.FileOpenFailedException(tileFile)
+        offsetSize = struct.calcsize(self._offsetFormat)
+        indexOffset, = struct.unpack(
+            self._offsetFormat, self._mmap[-offsetSize:])
+        index = json.loads(self._mmap[indexOffset:-offsetSize])
+        self._minBinSize = index["minBinSize"]
+        self._zoomFactor = index["zoomFactor"]
+        self._lengths = index["lengths"]
+        self._tracks = index["tracks"]
+
+    @classmethod
+    def build(
+            cls, samFilePath, indexFilePath, tileFilePath, minBinSize=1024,
+            zoomFactor=4, referenceFilePath=None):
+        """
+        Writes the coverage tile file for the specified BAM or CRAM file,
+        reading it one reference at a time. CRAM files are decoded using
+        the specified FASTA file.
+        """
+        samFile = pysam.AlignmentFile(
+            samFilePath, filepath_index=indexFilePath,
+            reference_filename=referenceFilePath)
+        index = {
+            "minBinSize": minBinSize, "zoomFactor": zoomFactor,
+            "lengths": dict(zip(samFile.references, samFile.lengths)),
+            "tracks": {}}
+        try:
+            with open(tileFilePath, "wb") as tileFile:
+                tileFile.write(cls._magic)
+                for referenceName, length in zip(
+                        samFile.references, samFile.lengths):
+                    numBins = (length + minBinSize - 1) // minBinSize
+                    trackSums = {}
+                    for read in samFile.fetch(referenceName):
+                        if not _isCountedInCoverage(read):
+                            continue
+                        trackNames = [cls.allReadsTrackName]
+                        if read.has_tag(b"RG"):
+                            trackNames.append(read.get_tag(b"RG"))
+                        for trackName in trackNames:
+                            if trackName not in trackSums:
+                                trackSums[trackName] = array.array(
+                                    b"d", [0]) * numBins
+                            _addAlignedBases(
+                                trackSums[trackName], minBinSize, 0, read)
+                    for trackName, sums in trackSums.items():
+                        levels = []
+                        binSize = minBinSize
+                        while True:
+                            offset = tileFile.tell()
+                            tileFile.write(_getMeanDepths(
+                                sums, binSize, 0, length).tostring())
+                            levels.append(offset)
+                            if len(sums) <= 1:
+                                break
+                            sums = array.array(b"d", (
+                                sum(sums[i:i + zoomFactor])
+                                for i in range(0, len(sums), zoomFactor)))
+                            binSize *= zoomFactor
+                        index["tracks"].setdefault(trackName, {})[
+                            referenceName] = levels
+                indexOffset = tileFile.tell()
+                tileFile.write(json.dumps(index))
+                tileFile.write(struct.pack(cls._offsetFormat, indexOffset))
+        finally:
+            samFile.close()
+
+    def getBinSizes(self, referenceName):
+        """
+        Returns the list of bin sizes of the tiles of the specified
+        reference, from the finest to the coarsest.
+        """
+        binSizes = [self._minBinSize]
+        while binSizes[-1] < self._lengths.get(referenceName, 0):
+            binSizes.append(binSizes[-1] * self._zoomFactor)
+        return binSizes
+
+    def getDepths(self, trackName, referenceName, binSize, start, end):
+        """
+        Returns the mean depths in the bins of the specified size, which
+        must be one of the tile bin sizes, from the bin containing start
+        to the bin containing end - 1.
+        """
+        firstBin = start // binSize
+        lastBin = (end - 1) // binSize
+        levels = self._tracks.get(trackName, {}).get(referenceName)
+        if levels is None:
+            return array.array(self._depthFormat, [0]) * (
+                lastBin - firstBin + 1)
+        level = self.getBinSizes(referenceName).index(binSize)
+        depthSize = struct.calcsize(self._depthFormat)
+        depths = array.array(self._depthFormat)
+        depths.fromstring(self._mmap[
+            levels[level] + firstBin * depthSize:
+            levels[level] + (lastBin + 1) * depthSize])
+        return depths
+
+
+class ReadNameIndexFile(object):
+    """
+    An index of the reads of a BAM or CRAM file by name, so that the
+    reads of a fragment are found without scanning the file.
+
+    The index holds an entry for each read, made of a 64 bit hash of its
+    name and of its location in the file, sorted by hash and memory
+    mapped, so that the entries of a name are found by a binary search.
+    The location of a read in a BAM file is the BGZF virtual offset of
+    the read. CRAM files cannot be positioned at a read, so the location
+    of a read in a CRAM file packs its reference index in the high 32
+    bits and its position in the low 32 bits, the unplaced unmapped
+    reads being given the reference index following the last reference
+    and their rank among these reads as position. As different names
+    may share a hash, the names of the reads found are checked.
+    """
+    _magic = b"GA4GHNAM"
+    _entryFormat = b"<QQ"
+
+    def __init__(self, nameIndexFile):
+        with open(nameIndexFile, "rb") as nameIndexFileHandle:
+            self._mmap = mmap.mmap(
+                nameIndexFileHandle.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(self._magic)] != self._magic:
+            raise exceptions.FileOpenFailedException(nameIndexFile)
+        self._entrySize = struct.calcsize(self._entryFormat)
+        self._numEntries = (
+            (len(self._mmap) - len(self._magic)) // self._entrySize)
+
+    @staticmethod
+    def getNameHash(name):
+        """
+        Returns the 64 bit hash of the specified read name.
+        """
+        digest = hashlib.md5(name.encode("utf-8")).digest()
+        return struct.unpack(b"<Q", digest[:8])[0]
+
+    @classmethod
+    def _getEntries(cls, samFile):
+        """
+        Yields the (name hash, location) entry of each read of the
+        specified file, in file order.
+        """
+        if samFile.is_cram:
+            numReferences = samFile.nreferences
+            for referenceIndex in range(numReferences):
+                for read in samFile.fetch(
+                        samFile.get_reference_name(referenceIndex)):
+                    yield cls.getNameHash(read.query_name), (
+                        referenceIndex << 32 | read.reference_start)
+            for rank, read in enumerate(samFile.fetch(b"*")):
+                yield cls.getNameHash(read.query_name), (
+                    numReferences << 32 | rank)
+        else:
+            location = samFile.tell()
+            for read in samFile.fetch(until_eof=True):
+                yield cls.getNameHash(read.query_name), location
+                location = samFile.tell()
+
+    @classmethod
+    def _writeRun(cls, entries):
+        """
+        Writes the specified entries, sorted, to a temporary file, which
+        is returned positioned at its start.
+        """
+        runFile = tempfile.TemporaryFile()
+        entries.sort()
+        for entry in entries:
+            runFile.write(struct.pack(cls._entryFormat, *entry))
+        runFile.seek(0)
+        return runFile
+
+    @classmethod
+    def _readRun(cls, runFile, bufferSize=1024 * 1024):
+        """
+        Yields the entries of the specified run file.
+        """
+        entrySize = struct.calcsize(cls._entryFormat)
+        while True:
+            data = runFile.read(bufferSize - bufferSize % entrySize)
+            if len(data) == 0:
+                break
+            for offset in range(0, len(data), entrySize):
+                yield struct.unpack_from(cls._entryFormat, data, offset)
+
+    @classmethod
+    def build(
+            cls, samFilePath, indexFilePath, nameIndexFilePath,
+            referenceFilePath=None, runSize=1024 * 1024):
+        """
+        Writes the read name index of the specified BAM or CRAM file,
+        reading it once. The entries are sorted in runs of runSize
+        entries, which are written to temporary files and merged, so
+        that files of any number of reads are indexed in bounded memory.
+        CRAM files are decoded using the specified FASTA file.
+        """
+        samFile = pysam.AlignmentFile(
+            samFilePath, filepath_index=indexFilePath,
+            reference_filename=referenceFilePath)
+        runFiles = []
+        try:
+            entries = []
+            for entry in cls._getEntries(samFile):
+                entries.append(entry)
+                if len(entries) == runSize:
+                    runFiles.append(cls._writeRun(entries))
+                    entries = []
+            runFiles.append(cls._writeRun(entries))
+            with open(nameIndexFilePath, "wb") as nameIndexFile:
+                nameIndexFile.write(cls._magic)
+                for entry in heapq.merge(*[
+                        cls._readRun(runFile) for runFile in runFiles]):
+                    nameIndexFile.write(struct.pack(cls._entryFormat, *entry))
+        finally:
+            for runFile in runFiles:
+                runFile.close()
+            samFile.close()
+
+    def _getEntry(self, index):
+        return struct.unpack_from(
+            self._entryFormat, self._mmap,
+            len(self._magic) + index * self._entrySize)
+
+    def getLocations(self, name):
+        """
+        Returns the sorted list of the distinct locations of the reads
+        whose names have the same hash as the specified name.
+        """
+        nameHash = self.getNameHash(name)
+        low, high = 0, self._numEntries
+        while low < high:
+            middle = (low + high) // 2
+            if self._getEntry(middle)[0] < nameHash:
+                low = middle + 1
+            else:
+                high = middle
+        locations = set()
+        for index in range(low, self._numEntries):
+            entryHash, location = self._getEntry(index)
+            if entryHash != nameHash:
+                break
+            locations.add(location)
+        return sorted(locations)
+
+
+class CramSliceCache(object):
+    """
+    Cache of the records decoded from CRAM files. Decoding CRAM
+    containers costs far more than reading BAM blocks, so the records of
+    each reference are decoded in fixed length slices, which are kept in
+    least recently used order, and queries falling in recently read
+    slices are answered without decoding them again. The cache is shared
+    by all the threads of the process, and the records it holds are
+    only ever read.
+    """
+
+    def __init__(self, maxCacheSize=32, sliceLength=16384):
+        self._lock = threading.Lock()
+        self._cache = collections.OrderedDict()
+        self._maxCacheSize = maxCacheSize
+        self._sliceLength = sliceLength
+        self._metrics = collections.Counter()
+
+    def setMaxCacheSize(self, size):
+        """
+        Sets the maximum number of slices held in the cache.
+        """
+        if size <= 0:
+            raise ValueError(
+                "The size of the cache must be a strictly positive value")
+        with self._lock:
+            self._maxCacheSize = size
+            self._evict()
+
+    def getMaxCacheSize(self):
+        """
+        Returns the maximum number of slices held in the cache.
+        """
+        return self._maxCacheSize
+
+    def getMetrics(self):
+        """
+        Returns a dictionary of the cache hits, misses and evictions, and
+        of the current and maximum size of the cache.
+        """
+        with self._lock:
+            return {
+                "hits": self._metrics["hits"],
+                "misses": self._metrics["misses"],
+                "evictions": self._metrics["evictions"],
+                "size": len(self._cache),
+                "maxSize": self._maxCacheSize,
+            }
+
+    def _evict(self):
+        """
+        Evicts the least recently used slices until the cache is within
+        its maximum size. Must be called with the lock held.
+        """
+        while len(self._cache) > self._maxCacheSize:
+            self._cache.popitem(last=False)
+            self._metrics["evictions"] += 1
+
+    def _getSlice(self, samFile, dataUrl, referenceName, sliceIndex):
+        """
+        Returns the list of the records of the specified CRAM file that
+        overlap the specified slice of the specified reference, decoding
+        them if they are not in the cache.
+        """
+        key = (dataUrl, referenceName, sliceIndex)
+        with self._lock:
+            records = self._cache.pop(key, None)
+            if records is not None:
+                self._cache[key] = records
+                self._metrics["hits"] += 1
+                return records
+            self._metrics["misses"] += 1
+        # Slices are decoded outside of the lock, so that a slow decode
+        # does not hold up other threads.
+        sliceStart = sliceIndex * self._sliceLength
+        records = list(samFile.fetch(
+            referenceName, sliceStart, sliceStart + self._sliceLength))
+        with self._lock:
+            self._cache[key] = records
+            self._evict()
+        return records
+
+    def fetch(self, samFile, dataUrl, referenceName, start=None, end=None):
+        """
+        Returns an iterator over the records of the specified CRAM file
+        overlapping the specified region of the specified reference, in
+        the order in which samFile.fetch returns them.
+        """
+        if start is None:
+            start = 0
+        if end is None:
+            end = samFile.get_reference_length(referenceName)
+        # As in htslib, an empty region selects the reads overlapping
+        # its start
+        end = max(end, start + 1)
+        firstSlice = start // self._sliceLength
+        lastSlice = (end - 1) // self._sliceLength
+        for sliceIndex in range(firstSlice, lastSlice + 1):
+            sliceStart = sliceIndex * self._sliceLength
+            records = self._getSlice(
+                samFile, dataUrl, referenceName, sliceIndex)
+            for record in records:
+                # Records starting before the slice were returned with
+                # an earlier one.
+                if sliceIndex != firstSlice and (
+                        record.reference_start < sliceStart):
+                    continue
+                if _overlaps(record, start, end):
+                    yield record
+
+
+# Per process cache of decoded CRAM records
+cramSliceCache = CramSliceCache()
+
+
 class AlignmentDataMixin(datamodel.PysamDatamodelMixin):
     """
     Mixin class that provides methods for getting read alignments
-    from bam files
+    from bam and cram files. The reads are held in the files listed in
+    _dataUrls, whose indexes are given by _indexFiles, and the reads of
+    several files are merged in order of position.
     """
+    fileHandleType = "reads"
+    # Mate positions closer than this are fetched with a single index seek
+    mateFetchGap = 16384
+
+    def _fetchFromFile(
+            self, samFile, dataUrl, referenceName, start=None, end=None):
+        """
+        Returns an iterator over the pysam reads overlapping the specified
+        region in the specified handle on the specified file, which are
+        taken from the CRAM slice cache for CRAM files.
+        """
+        if samFile.is_cram:
+            return cramSliceCache.fetch(
+                samFile, dataUrl, referenceName, start, end)
+        return samFile.fetch(referenceName, start, end)
+
+    def _fetch(self, dataUrl, referenceName, start=None, end=None):
+        """
+        Returns an iterator over the pysam reads overlapping the specified
+        region in the specified file, read through a handle checked out
+        until the iterator is exhausted or closed.
+        """
+        with self.fileHandle(dataUrl) as samFile:
+            for read in self._fetchFromFile(
+                    samFile, dataUrl, referenceName, start, end):
+                yield read
+
+    def _fetchAll(self, referenceName, start=None, end=None):
+        """
+        Returns an iterator over the pysam reads overlapping the specified
+        region in all the files, merged by (start position, file order)
+        from the sorted reads of each file.
+        """
+        if len(self._dataUrls) == 1:
+            return self._fetch(self._dataUrls[0], referenceName, start, end)
+        return (
+            read for _, _, read in heapq.merge(*[
+                _getSortKeys(fileIndex, self._fetch(
+                    dataUrl, referenceName, start, end))
+                for fileIndex, dataUrl in enumerate(self._dataUrls)]))
+
     def _getReadAlignments(
-            self, reference, start, end, readGroupSet, readGroup):
+            self, reference, start, end, readGroupSet, readGroup,
+            downsampler=None, readFilter=None):
         """
-        Returns an iterator over the specified reads
+        Returns an iterator over the specified reads, selected by the
+        specified ReadFilter and thinned out by the specified
+        ReadDownsampler if they are given.
         """
-        # TODO If reference is None, return against all references,
-        # including unmapped reads.
-        samFile = self.getFileHandle(self._dataUrl)
         referenceName = reference.getLocalId().encode()
         # TODO deal with errors from htslib
         start, end = self.sanitizeAlignmentFileFetch(start, end)
-        readAlignments = samFile.fetch(referenceName, start, end)
+        fetchStart, fetchEnd = start, end
+        if downsampler is not None:
+            fetchStart, fetchEnd = downsampler.getWindowedRange(start, end)
+        readAlignments = (
+            readAlignment for readAlignment in
+            self._fetchAll(referenceName, fetchStart, fetchEnd)
+            if self._isSelected(readAlignment, readGroup, readFilter))
+        if downsampler is not None:
+            readAlignments = (
+                readAlignment for readAlignment in
+                downsampler.filterReads(readAlignments)
+                if _overlaps(readAlignment, start, end))
         for readAlignment in readAlignments:
-            tags = dict(readAlignment.tags)
-            if readGroup is None:
-                if 'RG' in tags:
-                    alignmentReadGroupLocalId = tags['RG']
-                    readGroupCompoundId = datamodel.ReadGroupCompoundId(
-                        readGroupSet.getCompoundId(),
-                        str(alignmentReadGroupLocalId))
-                yield self.convertReadAlignment(
-                    readAlignment, readGroupSet, str(readGroupCompoundId))
-            else:
-                if self._filterReads:
-                    if 'RG' in tags and tags['RG'] == self._localId:
+            yield self.convertReadAlignment(
+                readAlignment, readGroupSet,
+                self._getReadGroupId(readAlignment, readGroupSet, readGroup))
+
+    def _scanReadAlignments(
+            self, readGroupSet, readGroup, unmappedOnly=False, offset=None,
+            readFilter=None):
+        """
+        Returns an iterator over (read, offset) pairs for the reads of the
+        whole files, across all references in index order followed by the
+        unplaced unmapped reads, or for the unplaced unmapped reads only.
+        The files are scanned one after the other. The offset of each read
+        is a tuple of integers, the index of its file followed by its
+        offset within the file, from which the scan is resumed, just after
+        the read, by passing it back.
+        """
+        fileIndex, fileOffset = 0, None
+        if offset is not None:
+            if len(offset) < 2 or not 0 <= offset[0] < len(self._dataUrls):
+                raise exceptions.BadPageTokenException()
+            fileIndex, fileOffset = offset[0], tuple(offset[1:])
+        for fileIndex in range(fileIndex, len(self._dataUrls)):
+            dataUrl = self._dataUrls[fileIndex]
+            # The scan moves the position of the handle, which is then
+            # repositioned by the next fetch from it.
+            with self.fileHandle(dataUrl) as samFile:
+                if samFile.is_cram:
+                    scan = self._scanCramFile(
+                        samFile, unmappedOnly, fileOffset)
+                else:
+                    scan = self._scanBamFile(
+                        samFile, unmappedOnly, fileOffset)
+                for readAlignment, nextOffset in scan:
+                    if self._isSelected(readAlignment, readGroup, readFilter):
                         yield self.convertReadAlignment(
                             readAlignment, readGroupSet,
-                            str(readGroup.getCompoundId()))
-                else:
-                    yield self.convertReadAlignment(
-                        readAlignment, readGroupSet,
-                        str(readGroup.getCompoundId()))
+                            self._getReadGroupId(
+                                readAlignment, readGroupSet, readGroup)), (
+                            fileIndex,) + nextOffset
+            fileOffset = None
+
+    @staticmethod
+    def _scanBamFile(samFile, unmappedOnly, offset):
+        """
+        Scans the specified BAM file, resuming from the BGZF virtual
+        offset of the next read. The unplaced unmapped reads are reached
+        through the offset of the first of them held in the index.
+        """
+        if offset is not None:
+            if len(offset) != 1:
+                raise exceptions.BadPageTokenException()
+            samFile.seek(offset[0])
+            readAlignments = samFile.fetch(until_eof=True)
+        elif unmappedOnly:
+            readAlignments = samFile.fetch(b"*")
+        else:
+            samFile.reset()
+            readAlignments = samFile.fetch(until_eof=True)
+        for readAlignment in readAlignments:
+            yield readAlignment, (samFile.tell(),)
+
+    @staticmethod
+    def _scanCramFile(samFile, unmappedOnly, offset):
+        """
+        Scans the specified CRAM file, which cannot be positioned at a
+        read, resuming from the (reference index, position, number of reads
+        already returned at the position) of the last read instead. The
+        unplaced unmapped reads are given the reference index following
+        the last reference and position 0, so resuming among them skips
+        the reads already returned.
+        """
+        numReferences = samFile.nreferences
+        resumeKey, numSkipped = (0, 0), 0
+        if unmappedOnly:
+            resumeKey = (numReferences, 0)
+        if offset is not None:
+            if len(offset) != 3:
+                raise exceptions.BadPageTokenException()
+            resumeKey, numSkipped = tuple(offset[:2]), offset[2]
+        readKey, numReadsAtKey = None, 0
+        for referenceIndex in range(resumeKey[0], numReferences + 1):
+            if referenceIndex < numReferences:
+                readAlignments = samFile.fetch(
+                    samFile.get_reference_name(referenceIndex),
+                    resumeKey[1] if referenceIndex == resumeKey[0] else None)
+            else:
+                readAlignments = samFile.fetch(b"*")
+            for readAlignment in readAlignments:
+                key = (referenceIndex, max(readAlignment.reference_start, 0))
+                if key < resumeKey:
+                    # Overlaps the resume position but starts before it
+                    continue
+                if key != readKey:
+                    readKey, numReadsAtKey = key, 0
+                numReadsAtKey += 1
+                if key == resumeKey and numReadsAtKey <= numSkipped:
+                    continue
+                yield readAlignment, key + (numReadsAtKey,)
+
+    def _getMateAlignments(
+            self, readGroupSet, readGroup, readAlignments, reference, start,
+            end, readFilter=None):
+        """
+        Returns the mates of the specified GA4GH read alignments which are
+        placed outside the specified region of the specified reference,
+        and selected by the specified ReadFilter if it is given.
+        The distinct mate positions are sorted and fetched in order from
+        the file handles, positions less than mateFetchGap apart being
+        fetched together, so that each group costs a single index seek.
+        The files are searched in order until all the mates are found.
+        """
+        referenceName = reference.getLocalId()
+        mateKeys = set()
+        for readAlignment in readAlignments:
+            matePosition = readAlignment.next_mate_position
+            if (readAlignment.number_reads != 2 or
+                    readAlignment.read_number not in (0, 1) or
+                    not matePosition.reference_name):
+                continue
+            if (matePosition.reference_name == referenceName and
+                    (start is None or matePosition.position >= start) and
+                    (end is None or matePosition.position < end)):
+                continue
+            mateKeys.add((
+                matePosition.reference_name, matePosition.position,
+                readAlignment.fragment_name, 1 - readAlignment.read_number))
+        mateAlignments = []
+        for dataUrl in self._dataUrls:
+            if len(mateKeys) == 0:
+                break
+            with self.fileHandle(dataUrl) as samFile:
+                referenceIndexes = dict(
+                    (name, index)
+                    for index, name in enumerate(samFile.references))
+                positions = sorted(set(
+                    (referenceIndexes[name], position)
+                    for name, position, _, _ in mateKeys
+                    if name in referenceIndexes))
+                regions = []
+                for referenceIndex, position in positions:
+                    if (len(regions) > 0 and
+                            regions[-1][0] == referenceIndex and
+                            position - regions[-1][2] < self.mateFetchGap):
+                        regions[-1][2] = position
+                    else:
+                        regions.append([referenceIndex, position, position])
+                for referenceIndex, regionStart, regionEnd in regions:
+                    mateReferenceName = samFile.references[referenceIndex]
+                    for read in self._fetchFromFile(
+                            samFile, dataUrl, mateReferenceName, regionStart,
+                            regionEnd + 1):
+                        key = (
+                            mateReferenceName, read.reference_start,
+                            read.query_name, _getReadNumber(read.flag))
+                        if (key in mateKeys and not read.flag & (
+                                SamFlags.SECONDARY_ALIGNMENT |
+                                SamFlags.SUPPLEMENTARY_ALIGNMENT) and
+                                self._isSelected(read, readGroup, None)):
+                            mateKeys.remove(key)
+                            if (readFilter is None or
+                                    readFilter.isSelected(read)):
+                                mateAlignments.append(
+                                    self.convertReadAlignment(
+                                        read, readGroupSet,
+                                        self._getReadGroupId(
+                                            read, readGroupSet, readGroup)))
+        return mateAlignments
+
+    def _getReadsByName(self, readGroupSet, fragmentName, nameIndexFiles):
+        """
+        Returns an iterator over the GA4GH alignments of the reads with
+        the specified name, found from their locations in the
+        ReadNameIndexFile of each file, given by the specified map from
+        data URLs, in file order.
+        """
+        for dataUrl in self._dataUrls:
+            nameIndexFile = nameIndexFiles[dataUrl]
+            with self.fileHandle(dataUrl) as samFile:
+                for location in nameIndexFile.getLocations(fragmentName):
+                    if samFile.is_cram:
+                        referenceIndex = location >> 32
+                        position = location & 0xffffffff
+                        if referenceIndex < samFile.nreferences:
+                            reads = (
+                                read for read in self._fetchFromFile(
+                                    samFile, dataUrl,
+                                    samFile.get_reference_name(
+                                        referenceIndex),
+                                    position, position + 1)
+                                if read.reference_start == position)
+                        else:
+                            reads = itertools.islice(
+                                samFile.fetch(b"*"), position, position + 1)
+                    else:
+                        samFile.seek(location)
+                        reads = itertools.islice(
+                            samFile.fetch(until_eof=True), 1)
+                    for read in reads:
+                        if read.query_name == fragmentName:
+                            yield self.convertReadAlignment(
+                                read, readGroupSet,
+                                self._getReadGroupId(
+                                    read, readGroupSet, None))
+
+    def _isSelected(self, readAlignment, readGroup, readFilter):
+        """
+        Returns True if the specified pysam read is selected by the
+        specified ReadFilter, if it is given, and belongs to the specified
+        read group, if it is given.
+        """
+        if readFilter is not None and not readFilter.isSelected(
+                readAlignment):
+            return False
+        if readGroup is not None and self._filterReads:
+            return (
+                readAlignment.has_tag(b'RG') and
+                readAlignment.get_tag(b'RG') == self._localId)
+        return True
+
+    def _getReadGroupId(self, readAlignment, readGroupSet, readGroup):
+        """
+        Returns the ID of the specified read group, or of the read group
+        of the specified pysam read in the specified read group set if no
+        read group is given.
+        """
+        if readGroup is not None:
+            return str(readGroup.getCompoundId())
+        readGroupLocalId = HtslibReadGroupSet.defaultReadGroupName
+        if readAlignment.has_tag(b'RG'):
+            readGroupLocalId = readAlignment.get_tag(b'RG')
+        return str(datamodel.ReadGroupCompoundId(
+            readGroupSet.getCompoundId(), str(readGroupLocalId)))
 
     def convertReadAlignment(self, read, readGroupSet, readGroupId):
         """
-        Convert a pysam ReadAlignment to a GA4GH ReadAlignment
+        Convert a pysam ReadAlignment to a GA4GH ReadAlignment. Reference
+        names are taken from the header of its file, which pysam keeps
+        with the read.
         """
-        samFile = self.getFileHandle(self._dataUrl)
         # TODO fill out remaining fields
         # TODO refine in tandem with code in converters module
         ret = protocol.ReadAlignment()
@@ -149,8 +1019,7 @@ class AlignmentDataMixin(datamodel.PysamDatamodelMixin):
             ret.alignment.CopyFrom(protocol.LinearAlignment())
             ret.alignment.mapping_quality = read.mapping_quality
             ret.alignment.position.CopyFrom(protocol.Position())
-            ret.alignment.position.reference_name = samFile.getrname(
-                read.reference_id)
+            ret.alignment.position.reference_name = read.reference_name
             ret.alignment.position.position = read.reference_start
             ret.alignment.position.strand = protocol.POS_STRAND
             if SamFlags.isFlagSet(read.flag, SamFlags.READ_REVERSE_STRAND):
@@ -173,8 +1042,8 @@ class AlignmentDataMixin(datamodel.PysamDatamodelMixin):
         else:
             ret.next_mate_position.Clear()
             if read.next_reference_id != -1:
-                ret.next_mate_position.reference_name = samFile.getrname(
-                    read.next_reference_id)
+                ret.next_mate_position.reference_name = (
+                    read.next_reference_name)
             else:
                 ret.next_mate_position.reference_name = ""
             ret.next_mate_position.position = read.next_reference_start
@@ -185,14 +1054,7 @@ class AlignmentDataMixin(datamodel.PysamDatamodelMixin):
             ret.number_reads = 2
         else:
             ret.number_reads = 1
-        ret.read_number = -1
-        if SamFlags.isFlagSet(read.flag, SamFlags.FIRST_IN_PAIR):
-            if SamFlags.isFlagSet(read.flag, SamFlags.SECOND_IN_PAIR):
-                ret.read_number = 2
-            else:
-                ret.read_number = 0
-        elif SamFlags.isFlagSet(read.flag, SamFlags.SECOND_IN_PAIR):
-            ret.read_number = 1
+        ret.read_number = _getReadNumber(read.flag)
         ret.improper_placement = not SamFlags.isFlagSet(
             read.flag, SamFlags.READ_PROPER_PAIR)
         ret.read_group_id = readGroupId
@@ -203,14 +1065,74 @@ class AlignmentDataMixin(datamodel.PysamDatamodelMixin):
         ret.id = readGroupSet.getReadAlignmentId(ret)
         return ret
 
+    def getCoverage(self, reference, start, end, binSize):
+        """
+        Returns a (binSize, binStart, depths) tuple giving the mean read
+        depth in consecutive bins covering the specified region of the
+        specified reference. When there are coverage tiles, the bins of
+        the coarsest tiles no larger than the requested bin size are
+        merged into bins at least as large as requested, and less than
+        twice as large. Otherwise the bins are of the requested size and
+        computed from the reads. The depths of several files are the sums
+        of the depths of each file.
+        """
+        referenceName = reference.getLocalId()
+        length = reference.getLength()
+        trackName = self.getCoverageTrackName()
+        tileFiles = self.getCoverageTileFiles()
+        if tileFiles is not None:
+            tileFiles = [tileFiles[dataUrl] for dataUrl in self._dataUrls]
+            tileBinSizes = [
+                tileBinSize for tileBinSize in
+                tileFiles[0].getBinSizes(referenceName)
+                if tileBinSize <= binSize and all(
+                    tileBinSize in tileFile.getBinSizes(referenceName)
+                    for tileFile in tileFiles[1:])]
+            if len(tileBinSizes) > 0:
+                tileBinSize = tileBinSizes[-1]
+                factor = -(-binSize // tileBinSize)
+                binSize = tileBinSize * factor
+                origin = start - start % binSize
+                binsEnd = min(
+                    length, ((end - 1) // binSize + 1) * binSize)
+                depths = [
+                    sum(binDepths) for binDepths in zip(*[
+                        tileFile.getDepths(
+                            trackName, referenceName, tileBinSize,
+                            origin, binsEnd)
+                        for tileFile in tileFiles])]
+                depths = _getAggregatedMeanDepths(
+                    depths, tileBinSize, origin, length, factor)
+                return binSize, origin, depths.tolist()
+        origin = start - start % binSize
+        sums = array.array(b"d", [0]) * (
+            (end - 1) // binSize - start // binSize + 1)
+        for dataUrl in self._dataUrls:
+            for read in self._fetch(
+                    dataUrl, referenceName.encode(), start, end):
+                if _isCountedInCoverage(read) and (
+                        trackName == CoverageTileFile.allReadsTrackName or (
+                            read.has_tag(b"RG") and
+                            read.get_tag(b"RG") == trackName)):
+                    _addAlignedBases(sums, binSize, origin, read)
+        depths = _getMeanDepths(sums, binSize, origin, length)
+        return binSize, origin, depths.tolist()
+
     def openFile(self, dataFile):
+        indexFile = self._indexFiles[dataFile]
         # We need to check to see if the path exists here as pysam does
         # not throw an error if the index is missing.
-        if not os.path.exists(self._indexFile):
-            raise exceptions.FileOpenFailedException(self._indexFile)
+        if not os.path.exists(indexFile):
+            raise exceptions.FileOpenFailedException(indexFile)
+        # CRAM records are decoded against the FASTA file of the
+        # reference set, rather than a reference fetched by htslib
+        referenceFile = None
+        if isCramFile(dataFile):
+            referenceFile = self.getReferenceFile()
         try:
             return pysam.AlignmentFile(
-                self._dataUrl, filepath_index=self._indexFile)
+                dataFile, filepath_index=indexFile,
+                reference_filename=referenceFile)
         except IOError as exception:
             # IOError thrown when the index file passed in is not actually
             # an index file... may also happen in other cases?
@@ -305,6 +1227,42 @@ class AbstractReadGroupSet(datamodel.DatamodelObject):
         """
         raise NotImplementedError()
 
+    def getCoverage(self, reference, start, end, binSize):
+        """
+        Returns a (binSize, binStart, depths) tuple giving the mean read
+        depth in consecutive bins covering the specified region of the
+        specified reference.
+        """
+        raise exceptions.NotImplementedException(
+            "Coverage is not available for this read group set")
+
+    def scanReadAlignments(
+            self, unmappedOnly=False, offset=None, readFilter=None):
+        """
+        Returns an iterator over (read, offset) pairs for all the reads of
+        this read group set, or for its unplaced unmapped reads only. The
+        offset of each read is passed back to resume the scan after it.
+        """
+        raise exceptions.UnmappedReadsNotSupported()
+
+    def getMateAlignments(
+            self, readAlignments, reference, start, end, readFilter=None):
+        """
+        Returns the mates of the specified GA4GH read alignments which are
+        placed outside the specified region of the specified reference,
+        and selected by the specified ReadFilter if it is given.
+        """
+        raise exceptions.NotImplementedException(
+            "Mates are not available for this read group set")
+
+    def getReadAlignmentsByName(self, fragmentName):
+        """
+        Returns an iterator over the GA4GH alignments of the reads of the
+        fragment with the specified name in this read group set.
+        """
+        raise exceptions.NotImplementedException(
+            "Reads cannot be looked up by name in this read group set")
+
     def getReadAlignmentId(self, gaAlignment):
         """
         Returns a string ID suitable for use in the specified GA
@@ -347,33 +1305,66 @@ class SimulatedReadGroupSet(AbstractReadGroupSet):
     def getPrograms(self):
         return []
 
-    def getReadAlignments(self, referenceId=None, start=None, end=None):
+    def getReadAlignments(
+            self, referenceId=None, start=None, end=None, downsampler=None,
+            readFilter=None):
         for readGroup in self.getReadGroups():
-            iterator = readGroup.getReadAlignments(referenceId, start, end)
+            iterator = readGroup.getReadAlignments(
+                referenceId, start, end, downsampler, readFilter)
             for alignment in iterator:
                 yield alignment
 
 
 class HtslibReadGroupSet(AlignmentDataMixin, AbstractReadGroupSet):
     """
-    Class representing a logical collection ReadGroups.
+    Class representing a logical collection ReadGroups, held in one or
+    more BAM or CRAM files, such as the files of the lanes of a sample.
+    Each read group is read from the files in which it appears.
     """
     defaultReadGroupName = "default"
+    coverageTileFileSuffix = ".coverage"
+    readNameIndexFileSuffix = ".names"
 
     def __init__(self, parentContainer, localId):
         super(HtslibReadGroupSet, self).__init__(parentContainer, localId)
         self._programs = []
-        self._dataUrl = None
-        self._indexFile = None
+        self._dataUrls = []
+        self._indexFiles = {}
+        self._readGroupDataUrls = {}
+        self._coverageTileFiles = None
+        self._coverageTileFilesChecked = False
+        self._readNameIndexFiles = None
+        self._readNameIndexFilesChecked = False
         # Used when we populate from a file. Not defined when we populate
         # from the DB.
         self._bamHeaderReferenceSetName = None
 
-    def getReadAlignments(self, reference, start=None, end=None):
+    def getReadAlignments(
+            self, reference, start=None, end=None, downsampler=None,
+            readFilter=None):
         """
         Returns an iterator over the specified reads
         """
-        return self._getReadAlignments(reference, start, end, self, None)
+        return self._getReadAlignments(
+            reference, start, end, self, None, downsampler, readFilter)
+
+    def scanReadAlignments(
+            self, unmappedOnly=False, offset=None, readFilter=None):
+        return self._scanReadAlignments(
+            self, None, unmappedOnly, offset, readFilter)
+
+    def getMateAlignments(
+            self, readAlignments, reference, start, end, readFilter=None):
+        return self._getMateAlignments(
+            self, None, readAlignments, reference, start, end, readFilter)
+
+    def getReadAlignmentsByName(self, fragmentName):
+        nameIndexFiles = self.getReadNameIndexFiles()
+        if nameIndexFiles is None:
+            raise exceptions.NotImplementedException(
+                "Reads cannot be looked up by name in read group set '{}', "
+                "which has no read name index".format(self.getId()))
+        return self._getReadsByName(self, fragmentName, nameIndexFiles)
 
     def getBamHeaderReferenceSetName(self):
         """
@@ -386,8 +1377,21 @@ class HtslibReadGroupSet(AlignmentDataMixin, AbstractReadGroupSet):
         Populates the instance variables of this ReadGroupSet from the
         specified database row.
         """
-        self._dataUrl = row[b'dataUrl']
-        self._indexFile = row[b'indexFile']
+        self._dataUrls = [row[b'dataUrl']]
+        self._indexFiles = {row[b'dataUrl']: row[b'indexFile']}
+        self._readGroupDataUrls = {}
+        # Repositories written before read group sets could span several
+        # files have no dataFiles column
+        if b'dataFiles' in row.keys() and row[b'dataFiles'] is not None:
+            self._dataUrls = []
+            self._indexFiles = {}
+            for dataFile in json.loads(row[b'dataFiles']):
+                dataUrl = dataFile["dataUrl"]
+                self._dataUrls.append(dataUrl)
+                self._indexFiles[dataUrl] = dataFile["indexFile"]
+                for readGroupName in dataFile["readGroupNames"]:
+                    self._readGroupDataUrls.setdefault(
+                        readGroupName, []).append(dataUrl)
         self._programs = []
         for jsonDict in json.loads(row[b'programs']):
             program = protocol.fromJson(json.dumps(jsonDict),
@@ -403,46 +1407,99 @@ class HtslibReadGroupSet(AlignmentDataMixin, AbstractReadGroupSet):
         specified dataUrl and indexFile. If indexFile is not specified
         guess usual form.
         """
-        self._dataUrl = dataUrl
-        self._indexFile = indexFile
-        if indexFile is None:
-            self._indexFile = dataUrl + ".bai"
-        samFile = self.getFileHandle(self._dataUrl)
+        indexFiles = None
+        if indexFile is not None:
+            indexFiles = [indexFile]
+        self.populateFromFiles([dataUrl], indexFiles)
+
+    def populateFromFiles(self, dataUrls, indexFiles=None):
+        """
+        Populates the instance variables of this ReadGroupSet from the
+        specified lists of data files and indexes, which must be in the
+        same order. If indexFiles is not specified guess usual form. The
+        read groups, programs and numbers of reads of the files are
+        combined.
+        """
+        if indexFiles is None:
+            indexFiles = [getDefaultIndexFile(dataUrl) for dataUrl in dataUrls]
+        assert len(dataUrls) == len(indexFiles)
+        self._dataUrls = list(dataUrls)
+        self._indexFiles = dict(zip(dataUrls, indexFiles))
+        self._readGroupDataUrls = {}
+        self._programs = []
+        self._bamHeaderReferenceSetName = None
+        self._numAlignedReads = 0
+        self._numUnalignedReads = 0
+        readGroupHeaders = collections.OrderedDict()
+        for dataUrl in self._dataUrls:
+            if isCramFile(dataUrl):
+                # The reference set needed to decode the CRAM records is not
+                # known until the header is read, so this handle is not
+                # pooled
+                samFileHandle = contextlib.closing(self.openFile(dataUrl))
+            else:
+                samFileHandle = self.fileHandle(dataUrl)
+            with samFileHandle as samFile:
+                self._readFileHeader(dataUrl, samFile, readGroupHeaders)
+        for readGroupName, readGroupHeader in readGroupHeaders.items():
+            readGroup = HtslibReadGroup(self, readGroupName)
+            if readGroupHeader is not None:
+                readGroup.populateFromHeader(readGroupHeader)
+            self.addReadGroup(readGroup)
+
+    def checkConsistency(self, dataRepository):
+        pass
+        # TODO verify that the references in the BAM file exist
+        # in the reference set. Otherwise, we won't be able to
+        # query for them.
+
+    def _readFileHeader(self, dataUrl, samFile, readGroupHeaders):
+        """
+        Adds the read groups, programs, reference set name and numbers of
+        reads of the specified handle on the specified file to this
+        ReadGroupSet, recording the header of each read group in the
+        specified OrderedDict.
+        """
         self._setHeaderFields(samFile)
         if 'RG' not in samFile.header or len(samFile.header['RG']) == 0:
-            readGroup = HtslibReadGroup(self, self.defaultReadGroupName)
-            self.addReadGroup(readGroup)
+            readGroupHeaders.setdefault(self.defaultReadGroupName, None)
+            self._readGroupDataUrls.setdefault(
+                self.defaultReadGroupName, []).append(dataUrl)
         else:
             for readGroupHeader in samFile.header['RG']:
-                readGroup = HtslibReadGroup(self, readGroupHeader['ID'])
-                readGroup.populateFromHeader(readGroupHeader)
-                self.addReadGroup(readGroup)
-        self._bamHeaderReferenceSetName = None
+                readGroupHeaders.setdefault(
+                    readGroupHeader['ID'], readGroupHeader)
+                self._readGroupDataUrls.setdefault(
+                    readGroupHeader['ID'], []).append(dataUrl)
         for referenceInfo in samFile.header['SQ']:
             if 'AS' not in referenceInfo:
                 infoDict = parseMalformedBamHeader(referenceInfo)
             else:
                 infoDict = referenceInfo
-            name = infoDict.get('AS', references.DEFAULT_REFERENCESET_NAME)
+            name = infoDict.get(
+                'AS', references.DEFAULT_REFERENCESET_NAME)
             if self._bamHeaderReferenceSetName is None:
                 self._bamHeaderReferenceSetName = name
             elif self._bamHeaderReferenceSetName != name:
                 raise exceptions.MultipleReferenceSetsInReadGroupSet(
-                    self._dataUrl, name, self._bamFileReferenceName)
-        self._numAlignedReads = samFile.mapped
-        self._numUnalignedReads = samFile.unmapped
-
-    def checkConsistency(self, dataRepository):
-        pass
-        # TODO verify that the references in the BAM file exist
-        # in the reference set. Otherwise, we won't be able to
-        # query for them.
+                    dataUrl, name, self._bamHeaderReferenceSetName)
+        if samFile.is_cram:
+            # CRAM indexes do not record the numbers of reads
+            self._numAlignedReads = -1
+            self._numUnalignedReads = -1
+        elif self._numAlignedReads != -1:
+            self._numAlignedReads += samFile.mapped
+            self._numUnalignedReads += samFile.unmapped
 
     def _setHeaderFields(self, samFile):
-        programs = []
+        programIds = set(program.id for program in self._programs)
         if 'PG' in samFile.header:
             htslibPrograms = samFile.header['PG']
             for htslibProgram in htslibPrograms:
+                if htslibProgram['ID'] in programIds:
+                    # The files of the lanes of a sample are usually
+                    # written by the same programs
+                    continue
                 program = protocol.Program()
                 program.id = htslibProgram['ID']
                 program.command_line = htslibProgram.get(
@@ -451,23 +1508,128 @@ class HtslibReadGroupSet(AlignmentDataMixin, AbstractReadGroupSet):
                 program.prev_program_id = htslibProgram.get(
                     'PP', pb.DEFAULT_STRING)
                 program.version = htslibProgram.get('VN', pb.DEFAULT_STRING)
-                programs.append(program)
-        self._programs = programs
+                self._programs.append(program)
+                programIds.add(program.id)
 
     def getPrograms(self):
         return self._programs
 
     def getDataUrl(self):
         """
-        Returns the data URL for this ReadGroupSet.
+        Returns the data URL of the first file of this ReadGroupSet.
+        """
+        return self._dataUrls[0]
+
+    def getDataUrls(self):
+        """
+        Returns the data URLs of the files of this ReadGroupSet, in order.
+        """
+        return self._dataUrls
+
+    def getDataFiles(self):
+        return list(self._dataUrls)
+
+    def getIndexFile(self, dataUrl=None):
+        """
+        Returns the index file of the specified file of this ReadGroupSet,
+        or of its first file if none is specified.
+        """
+        if dataUrl is None:
+            dataUrl = self._dataUrls[0]
+        return self._indexFiles[dataUrl]
+
+    def getReadGroupDataUrls(self, readGroupName):
+        """
+        Returns the data URLs of the files holding the reads of the read
+        group with the specified name, in order.
+        """
+        return self._readGroupDataUrls.get(readGroupName, self._dataUrls)
+
+    def getReadGroupNames(self, dataUrl):
+        """
+        Returns the names of the read groups with reads in the specified
+        file.
+        """
+        return [
+            readGroup.getLocalId() for readGroup in self.getReadGroups()
+            if dataUrl in self.getReadGroupDataUrls(readGroup.getLocalId())]
+
+    def getReferenceFile(self):
+        """
+        Returns the path of the FASTA file of the reference set of this
+        ReadGroupSet, against which CRAM records are decoded, or None if
+        the reference set is not known yet.
+        """
+        if self._referenceSet is None:
+            return None
+        return self._referenceSet.getDataUrl()
+
+    def getCoverageTrackName(self):
+        return CoverageTileFile.allReadsTrackName
+
+    def _getSidecarFiles(self, suffix, fileClass):
+        """
+        Returns a map from the data URLs of the files of this read group
+        set to the instances of the specified class for the files with the
+        specified suffix written next to them, or None if any of these is
+        missing or older than its BAM or CRAM file.
+        """
+        sidecarFiles = {}
+        for dataUrl in self._dataUrls:
+            sidecarFilePath = dataUrl + suffix
+            if not (os.path.exists(sidecarFilePath) and
+                    os.path.getmtime(sidecarFilePath) >=
+                    os.path.getmtime(dataUrl)):
+                return None
+            sidecarFiles[dataUrl] = fileClass(sidecarFilePath)
+        return sidecarFiles
+
+    def writeCoverageTileFile(self):
+        """
+        Writes the CoverageTileFile for each BAM or CRAM file of this read
+        group set next to it, from where it is used to serve coverage.
         """
-        return self._dataUrl
+        for dataUrl in self._dataUrls:
+            CoverageTileFile.build(
+                dataUrl, self._indexFiles[dataUrl],
+                dataUrl + self.coverageTileFileSuffix,
+                referenceFilePath=self.getReferenceFile())
 
-    def getIndexFile(self):
+    def getCoverageTileFiles(self):
         """
-        Returns the index file for this ReadGroupSet.
+        Returns a map from the data URLs of the files of this read group
+        set to the CoverageTileFiles written next to them, or None if any
+        of these is missing or older than its BAM file.
         """
-        return self._indexFile
+        if not self._coverageTileFilesChecked:
+            self._coverageTileFilesChecked = True
+            self._coverageTileFiles = self._getSidecarFiles(
+                self.coverageTileFileSuffix, CoverageTileFile)
+        return self._coverageTileFiles
+
+    def writeReadNameIndexFile(self):
+        """
+        Writes the ReadNameIndexFile for each BAM or CRAM file of this
+        read group set next to it, from where it is used to look up reads
+        by name.
+        """
+        for dataUrl in self._dataUrls:
+            ReadNameIndexFile.build(
+                dataUrl, self._indexFiles[dataUrl],
+                dataUrl + self.readNameIndexFileSuffix,
+                referenceFilePath=self.getReferenceFile())
+
+    def getReadNameIndexFiles(self):
+        """
+        Returns a map from the data URLs of the files of this read group
+        set to the ReadNameIndexFiles written next to them, or None if any
+        of these is missing or older than its BAM or CRAM file.
+        """
+        if not self._readNameIndexFilesChecked:
+            self._readNameIndexFilesChecked = True
+            self._readNameIndexFiles = self._getSidecarFiles(
+                self.readNameIndexFileSuffix, ReadNameIndexFile)
+        return self._readNameIndexFiles
 
 
 class AbstractReadGroup(datamodel.DatamodelObject):
@@ -558,6 +1720,34 @@ class AbstractReadGroup(datamodel.DatamodelObject):
         """
         raise NotImplementedError()
 
+    def getCoverage(self, reference, start, end, binSize):
+        """
+        Returns a (binSize, binStart, depths) tuple giving the mean read
+        depth in consecutive bins covering the specified region of the
+        specified reference.
+        """
+        raise exceptions.NotImplementedException(
+            "Coverage is not available for this read group")
+
+    def scanReadAlignments(
+            self, unmappedOnly=False, offset=None, readFilter=None):
+        """
+        Returns an iterator over (read, offset) pairs for all the reads of
+        this read group, or for its unplaced unmapped reads only. The
+        offset of each read is passed back to resume the scan after it.
+        """
+        raise exceptions.UnmappedReadsNotSupported()
+
+    def getMateAlignments(
+            self, readAlignments, reference, start, end, readFilter=None):
+        """
+        Returns the mates of the specified GA4GH read alignments which are
+        placed outside the specified region of the specified reference,
+        and selected by the specified ReadFilter if it is given.
+        """
+        raise exceptions.NotImplementedException(
+            "Mates are not available for this read group")
+
     def getBioSampleId(self):
         return self._bioSampleId
 
@@ -637,7 +1827,18 @@ class SimulatedReadGroup(AbstractReadGroup):
         self._numAlignedReads = self._parentContainer.getNumAlignedReads()
         self._numUnalignedReads = 0
 
-    def getReadAlignments(self, referenceId=None, start=None, end=None):
+    def getReadAlignments(
+            self, referenceId=None, start=None, end=None, downsampler=None,
+            readFilter=None):
+        # Simulated reads are unflagged, so readFilter does not apply
+        alignments = self._getReadAlignments()
+        if downsampler is not None:
+            alignments = downsampler.filterReads(
+                alignments, lambda alignment: alignment.fragment_name,
+                lambda alignment: alignment.alignment.position.position)
+        return alignments
+
+    def _getReadAlignments(self):
         rng = random.Random(self._randomSeed)
 
         # We seed reads with sequential seeds starting from here. We hope no
@@ -714,9 +1915,12 @@ class HtslibReadGroup(AlignmentDataMixin, AbstractReadGroup):
     """
     def __init__(self, parentContainer, localId):
         super(HtslibReadGroup, self).__init__(parentContainer, localId)
-        # These attributes are used in AlignmentDataMixin.openFile
-        self._dataUrl = parentContainer.getDataUrl()
-        self._indexFile = parentContainer.getIndexFile()
+        # These attributes are used in AlignmentDataMixin. Only the files
+        # holding the reads of this read group are read.
+        self._dataUrls = parentContainer.getReadGroupDataUrls(localId)
+        self._indexFiles = dict(
+            (dataUrl, parentContainer.getIndexFile(dataUrl))
+            for dataUrl in self._dataUrls)
         self._filterReads = localId != HtslibReadGroupSet.defaultReadGroupName
         self._bioSampleId = None
         self._sampleName = None
@@ -765,12 +1969,37 @@ class HtslibReadGroup(AlignmentDataMixin, AbstractReadGroup):
         self._platformUnit = experiment.platform_unit
         self._runTime = experiment.run_time
 
-    def getReadAlignments(self, reference, start=None, end=None):
+    def getReadAlignments(
+            self, reference, start=None, end=None, downsampler=None,
+            readFilter=None):
         """
         Returns an iterator over the specified reads
         """
         return self._getReadAlignments(
-            reference, start, end, self._parentContainer, self)
+            reference, start, end, self._parentContainer, self, downsampler,
+            readFilter)
+
+    def scanReadAlignments(
+            self, unmappedOnly=False, offset=None, readFilter=None):
+        return self._scanReadAlignments(
+            self._parentContainer, self, unmappedOnly, offset, readFilter)
+
+    def getMateAlignments(
+            self, readAlignments, reference, start, end, readFilter=None):
+        return self._getMateAlignments(
+            self._parentContainer, self, readAlignments, reference, start,
+            end, readFilter)
+
+    def getCoverageTrackName(self):
+        if self._filterReads:
+            return self._localId
+        return CoverageTileFile.allReadsTrackName
+
+    def getCoverageTileFiles(self):
+        return self._parentContainer.getCoverageTileFiles()
+
+    def getReferenceFile(self):
+        return self._parentContainer.getReferenceFile()
 
     def getPrograms(self):
         return self._parentContainer.getPrograms()
@@ -6,9 +6,16 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import array
 import hashlib
+import itertools
 import json
+import mmap
+import multiprocessing
+import os
 import random
+import re
+import struct
 
 import pysam
 
@@ -44,6 +51,9 @@ class AbstractReferenceSet(datamodel.DatamodelObject):
         self._ncbiTaxonId = None
         self._sourceAccessions = []
         self._sourceUri = None
+        self._md5checksum = None
+        self._referenceMd5ChecksumMap = None
+        self._referenceAccessionMap = None
 
     def addReference(self, reference):
         """
@@ -53,6 +63,24 @@ class AbstractReferenceSet(datamodel.DatamodelObject):
         self._referenceIdMap[id_] = reference
         self._referenceNameMap[reference.getLocalId()] = reference
         self._referenceIds.append(id_)
+        self._md5checksum = None
+        self._referenceMd5ChecksumMap = None
+        self._referenceAccessionMap = None
+
+    def _indexReferences(self):
+        """
+        Builds the maps from MD5 checksums and accessions to the references
+        in this ReferenceSet, which are kept until a reference is added.
+        """
+        md5ChecksumMap = {}
+        accessionMap = {}
+        for reference in self.getReferences():
+            md5ChecksumMap.setdefault(
+                reference.getMd5Checksum(), []).append(reference)
+            for accession in reference.getSourceAccessions():
+                accessionMap.setdefault(accession, []).append(reference)
+        self._referenceMd5ChecksumMap = md5ChecksumMap
+        self._referenceAccessionMap = accessionMap
 
     def setDescription(self, description):
         """
@@ -126,19 +154,37 @@ class AbstractReferenceSet(datamodel.DatamodelObject):
             raise exceptions.ReferenceNotFoundException(id_)
         return self._referenceIdMap[id_]
 
+    def getReferencesByMd5Checksum(self, md5checksum):
+        """
+        Returns the list of References in this ReferenceSet with the
+        specified MD5 checksum.
+        """
+        if self._referenceMd5ChecksumMap is None:
+            self._indexReferences()
+        return self._referenceMd5ChecksumMap.get(md5checksum, [])
+
+    def getReferencesByAccession(self, accession):
+        """
+        Returns the list of References in this ReferenceSet with the
+        specified source accession.
+        """
+        if self._referenceAccessionMap is None:
+            self._indexReferences()
+        return self._referenceAccessionMap.get(accession, [])
+
     def getMd5Checksum(self):
         """
         Returns the MD5 checksum for this reference set. This checksum is
         calculated by making a list of `Reference.md5checksum` for all
         `Reference`s in this set. We then sort this list, and take the
-        MD5 hash of all the strings concatenated together.
+        MD5 hash of all the strings concatenated together. The checksum
+        is computed once, and again only if references are added.
         """
-        references = sorted(
-            self.getReferences(),
-            key=lambda ref: ref.getMd5Checksum())
-        checksums = ''.join([ref.getMd5Checksum() for ref in references])
-        md5checksum = hashlib.md5(checksums).hexdigest()
-        return md5checksum
+        if self._md5checksum is None:
+            checksums = ''.join(sorted(
+                ref.getMd5Checksum() for ref in self.getReferences()))
+            self._md5checksum = hashlib.md5(checksums).hexdigest()
+        return self._md5checksum
 
     def getAssemblyId(self):
         """
@@ -419,29 +465,247 @@ class SimulatedReference(AbstractReference):
 ##################################################################
 
 
+class PackedSequenceFile(object):
+    """
+    The bases of the references in a FASTA file, packed four to a byte
+    and memory mapped, so that any number of server processes share one
+    copy through the page cache.
+
+    Each reference is stored as its 2-bit packed bases (A, C, G, T, most
+    significant bits first), followed by a table of runs of any other
+    character (such as N) and a table of the runs of soft-masked
+    (lowercase) bases. Both tables are sorted arrays of native 32 bit
+    integers, which are binary searched in place. A JSON index giving the
+    offsets of these sections for each reference is written at the end of
+    the file, followed by its offset.
+    """
+    _magic = b"GA4GHPKD"
+    _offsetFormat = b"<Q"
+    _exceptionStruct = struct.Struct(b"=III")  # start, end, character
+    _maskStruct = struct.Struct(b"=II")  # start, end
+    _packTable = dict(
+        (b"".join(quad), index) for index, quad in
+        enumerate(itertools.product(b"ACGT", repeat=4)))
+    # The i-th of these translates each packed byte into its i-th base.
+    _unpackTranslations = [
+        b"".join(bases) for bases in
+        zip(*itertools.product(b"ACGT", repeat=4))]
+    _packTranslation = b"".join(
+        chr(code).upper() if chr(code).upper() in b"ACGT" else b"A"
+        for code in range(256))
+    _exceptionRe = re.compile(br"([^ACGTacgt])\1*")
+    _maskRe = re.compile(br"[a-z]+")
+
+    def __init__(self, packedFile):
+        with open(packedFile, "rb") as packedFileHandle:
+            self._mmap = mmap.mmap(
+                packedFileHandle.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(self._magic)] != self._magic:
+            raise exceptions.FileOpenFailedException(packedFile)
+        offsetSize = struct.calcsize(self._offsetFormat)
+        indexOffset, = struct.unpack(
+            self._offsetFormat, self._mmap[-offsetSize:])
+        self._index = json.loads(self._mmap[indexOffset:-offsetSize])
+
+    @classmethod
+    def _addBlock(cls, blocks, start, end, *values):
+        """
+        Appends the specified run to a flattened table of runs, merging it
+        into the last run if they are adjacent and have the same values.
+        """
+        width = 2 + len(values)
+        if (len(blocks) >= width and blocks[-width + 1] == start and
+                tuple(blocks[len(blocks) - width + 2:]) == values):
+            blocks[-width + 1] = end
+        else:
+            blocks.extend((start, end) + values)
+
+    @classmethod
+    def build(cls, fastaFilePath, packedFilePath, chunkSize=1024 * 1024):
+        """
+        Writes the packed sequence file for the specified (indexed) FASTA
+        file, reading each reference in chunks of the specified size.
+        """
+        chunkSize -= chunkSize % 4
+        fastaFile = pysam.FastaFile(fastaFilePath)
+        index = {}
+        try:
+            with open(packedFilePath, "wb") as packedFile:
+                packedFile.write(cls._magic)
+                for referenceName, length in zip(
+                        fastaFile.references, fastaFile.lengths):
+                    entry = {"length": length, "bases": packedFile.tell()}
+                    exceptionBlocks = array.array(b"I")
+                    maskBlocks = array.array(b"I")
+                    for start in range(0, length, chunkSize):
+                        end = min(start + chunkSize, length)
+                        bases = fastaFile.fetch(referenceName, start, end)
+                        for match in cls._exceptionRe.finditer(bases):
+                            cls._addBlock(
+                                exceptionBlocks, start + match.start(),
+                                start + match.end(),
+                                ord(match.group(1).upper()))
+                        for match in cls._maskRe.finditer(bases):
+                            cls._addBlock(
+                                maskBlocks, start + match.start(),
+                                start + match.end())
+                        bases = bases.translate(cls._packTranslation)
+                        bases += b"A" * (-len(bases) % 4)
+                        packedFile.write(bytearray(
+                            cls._packTable[bases[i:i + 4]]
+                            for i in range(0, len(bases), 4)))
+                    entry["exceptions"] = packedFile.tell()
+                    entry["numExceptions"] = len(exceptionBlocks) // 3
+                    packedFile.write(exceptionBlocks.tostring())
+                    entry["masks"] = packedFile.tell()
+                    entry["numMasks"] = len(maskBlocks) // 2
+                    packedFile.write(maskBlocks.tostring())
+                    index[referenceName] = entry
+                indexOffset = packedFile.tell()
+                packedFile.write(json.dumps(index))
+                packedFile.write(struct.pack(cls._offsetFormat, indexOffset))
+        finally:
+            fastaFile.close()
+
+    def _searchBlocks(self, blockStruct, offset, count, field, position):
+        """
+        Returns the index of the first run in the specified table whose
+        value of the specified field (0 for the start, 1 for the end) is
+        greater than the specified position. As the runs are sorted and do
+        not overlap, both fields increase through the table.
+        """
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            value = blockStruct.unpack_from(
+                self._mmap, offset + middle * blockStruct.size)[field]
+            if value <= position:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _getBlocks(self, blockStruct, offset, count, start, end):
+        """
+        Returns the runs in the specified table that overlap the specified
+        range as a flattened array, read from the file in one slice.
+        """
+        first = self._searchBlocks(blockStruct, offset, count, 1, start)
+        last = self._searchBlocks(blockStruct, offset, count, 0, end - 1)
+        blocks = array.array(b"I")
+        blocks.fromstring(self._mmap[
+            offset + first * blockStruct.size:
+            offset + max(first, last) * blockStruct.size])
+        return blocks
+
+    def getBases(self, referenceName, start, end):
+        """
+        Returns the bases of the specified reference in the specified
+        range, which must be within the reference. The packed bytes are
+        decoded with one translation per base position in the byte, whose
+        results are interleaved by slice assignment, so that no Python
+        code runs per base.
+        """
+        entry = self._index[referenceName]
+        packed = self._mmap[
+            entry["bases"] + start // 4:entry["bases"] + (end + 3) // 4]
+        bases = bytearray(4 * len(packed))
+        for position, translation in enumerate(self._unpackTranslations):
+            bases[position::4] = packed.translate(translation)
+        skip = start % 4
+        bases = bases[skip:skip + end - start]
+        blocks = self._getBlocks(
+            self._exceptionStruct, entry["exceptions"],
+            entry["numExceptions"], start, end)
+        for index in range(0, len(blocks), 3):
+            blockStart = max(blocks[index], start) - start
+            blockEnd = min(blocks[index + 1], end) - start
+            bases[blockStart:blockEnd] = chr(blocks[index + 2]) * (
+                blockEnd - blockStart)
+        blocks = self._getBlocks(
+            self._maskStruct, entry["masks"], entry["numMasks"], start, end)
+        for index in range(0, len(blocks), 2):
+            blockStart = max(blocks[index], start) - start
+            blockEnd = min(blocks[index + 1], end) - start
+            bases[blockStart:blockEnd] = bases[blockStart:blockEnd].lower()
+        return bytes(bases)
+
+
+def _computeMd5Checksum(fastaFile, referenceName, length, chunkSize):
+    """
+    Returns the MD5 checksum of the bases of the specified reference,
+    reading them in chunks of the specified size so that the whole
+    sequence is never held in memory.
+    """
+    md5 = hashlib.md5()
+    for start in range(0, length, chunkSize):
+        end = min(start + chunkSize, length)
+        md5.update(fastaFile.fetch(referenceName, start, end))
+    return md5.hexdigest()
+
+
+_workerFastaFile = None
+
+
+def _openWorkerFastaFile(dataUrl):
+    """
+    Opens the FASTA file read by a checksum worker process.
+    """
+    global _workerFastaFile
+    _workerFastaFile = pysam.FastaFile(dataUrl)
+
+
+def _computeMd5ChecksumInWorker(args):
+    referenceName, length, chunkSize = args
+    return _computeMd5Checksum(
+        _workerFastaFile, referenceName, length, chunkSize)
+
+
 class HtslibReferenceSet(datamodel.PysamDatamodelMixin, AbstractReferenceSet):
     """
     A referenceSet based on data on a file system
     """
+    fileHandleType = "references"
+
+    packedSequenceFileSuffix = ".packed"
+
     def __init__(self, localId):
         super(HtslibReferenceSet, self).__init__(localId)
         self._dataUrl = None
+        self._packedSequenceFile = None
+        self._packedSequenceFileChecked = False
+
+    md5ChunkSize = 1024 * 1024
 
-    def populateFromFile(self, dataUrl):
+    def populateFromFile(self, dataUrl, numProcesses=1):
         """
         Populates the instance variables of this ReferencSet from the
-        data URL.
+        data URL. Reference lengths are taken from the FASTA index, and
+        the MD5 checksums of the references are computed by streaming
+        through their bases, in the specified number of processes.
         """
         self._dataUrl = dataUrl
-        fastaFile = self.getFastaFile()
-        for referenceName in fastaFile.references:
+        with self.fastaFileHandle() as fastaFile:
+            lengths = zip(fastaFile.references, fastaFile.lengths)
+            args = [
+                (referenceName, length, self.md5ChunkSize)
+                for referenceName, length in lengths]
+            if numProcesses > 1:
+                pool = multiprocessing.Pool(
+                    numProcesses, _openWorkerFastaFile, (dataUrl,))
+                try:
+                    md5checksums = pool.map(
+                        _computeMd5ChecksumInWorker, args)
+                finally:
+                    pool.terminate()
+            else:
+                md5checksums = [
+                    _computeMd5Checksum(fastaFile, *arg) for arg in args]
+        for (referenceName, length), md5checksum in itertools.izip(
+                lengths, md5checksums):
             reference = HtslibReference(self, referenceName)
-            # TODO break this up into chunks and calculate the MD5
-            # in bits (say, 64K chunks?)
-            bases = fastaFile.fetch(referenceName)
-            md5checksum = hashlib.md5(bases).hexdigest()
             reference.setMd5checksum(md5checksum)
-            reference.setLength(len(bases))
+            reference.setLength(length)
             self.addReference(reference)
 
     def populateFromRow(self, row):
@@ -464,21 +728,50 @@ class HtslibReferenceSet(datamodel.PysamDatamodelMixin, AbstractReferenceSet):
         """
         return self._dataUrl
 
+    def writePackedSequenceFile(self):
+        """
+        Writes the PackedSequenceFile for the FASTA file of this reference
+        set next to it, from where it is used to serve bases.
+        """
+        PackedSequenceFile.build(
+            self._dataUrl, self._dataUrl + self.packedSequenceFileSuffix)
+
+    def getPackedSequenceFile(self):
+        """
+        Returns the PackedSequenceFile written next to the FASTA file of
+        this reference set, or None if there is none or it is older than
+        the FASTA file.
+        """
+        if not self._packedSequenceFileChecked:
+            self._packedSequenceFileChecked = True
+            packedFilePath = self._dataUrl + self.packedSequenceFileSuffix
+            if (os.path.exists(packedFilePath) and
+                    os.path.getmtime(packedFilePath) >=
+                    os.path.getmtime(self._dataUrl)):
+                self._packedSequenceFile = PackedSequenceFile(packedFilePath)
+        return self._packedSequenceFile
+
     def openFile(self, dataFile):
         return pysam.FastaFile(dataFile)
 
-    def getFastaFile(self):
+    def getDataFiles(self):
+        return [self._dataUrl]
+
+    def fastaFileHandle(self):
         """
-        Returns a reference to the Fasta file instance used to read the
-        data in this reference set.
+        Returns a context manager checking out a handle on the Fasta file
+        holding the data of this reference set for the duration of the
+        with block.
         """
-        return self.getFileHandle(self._dataUrl)
+        return self.fileHandle(self._dataUrl)
 
 
 class HtslibReference(datamodel.PysamDatamodelMixin, AbstractReference):
     """
     A reference based on data stored in a file on the file system
     """
+    fileHandleType = "references"
+
     def __init__(self, parentContainer, localId):
         super(HtslibReference, self).__init__(parentContainer, localId)
 
@@ -496,8 +789,11 @@ class HtslibReference(datamodel.PysamDatamodelMixin, AbstractReference):
 
     def getBases(self, start, end):
         self.checkQueryRange(start, end)
-        fastaFile = self._parentContainer.getFastaFile()
         localId = self.getLocalId().encode()
-        # TODO we should have some error checking here...
-        bases = fastaFile.fetch(localId, start, end)
+        packedSequenceFile = self._parentContainer.getPackedSequenceFile()
+        if packedSequenceFile is not None:
+            return packedSequenceFile.getBases(localId, start, end)
+        with self._parentContainer.fastaFileHandle() as fastaFile:
+            # TODO we should have some error checking here...
+            bases = fastaFile.fetch(localId, start, end)
         return bases
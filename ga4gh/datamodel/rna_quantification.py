@@ -6,6 +6,13 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import array
+import itertools
+import json
+import mmap
+import os
+import struct
+
 import ga4gh.datamodel as datamodel
 import ga4gh.protocol as protocol
 import ga4gh.exceptions as exceptions
@@ -26,6 +33,129 @@ import ga4gh.sqliteBackend as sqliteBackend
 """
 
 
+class ExpressionMatrix(object):
+    """
+    A columnar cache of the expression values of all the RnaQuantifications
+    stored in an RNA quantification sqlite DB, memory mapped from a file.
+    The file holds one row of doubles per feature, with a column per
+    RnaQuantification and NaN where a quantification has no value for
+    the feature. The rows are followed by the maximum value in each row,
+    so that features over a threshold are found without reading the rows.
+
+    The file starts with the length of a JSON header listing the feature
+    and RnaQuantification IDs in row and column order. Values are in the
+    native byte order, as the file is a cache local to the server.
+    """
+    _lengthFormat = b"<Q"
+    _typecode = b"d"
+
+    def __init__(self, matrixFile):
+        """
+        :param matrixFile: path of a file written by ExpressionMatrix.build
+        """
+        self._matrixFile = matrixFile
+        with open(matrixFile, "rb") as matrixFileHandle:
+            lengthSize = struct.calcsize(self._lengthFormat)
+            headerLength, = struct.unpack(
+                self._lengthFormat, matrixFileHandle.read(lengthSize))
+            header = json.loads(matrixFileHandle.read(headerLength))
+            self._featureIds = header["featureIds"]
+            self._rnaQuantificationIds = header["rnaQuantificationIds"]
+            self._rowsOffset = lengthSize + headerLength
+            self._mmap = mmap.mmap(
+                matrixFileHandle.fileno(), 0, access=mmap.ACCESS_READ)
+        self._featureIndexes = dict(
+            (featureId, index)
+            for index, featureId in enumerate(self._featureIds))
+        self._rowLength = array.array(self._typecode).itemsize * len(
+            self._rnaQuantificationIds)
+        self._maximaOffset = (
+            self._rowsOffset + self._rowLength * len(self._featureIds))
+
+    @classmethod
+    def build(cls, dbFile, matrixFile):
+        """
+        Writes the expression matrix for the specified RNA quantification
+        DB to the specified file, streaming through the Expression table
+        in feature order.
+        """
+        with SqliteRnaBackend(dbFile) as dataSource:
+            rnaQuantificationIds = [
+                rnaQuant["id"] for rnaQuant in
+                dataSource.searchRnaQuantificationsInDb()]
+            featureIds = [row[0] for row in dataSource._dbconn.execute(
+                "SELECT DISTINCT feature_id FROM Expression "
+                "WHERE feature_id IS NOT NULL ORDER BY feature_id")]
+            columns = dict(
+                (rnaQuantificationId, index) for index, rnaQuantificationId
+                in enumerate(rnaQuantificationIds))
+            header = json.dumps({
+                "featureIds": featureIds,
+                "rnaQuantificationIds": rnaQuantificationIds})
+            maxima = array.array(cls._typecode)
+            query = dataSource._dbconn.execute(
+                "SELECT feature_id, rna_quantification_id, expression "
+                "FROM Expression WHERE feature_id IS NOT NULL "
+                "ORDER BY feature_id")
+            with open(matrixFile, "wb") as matrixFileHandle:
+                matrixFileHandle.write(
+                    struct.pack(cls._lengthFormat, len(header)))
+                matrixFileHandle.write(header)
+                rows = itertools.groupby(query, key=lambda row: row[0])
+                for _, expressions in rows:
+                    row = array.array(
+                        cls._typecode, [float("nan")] * len(columns))
+                    for _, rnaQuantificationId, expression in expressions:
+                        if rnaQuantificationId in columns:
+                            row[columns[rnaQuantificationId]] = expression
+                    values = [value for value in row if value == value]
+                    maxima.append(max(values) if values else float("nan"))
+                    matrixFileHandle.write(row.tostring())
+                matrixFileHandle.write(maxima.tostring())
+
+    def getFeatureIds(self):
+        """
+        Returns the IDs of the features in this matrix, in row order.
+        """
+        return self._featureIds
+
+    def getRnaQuantificationIds(self):
+        """
+        Returns the local IDs of the RnaQuantifications in this matrix,
+        in column order.
+        """
+        return self._rnaQuantificationIds
+
+    def _readArray(self, offset, length):
+        values = array.array(self._typecode)
+        values.fromstring(self._mmap[offset:offset + length])
+        return values
+
+    def getFeatureIdsOverThreshold(self, threshold):
+        """
+        Returns the IDs of the features with an expression value over the
+        specified threshold in at least one RnaQuantification.
+        """
+        maxima = self._readArray(
+            self._maximaOffset,
+            array.array(self._typecode).itemsize * len(self._featureIds))
+        return [
+            featureId for featureId, maximum in
+            itertools.izip(self._featureIds, maxima)
+            if maximum > threshold]
+
+    def getRow(self, featureId):
+        """
+        Returns the array of expression values of the specified feature,
+        or None if the feature has no expression values.
+        """
+        index = self._featureIndexes.get(featureId)
+        if index is None:
+            return None
+        return self._readArray(
+            self._rowsOffset + index * self._rowLength, self._rowLength)
+
+
 class AbstractExpressionLevel(datamodel.DatamodelObject):
     """
     An abstract base class of a expression level
@@ -68,6 +198,7 @@ class SqliteExpressionLevel(AbstractExpressionLevel):
     def __init__(self, parentContainer, record):
         super(SqliteExpressionLevel, self).__init__(
             parentContainer, record["id"])
+        self._record = record
         self._expression = record["expression"]
         self._featureId = record["feature_id"]
         # sqlite stores booleans as int (False = 0, True = 1)
@@ -79,10 +210,36 @@ class SqliteExpressionLevel(AbstractExpressionLevel):
         self._confIntervalLow = record["conf_low"]
         self._confIntervalHigh = record["conf_hi"]
 
+    def toProtocolElement(self):
+        return _gaExpressionLevelForRecord(
+            self.getId(), self._parentContainer.getId(), self._record)
+
     def getName(self):
         return self._name
 
 
+def _gaExpressionLevelForRecord(id_, rnaQuantificationId, record):
+    """
+    Returns the protocol ExpressionLevel with the specified ID in the
+    specified RnaQuantification for the specified row of the Expression
+    table.
+    """
+    protocolElement = protocol.ExpressionLevel()
+    protocolElement.id = id_
+    protocolElement.name = record["name"]
+    protocolElement.feature_id = record["feature_id"]
+    protocolElement.rna_quantification_id = rnaQuantificationId
+    protocolElement.raw_read_count = record["raw_read_count"]
+    protocolElement.expression = record["expression"]
+    # sqlite stores booleans as int (False = 0, True = 1)
+    protocolElement.is_normalized = bool(record["is_normalized"])
+    protocolElement.units = record["units"]
+    protocolElement.score = record["score"]
+    protocolElement.conf_interval_low = record["conf_low"]
+    protocolElement.conf_interval_high = record["conf_hi"]
+    return protocolElement
+
+
 class AbstractRnaQuantificationSet(datamodel.DatamodelObject):
     """
     An abstract base class of a RNA quantification set
@@ -117,6 +274,41 @@ class AbstractRnaQuantificationSet(datamodel.DatamodelObject):
         return [self._rnaQuantificationIdMap[id_] for
                 id_ in self._rnaQuantificationIds]
 
+    def getExpressionMatrix(self, featureIds=[], threshold=None):
+        """
+        Returns the expression values of the specified features across
+        all RnaQuantifications in this set, as a tuple of the feature IDs,
+        the RnaQuantifications and a list with one row of expression values
+        per feature, holding None where a value is missing. If a threshold
+        is given, only features with a value over it in at least one
+        RnaQuantification are included. If no featureIds are given, all
+        features are considered.
+        """
+        rnaQuantifications = self.getRnaQuantifications()
+        values = {}
+        for column, rnaQuantification in enumerate(rnaQuantifications):
+            for expressionLevel in rnaQuantification.getExpressionLevels(
+                    threshold=float("-inf"), featureIds=featureIds):
+                gaExpressionLevel = expressionLevel.toProtocolElement()
+                row = values.setdefault(
+                    gaExpressionLevel.feature_id,
+                    [None] * len(rnaQuantifications))
+                row[column] = gaExpressionLevel.expression
+        if len(featureIds) == 0:
+            featureIds = sorted(values.keys())
+        rows = []
+        matrixFeatureIds = []
+        for featureId in featureIds:
+            row = values.get(featureId)
+            if row is None:
+                continue
+            if threshold is not None and not any(
+                    value > threshold for value in row if value is not None):
+                continue
+            matrixFeatureIds.append(featureId)
+            rows.append(row)
+        return matrixFeatureIds, rnaQuantifications, rows
+
     def getReferenceSet(self):
         """
         Returns the reference set associated with this RnaQuantificationSet.
@@ -158,6 +350,7 @@ class SqliteRnaQuantificationSet(AbstractRnaQuantificationSet):
             parentContainer, name)
         self._dbFilePath = None
         self._db = None
+        self._expressionMatrix = None
 
     def getDataUrl(self):
         """
@@ -184,6 +377,58 @@ class SqliteRnaQuantificationSet(AbstractRnaQuantificationSet):
         self._db = SqliteRnaBackend(self._dbFilePath)
         self.addRnaQuants()
 
+    def _getExpressionMatrix(self):
+        """
+        Returns the ExpressionMatrix written next to the DB (with the
+        .matrix suffix) when the set was loaded, or None if there is no
+        such file or it is older than the DB. The matrix is never built
+        here, as that is too slow to do while serving a request.
+        """
+        if self._expressionMatrix is None:
+            matrixFile = self._dbFilePath + ".matrix"
+            if (os.path.exists(matrixFile) and
+                    os.path.getmtime(matrixFile) >=
+                    os.path.getmtime(self._dbFilePath)):
+                self._expressionMatrix = ExpressionMatrix(matrixFile)
+        return self._expressionMatrix
+
+    def getExpressionMatrix(self, featureIds=[], threshold=None):
+        """
+        Returns the expression values of the specified features across
+        all RnaQuantifications in this set, read from the memory mapped
+        ExpressionMatrix. If the matrix file is missing or out of date,
+        the values are read from the DB instead. See
+        AbstractRnaQuantificationSet.
+        """
+        expressionMatrix = self._getExpressionMatrix()
+        if expressionMatrix is None:
+            return super(
+                SqliteRnaQuantificationSet, self).getExpressionMatrix(
+                    featureIds, threshold)
+        if len(featureIds) == 0:
+            featureIds = expressionMatrix.getFeatureIds()
+        if threshold is not None:
+            overThreshold = set(
+                expressionMatrix.getFeatureIdsOverThreshold(threshold))
+            featureIds = [
+                featureId for featureId in featureIds
+                if featureId in overThreshold]
+        matrixFeatureIds = []
+        rows = []
+        for featureId in featureIds:
+            row = expressionMatrix.getRow(featureId)
+            if row is not None:
+                matrixFeatureIds.append(featureId)
+                rows.append([value if value == value else None
+                             for value in row])
+        rnaQuantifications = [
+            self.getRnaQuantification(str(
+                datamodel.RnaQuantificationCompoundId(
+                    self.getCompoundId(), rnaQuantificationId)))
+            for rnaQuantificationId in
+            expressionMatrix.getRnaQuantificationIds()]
+        return matrixFeatureIds, rnaQuantifications, rows
+
     def addRnaQuants(self):
         with self._db as dataSource:
             rnaQuantsReturned = dataSource.searchRnaQuantificationsInDb()
@@ -245,6 +490,38 @@ class AbstractRnaQuantification(datamodel.DatamodelObject):
             # for now set to empty
             self._programs = []
 
+    def searchExpressionLevels(
+            self, threshold=0.0, featureIds=[], pageToken=None,
+            pageSize=None):
+        """
+        Yields (expressionLevel, nextPageToken) pairs for the protocol
+        ExpressionLevels matching the specified threshold and feature IDs.
+        The page token is the number of expression levels that precede
+        the page.
+
+        :param threshold: float minimum expression values to return
+        :param featureIds: list of feature IDs to restrict the search to
+        :param pageToken: None or str
+        :param pageSize: None or int
+        """
+        startIndex = 0
+        if pageToken:
+            try:
+                startIndex = int(pageToken)
+            except ValueError:
+                raise exceptions.BadPageTokenException(pageToken)
+        expressionLevels = self.getExpressionLevels(
+            threshold=threshold, featureIds=featureIds)[startIndex:]
+        if pageSize:
+            expressionLevels = expressionLevels[:pageSize + 1]
+        for index, expressionLevel in enumerate(expressionLevels):
+            if pageSize and index == pageSize:
+                break
+            nextPageToken = str(startIndex + index + 1)
+            if index == len(expressionLevels) - 1:
+                nextPageToken = None
+            yield expressionLevel.toProtocolElement(), nextPageToken
+
     def getReferenceSet(self):
         """
         Returns the reference set associated with this RnaQuantification.
@@ -307,7 +584,8 @@ class SqliteRnaQuantification(AbstractRnaQuantification):
     def getExpressionLevels(
             self, threshold=0.0, featureIds=[], startIndex=0, maxResults=0):
         """
-        Returns the list of ExpressionLevels in this RNA Quantification.
+        Returns the list of ExpressionLevels in this RNA Quantification,
+        ordered by expression.
         """
         rnaQuantificationId = self.getLocalId()
         with self._db as dataSource:
@@ -322,6 +600,53 @@ class SqliteRnaQuantification(AbstractRnaQuantification):
                 expressionEntry in expressionsReturned]
             return expressionLevels
 
+    def searchExpressionLevels(
+            self, threshold=0.0, featureIds=[], pageToken=None,
+            pageSize=None):
+        """
+        Yields (expressionLevel, nextPageToken) pairs for the protocol
+        ExpressionLevels matching the specified threshold and feature IDs,
+        in order of increasing expression and then rowid. The page token
+        holds the expression and rowid of the last expression level
+        returned, so each page is a seek into the
+        (rna_quantification_id, expression) index rather than a scan over
+        all of the preceding rows. The rows are converted to protocol
+        objects as they are read.
+
+        :param threshold: float minimum expression values to return
+        :param featureIds: list of feature IDs to restrict the search to
+        :param pageToken: None or str
+        :param pageSize: None or int
+        """
+        after = None
+        if pageToken:
+            try:
+                expression, rowId = pageToken.split(":")
+                after = float(expression), int(rowId)
+            except ValueError:
+                raise exceptions.BadPageTokenException(pageToken)
+        maxResults = pageSize + 1 if pageSize else 0
+        compoundId = self.getCompoundId()
+        rnaQuantificationId = self.getId()
+        with self._db as dataSource:
+            rows = dataSource.searchExpressionLevelsInDb(
+                self.getLocalId(), featureIds=featureIds,
+                threshold=threshold, maxResults=maxResults, after=after)
+            current = next(rows, None)
+            count = 0
+            while current is not None and count != pageSize:
+                following = next(rows, None)
+                nextPageToken = None
+                if following is not None:
+                    nextPageToken = "{!r}:{}".format(
+                        current["expression"], current["rowid"])
+                id_ = str(datamodel.ExpressionLevelCompoundId(
+                    compoundId, current["id"]))
+                yield _gaExpressionLevelForRecord(
+                    id_, rnaQuantificationId, current), nextPageToken
+                current = following
+                count += 1
+
     def getExpressionLevel(self, compoundId):
         expressionId = compoundId.expression_level_id
         with self._db as dataSource:
@@ -372,22 +697,31 @@ class SqliteRnaBackend(sqliteBackend.SqliteBackedDataSource):
 
     def searchExpressionLevelsInDb(
             self, rnaQuantId, featureIds=[], threshold=0.0, startIndex=0,
-            maxResults=0):
+            maxResults=0, after=None):
         """
         :param rnaQuantId: string restrict search by quantification id
         :param threshold: float minimum expression values to return
-        :return an array of dictionaries, representing the returned data.
+        :param after: None, or the (expression, rowid) of the last
+            expression level of the previous page, after which this page
+            starts
+        :return an iterator over dictionaries, representing the returned
+            data, ordered by expression and rowid.
         """
-        sql = ("SELECT * FROM Expression WHERE "
+        sql = ("SELECT rowid, * FROM Expression WHERE "
                "rna_quantification_id = ? "
                "AND expression > ? ")
         sql_args = (rnaQuantId, threshold)
+        if after is not None:
+            expression, rowId = after
+            sql += "AND expression >= ? AND (expression > ? OR rowid > ?) "
+            sql_args += (expression, expression, rowId)
         if len(featureIds) > 0:
             sql += "AND feature_id in ("
             sql += ",".join(['?' for featureId in featureIds])
             sql += ") "
             for featureId in featureIds:
                 sql_args += (featureId,)
+        sql += "ORDER BY expression, rowid"
         sql += sqliteBackend.limitsSql(
             startIndex=startIndex, maxResults=maxResults)
         query = self._dbconn.execute(sql, sql_args)
@@ -8,6 +8,7 @@ from __future__ import unicode_literals
 
 import json
 import random
+import re
 
 import ga4gh.protocol as protocol
 import ga4gh.datamodel as datamodel
@@ -55,7 +56,63 @@ _featureColumns = [
     ('name', 'TEXT'),  # the "ID" as found in GFF3, or '' if none
     ('gene_name', 'TEXT'),  # as found in GFF3 attributes
     ('transcript_name', 'TEXT'),  # as found in GFF3 attributes
-    ('attributes', 'TEXT')]  # JSON encoding of attributes dict
+    ('attributes', 'TEXT'),  # JSON encoding of attributes dict
+    ('payload', 'BLOB')]  # serialized Feature, see featurePayloadForRecord
+
+# The ways in which the name and gene symbol of a features search are
+# matched against those of the features
+NAME_MATCH_EXACT = "exact"
+NAME_MATCH_PREFIX = "prefix"
+NAME_MATCH_SUBSTRING = "substring"
+NAME_MATCHES = [NAME_MATCH_EXACT, NAME_MATCH_PREFIX, NAME_MATCH_SUBSTRING]
+
+
+def featurePayloadForRecord(record):
+    """
+    Returns the serialized protocol.Feature stored in the payload column
+    of the FEATURE table for the specified record. The record is a
+    dictionary keyed by FEATURE column name, in which child_ids and
+    attributes hold the decoded list and dictionary rather than their
+    JSON encodings.
+
+    The payload holds everything that does not depend on where the
+    feature set is served from: the id, parent_id and child_ids fields
+    hold the local feature IDs, feature_set_id is left empty and
+    feature_type only carries the term name. These are filled in by
+    Gff3DbFeatureSet as each feature is served.
+    """
+    return _localFeatureForRecord(record).SerializeToString()
+
+
+def _localFeatureForRecord(record):
+    """
+    Returns the protocol.Feature for the specified decoded FEATURE record,
+    with local feature IDs and only the term name of the feature type,
+    as described in featurePayloadForRecord.
+    """
+    gaFeature = protocol.Feature()
+    gaFeature.id = str(record['id'])
+    if record.get('parent_id'):
+        gaFeature.parent_id = str(record['parent_id'])
+    gaFeature.reference_name = pb.string(record.get('reference_name'))
+    gaFeature.start = pb.int(record.get('start'))
+    gaFeature.end = pb.int(record.get('end'))
+    gaFeature.name = pb.string(record.get('name'))
+    if record.get('strand', '') == '-':
+        gaFeature.strand = protocol.NEG_STRAND
+    else:
+        # default to positive strand
+        gaFeature.strand = protocol.POS_STRAND
+    gaFeature.child_ids.extend(map(str, record['child_ids']))
+    gaFeature.feature_type.term = pb.string(record.get('type'))
+    attributes = record['attributes']
+    # TODO: Identify which values are ExternalIdentifiers and OntologyTerms
+    for key in attributes:
+        for v in attributes[key]:
+            gaFeature.attributes.vals[key].values.add().string_value = v
+    if 'gene_name' in attributes and len(attributes['gene_name']) > 0:
+        gaFeature.gene_symbol = pb.string(attributes['gene_name'][0])
+    return gaFeature
 
 
 class Gff3DbBackend(sqliteBackend.SqliteBackedDataSource):
@@ -74,11 +131,47 @@ class Gff3DbBackend(sqliteBackend.SqliteBackedDataSource):
         super(Gff3DbBackend, self).__init__(dbFile)
         self.featureColumnNames = [f[0] for f in _featureColumns]
         self.featureColumnTypes = [f[1] for f in _featureColumns]
+        self._fullTextIndex = None
+
+    def _hasFullTextIndex(self):
+        """
+        Returns True if the DB has the FEATURE_FTS trigram index over
+        feature names and gene symbols. DBs built before the index was
+        introduced do not.
+        """
+        if self._fullTextIndex is None:
+            query = self._dbconn.execute(
+                "SELECT COUNT(*) FROM sqlite_master "
+                "WHERE type = 'table' AND lower(name) = 'feature_fts'")
+            self._fullTextIndex = query.fetchone()[0] > 0
+        return self._fullTextIndex
+
+    def _columnMatchSql(self, column, value, nameMatch=NAME_MATCH_EXACT):
+        """
+        Returns the SQL condition and arguments matching the specified
+        column against a name or gene symbol from a search request, in
+        the specified way: exactly, as a prefix or as a substring of the
+        column's values. Exact and prefix matches use the column index,
+        substring matches the full text index if the DB has one.
+        """
+        if nameMatch == NAME_MATCH_EXACT:
+            return "AND {} = ? ".format(column), (value,)
+        pattern = re.sub(r'([*?[])', r'[\1]', value) + '*'
+        if nameMatch == NAME_MATCH_PREFIX:
+            return "AND {} GLOB ? ".format(column), (pattern,)
+        pattern = '*' + pattern
+        if self._hasFullTextIndex():
+            sql = (
+                "AND id IN (SELECT rowid FROM FEATURE_FTS "
+                "WHERE {} GLOB ?) ".format(column))
+        else:
+            sql = "AND {} GLOB ? ".format(column)
+        return sql, (pattern,)
 
     def countFeaturesSearchInDb(
             self, referenceName=None, start=None, end=None,
             parentId=None, featureTypes=None,
-            name=None, geneSymbol=None):
+            name=None, geneSymbol=None, nameMatch=NAME_MATCH_EXACT):
         """
         Same parameters as searchFeaturesInDb,
         except without the pagetoken/size.
@@ -87,7 +180,7 @@ class Gff3DbBackend(sqliteBackend.SqliteBackedDataSource):
             pageToken=None, pageSize=None,
             referenceName=referenceName, start=start, end=end,
             parentId=parentId, featureTypes=featureTypes,
-            name=name, geneSymbol=geneSymbol)
+            name=name, geneSymbol=geneSymbol, nameMatch=nameMatch)
         query = self._dbconn.execute(sql, sql_args)
         return (query.fetchone())[0]
 
@@ -99,15 +192,20 @@ class Gff3DbBackend(sqliteBackend.SqliteBackedDataSource):
         """
         # TODO: Optimize by refactoring out string concatenation
         sql = ""
-        sql_rows = "SELECT * FROM FEATURE WHERE id > 1 "
-        sql_count = "SELECT COUNT(*) FROM FEATURE WHERE id > 1 "
+        sql_rows = "SELECT * FROM FEATURE WHERE id > 0 "
+        sql_count = "SELECT COUNT(*) FROM FEATURE WHERE id > 0 "
         sql_args = ()
+        nameMatch = kwargs.get('nameMatch', NAME_MATCH_EXACT)
         if 'name' in kwargs and kwargs['name']:
-            sql += "AND name = ? "  # compare this to query start
-            sql_args += (kwargs.get('name'),)
+            condition, args = self._columnMatchSql(
+                'name', kwargs['name'], nameMatch)
+            sql += condition
+            sql_args += args
         if 'geneSymbol' in kwargs and kwargs['geneSymbol']:
-            sql += "AND gene_name = ? "  # compare this to query start
-            sql_args += (kwargs.get('geneSymbol'),)
+            condition, args = self._columnMatchSql(
+                'gene_name', kwargs['geneSymbol'], nameMatch)
+            sql += condition
+            sql_args += args
         if 'start' in kwargs and kwargs['start'] is not None:
             sql += "AND end > ? "  # compare this to query start
             sql_args += (kwargs.get('start'),)
@@ -135,7 +233,7 @@ class Gff3DbBackend(sqliteBackend.SqliteBackedDataSource):
             self, pageToken=0, pageSize=None,
             referenceName=None, start=None, end=None,
             parentId=None, featureTypes=None,
-            name=None, geneSymbol=None):
+            name=None, geneSymbol=None, nameMatch=NAME_MATCH_EXACT):
         """
         Perform a full features query in database.
 
@@ -147,6 +245,8 @@ class Gff3DbBackend(sqliteBackend.SqliteBackedDataSource):
         :param parentId: string restrict search by id of parent node.
         :param name: match features by name
         :param geneSymbol: match features by gene symbol
+        :param nameMatch: one of NAME_MATCHES, how name and geneSymbol
+            are matched
         :return an array of dictionaries, representing the returned data.
         """
         # TODO: Refactor out common bits of this and the above count query.
@@ -154,11 +254,37 @@ class Gff3DbBackend(sqliteBackend.SqliteBackedDataSource):
             pageToken=pageToken, pageSize=pageSize,
             referenceName=referenceName, start=start, end=end,
             parentId=parentId, featureTypes=featureTypes,
-            name=name, geneSymbol=geneSymbol)
+            name=name, geneSymbol=geneSymbol, nameMatch=nameMatch)
         sql += sqliteBackend.limitsSql(pageToken, pageSize)
         query = self._dbconn.execute(sql, sql_args)
         return sqliteBackend.sqliteRowsToDicts(query.fetchall())
 
+    def searchFeatureSubtreeInDb(self, featureId, pageToken=0, pageSize=None):
+        """
+        Fetches the feature with the specified ID together with all
+        of its descendants, following parent_id links with a recursive
+        query. Features are returned level by level, starting with the
+        requested feature, and ordered by position within each level.
+
+        :param featureId: the ID of the root feature in the FEATURE table
+        :param pageToken: int representing first record to return
+        :param pageSize: int representing number of records to return
+        :return an array of dictionaries, representing the returned data.
+        """
+        sql = (
+            "WITH RECURSIVE subtree(id, depth) AS ("
+            "SELECT id, 0 FROM FEATURE WHERE id = ? "
+            "UNION ALL "
+            "SELECT FEATURE.id, subtree.depth + 1 FROM FEATURE "
+            "JOIN subtree ON FEATURE.parent_id = subtree.id) "
+            "SELECT FEATURE.* FROM subtree "
+            "JOIN FEATURE ON FEATURE.id = subtree.id "
+            "ORDER BY subtree.depth, FEATURE.start, FEATURE.end, "
+            "FEATURE.id")
+        sql += sqliteBackend.limitsSql(pageToken, pageSize)
+        query = self._dbconn.execute(sql, (featureId,))
+        return sqliteBackend.sqliteRowsToDicts(query.fetchall())
+
     def getFeatureById(self, featureId):
         """
         Fetch feature by featureID.
@@ -216,6 +342,25 @@ class AbstractFeatureSet(datamodel.DatamodelObject):
             gaFeatureSet.info[key].values.extend(self._info[key])
         return gaFeatureSet
 
+    def _subtreePages(self, features, pageToken, pageSize):
+        """
+        Yields (feature, nextPageToken) pairs for the specified list of
+        subtree features starting at the pageToken offset. The list may
+        hold one feature beyond pageSize, showing that another page follows.
+        """
+        offset = pageToken
+        if pageSize and len(features) > pageSize:
+            features = features[:pageSize]
+            lastToken = str(offset + pageSize)
+        else:
+            lastToken = None
+        for index, feature in enumerate(features):
+            if index == len(features) - 1:
+                nextPageToken = lastToken
+            else:
+                nextPageToken = str(offset + index + 1)
+            yield feature, nextPageToken
+
     def getCompoundIdForFeatureId(self, featureId):
         """
         Returns server-style compound ID for an internal featureId.
@@ -289,10 +434,25 @@ class SimulatedFeatureSet(AbstractFeatureSet):
         feature.parent_id = ""  # TODO: Test with nonempty parentIDs?
         return feature
 
+    def getFeatureSubtree(self, compoundId, pageToken=0, pageSize=None):
+        """
+        Returns the simulated feature for the specified ID, which has
+        no descendants.
+
+        :param compoundId: any non-null string
+        :param pageToken: int representing first feature to return
+        :param pageSize: None or int
+        :return: Yields feature, nextPageToken pairs.
+        """
+        features = [self.getFeature(compoundId)]
+        features = features[pageToken:]
+        return self._subtreePages(features, pageToken, pageSize)
+
     def getFeatures(self, referenceName=None, start=None, end=None,
                     pageToken=None, pageSize=None,
                     featureTypes=None, parentId=None,
-                    name=None, geneSymbol=None, numFeatures=10):
+                    name=None, geneSymbol=None, nameMatch=NAME_MATCH_EXACT,
+                    numFeatures=10):
         """
         Returns a set number of simulated features.
 
@@ -305,6 +465,8 @@ class SimulatedFeatureSet(AbstractFeatureSet):
         :param parentId: optional parentId to limit query.
         :param name: the name of the feature
         :param geneSymbol: the symbol for the gene the features are on
+        :param nameMatch: one of NAME_MATCHES, how name and geneSymbol
+            are matched
         :param numFeatures: number of features to generate in the return.
             10 is a reasonable (if arbitrary) default.
         :return: Yields feature, nextPageToken pairs.
@@ -344,6 +506,7 @@ class Gff3DbFeatureSet(AbstractFeatureSet):
     def __init__(self, parentContainer, localId):
         super(Gff3DbFeatureSet, self).__init__(parentContainer, localId)
         self._ontology = None
+        self._featureTypes = {}
         self._dbFilePath = None
         self._db = None
 
@@ -353,6 +516,7 @@ class Gff3DbFeatureSet(AbstractFeatureSet):
         specified value.
         """
         self._ontology = ontology
+        self._featureTypes = {}
 
     def getOntology(self):
         """
@@ -401,46 +565,89 @@ class Gff3DbFeatureSet(AbstractFeatureSet):
             gaFeature = self._gaFeatureForFeatureDbRecord(featureReturned)
             return gaFeature
 
+    def getFeatureSubtree(self, compoundId, pageToken=0, pageSize=None):
+        """
+        Returns the feature with the specified compoundId followed by all
+        of its descendants, such as the transcripts, exons and CDS of a
+        gene, as retrieved in a single DB query.
+
+        :param compoundId: a datamodel.FeatureCompoundId object
+        :param pageToken: int representing first feature to return
+        :param pageSize: None or int
+        :return: yields a protocol.Feature at a time, together with
+            the corresponding nextPageToken (which is null for the last
+            feature served out).
+        :raises: exceptions.ObjectWithIdNotFoundException if invalid
+            compoundId is provided.
+        """
+        featureId = long(compoundId.featureId)
+        limit = pageSize + 1 if pageSize else None
+        with self._db as dataSource:
+            featuresReturned = dataSource.searchFeatureSubtreeInDb(
+                featureId, pageToken, limit)
+        if len(featuresReturned) == 0 and not pageToken:
+            raise exceptions.ObjectWithIdNotFoundException(compoundId)
+        gaFeatures = [
+            self._gaFeatureForFeatureDbRecord(featureRecord)
+            for featureRecord in featuresReturned]
+        return self._subtreePages(gaFeatures, pageToken, pageSize)
+
+    def _getFeatureType(self, name):
+        """
+        Returns the OntologyTerm for the specified feature type name,
+        caching the translation as it is shared by many features.
+        """
+        if name not in self._featureTypes:
+            self._featureTypes[name] = self._ontology.getGaTermByName(name)
+        return self._featureTypes[name]
+
     def _gaFeatureForFeatureDbRecord(self, feature):
         """
         :param feature: The DB Row representing a feature
         :return: the corresponding GA4GH protocol.Feature object
         """
+        payload = feature.get('payload')
+        if payload is None:
+            # Feature DBs built before the payload column was introduced
+            return self._gaFeatureForFeatureDbColumns(feature)
         gaFeature = protocol.Feature()
-        gaFeature.id = self.getCompoundIdForFeatureId(feature['id'])
-        if feature.get('parent_id'):
+        gaFeature.ParseFromString(bytes(payload))
+        return self._gaFeatureForLocalFeature(gaFeature)
+
+    def _gaFeatureForFeatureDbColumns(self, feature):
+        """
+        :param feature: The DB Row representing a feature, without a payload
+        :return: the corresponding GA4GH protocol.Feature object
+        """
+        record = dict(feature)
+        record['child_ids'] = json.loads(feature['child_ids'])
+        record['attributes'] = json.loads(feature['attributes'])
+        return self._gaFeatureForLocalFeature(_localFeatureForRecord(record))
+
+    def _gaFeatureForLocalFeature(self, gaFeature):
+        """
+        Fills in the server IDs and the feature type term of the specified
+        protocol.Feature, which holds local feature IDs as stored in the
+        payload column, and returns it.
+        """
+        gaFeature.id = self.getCompoundIdForFeatureId(gaFeature.id)
+        if gaFeature.parent_id:
             gaFeature.parent_id = self.getCompoundIdForFeatureId(
-                    feature['parent_id'])
-        else:
-            gaFeature.parent_id = ""
+                gaFeature.parent_id)
+        childIds = [
+            self.getCompoundIdForFeatureId(childId)
+            for childId in gaFeature.child_ids]
+        del gaFeature.child_ids[:]
+        gaFeature.child_ids.extend(childIds)
         gaFeature.feature_set_id = self.getId()
-        gaFeature.reference_name = pb.string(feature.get('reference_name'))
-        gaFeature.start = pb.int(feature.get('start'))
-        gaFeature.end = pb.int(feature.get('end'))
-        gaFeature.name = pb.string(feature.get('name'))
-        if feature.get('strand', '') == '-':
-            gaFeature.strand = protocol.NEG_STRAND
-        else:
-            # default to positive strand
-            gaFeature.strand = protocol.POS_STRAND
-        gaFeature.child_ids.extend(map(
-                self.getCompoundIdForFeatureId,
-                json.loads(feature['child_ids'])))
         gaFeature.feature_type.CopyFrom(
-            self._ontology.getGaTermByName(feature['type']))
-        attributes = json.loads(feature['attributes'])
-        # TODO: Identify which values are ExternalIdentifiers and OntologyTerms
-        for key in attributes:
-            for v in attributes[key]:
-                gaFeature.attributes.vals[key].values.add().string_value = v
-        if 'gene_name' in attributes and len(attributes['gene_name']) > 0:
-            gaFeature.gene_symbol = pb.string(attributes['gene_name'][0])
+            self._getFeatureType(gaFeature.feature_type.term))
         return gaFeature
 
     def getFeatures(self, referenceName=None, start=None, end=None,
                     pageToken=None, pageSize=None,
                     featureTypes=None, parentId=None,
-                    name=None, geneSymbol=None):
+                    name=None, geneSymbol=None, nameMatch=NAME_MATCH_EXACT):
         """
         method passed to runSearchRequest to fulfill the request
         :param str referenceName: name of reference (ex: "chr1")
@@ -452,6 +659,8 @@ class Gff3DbFeatureSet(AbstractFeatureSet):
         :param parentId: none or featureID of parent
         :param name: the name of the feature
         :param geneSymbol: the symbol for the gene the features are on
+        :param nameMatch: one of NAME_MATCHES, how name and geneSymbol
+            are matched; exactly by default
         :return: yields a protocol.Feature at a time, together with
             the corresponding nextPageToken (which is null for the last
             feature served out).
@@ -465,13 +674,13 @@ class Gff3DbFeatureSet(AbstractFeatureSet):
                 referenceName=referenceName,
                 start=start, end=end,
                 parentId=parentId, featureTypes=featureTypes,
-                name=name, geneSymbol=geneSymbol)
+                name=name, geneSymbol=geneSymbol, nameMatch=nameMatch)
             featuresReturned = dataSource.searchFeaturesInDb(
                 pageToken, pageSize,
                 referenceName=referenceName,
                 start=start, end=end,
                 parentId=parentId, featureTypes=featureTypes,
-                name=name, geneSymbol=geneSymbol)
+                name=name, geneSymbol=geneSymbol, nameMatch=nameMatch)
 
         # pagination logic: None if last feature was returned,
         # else 1 + row number being returned (starting at row 0).
@@ -6,9 +6,12 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import bisect
+import collections
 import datetime
 import glob
 import hashlib
+import itertools
 import json
 import os
 import random
@@ -431,11 +434,32 @@ def isEmptyIter(it):
 class HtslibVariantSet(datamodel.PysamDatamodelMixin, AbstractVariantSet):
     """
     Class representing a single variant set backed by a directory of indexed
-    VCF or BCF files.
+    VCF or BCF files. The records of a contig may be sharded by position
+    across several files, which are chained in coordinate order.
+
+    The call sets may also be partitioned across files covering the same
+    sites, such as the sample batches of a large cohort. Files with the
+    same samples form a partition, each partition being sharded on its own,
+    and the records of the partitions holding the requested call sets are
+    joined on (position, ref, alts) as they are read.
     """
+    fileHandleType = "variants"
+
     def __init__(self, parentContainer, localId):
         super(HtslibVariantSet, self).__init__(parentContainer, localId)
+        # Maps contigs to the (start, end, dataUrl, indexFile, partition)
+        # shards holding their records, sorted by partition and start
         self._chromFileMap = {}
+        # Maps contigs and partitions to the starts of their shards and the
+        # greatest end of the shards up to each of them, which are bisected
+        # to find the shards overlapping a region
+        self._chromShardIndex = {}
+        # The sample names of each partition of the call sets, or None for
+        # a variant set read from a repository written before call sets
+        # could be partitioned, whose call sets are all in one partition
+        self._callSetPartitions = []
+        # Maps call set IDs to the indexes of their partitions
+        self._callSetPartitionMap = {}
         self._metadata = None
 
     def isAnnotated(self):
@@ -447,15 +471,39 @@ class HtslibVariantSet(datamodel.PysamDatamodelMixin, AbstractVariantSet):
 
     def getReferenceToDataUrlIndexMap(self):
         """
-        Returns the map of Reference names to the (dataUrl, indexFile) pairs.
+        Returns the map of Reference names to the lists of (start, end,
+        dataUrl, indexFile, partition) shards holding their records, sorted
+        by partition and start.
         """
         return self._chromFileMap
 
+    def getCallSetPartitions(self):
+        """
+        Returns the list of the sample names of each partition of the call
+        sets, in the order of their indexes in the shards. The call sets
+        of a variant set read from a repository written before call sets
+        could be partitioned are all in a single partition.
+        """
+        if self._callSetPartitions is None:
+            return [[callSet.getLocalId() for callSet in self.getCallSets()]]
+        return self._callSetPartitions
+
+    def getCallSetPartition(self, callSetId):
+        """
+        Returns the index of the partition holding the specified call set.
+        """
+        return self._callSetPartitionMap.get(callSetId, 0)
+
     def getDataUrlIndexPairs(self):
         """
         Returns the set of (dataUrl, indexFile) pairs.
         """
-        return set(self._chromFileMap.values())
+        return set(
+            shard[2:4] for shards in self._chromFileMap.values()
+            for shard in shards)
+
+    def getDataFiles(self):
+        return sorted(self.getDataUrlIndexPairs())
 
     def populateFromRow(self, row):
         """
@@ -467,7 +515,20 @@ class HtslibVariantSet(datamodel.PysamDatamodelMixin, AbstractVariantSet):
         # We can't load directly as we want tuples to be stored
         # rather than lists.
         for key, value in json.loads(row[b'dataUrlIndexMap']).items():
-            self._chromFileMap[key] = tuple(value)
+            if len(value) == 2 and not isinstance(value[0], list):
+                # Repositories written before contigs could be sharded
+                # map each contig to a single (dataUrl, indexFile) pair
+                value = [[0, self.vcfMax] + value]
+            # Shards written before call sets could be partitioned have no
+            # partition index
+            self._chromFileMap[key] = [
+                tuple(shard + [0] * (5 - len(shard))) for shard in value]
+        self._indexShards()
+        self._callSetPartitions = None
+        if (b'callSetPartitions' in row.keys() and
+                row[b'callSetPartitions'] is not None):
+            self._callSetPartitions = json.loads(row[b'callSetPartitions'])
+        self._indexCallSetPartitions()
         self._metadata = []
         for jsonDict in json.loads(row[b'metadata']):
             metadata = protocol.fromJson(json.dumps(jsonDict),
@@ -481,12 +542,15 @@ class HtslibVariantSet(datamodel.PysamDatamodelMixin, AbstractVariantSet):
         the jth index file corresponds to the jth data file.
         """
         assert len(dataUrls) == len(indexFiles)
+        shards = []
         for dataUrl, indexFile in zip(dataUrls, indexFiles):
             varFile = pysam.VariantFile(dataUrl, index_filename=indexFile)
             try:
-                self._populateFromVariantFile(varFile, dataUrl, indexFile)
+                shards.extend(self._populateFromVariantFile(
+                    varFile, dataUrl, indexFile))
             finally:
                 varFile.close()
+        self._addShards(shards)
 
     def populateFromDirectory(self, vcfDirectory):
         """
@@ -513,7 +577,7 @@ class HtslibVariantSet(datamodel.PysamDatamodelMixin, AbstractVariantSet):
         """
         Perform consistency check on the variant set
         """
-        for referenceName, (dataUrl, indexFile) in self._chromFileMap.items():
+        for dataUrl, indexFile in sorted(self.getDataUrlIndexPairs()):
             varFile = pysam.VariantFile(dataUrl, index_filename=indexFile)
             try:
                 for chrom in varFile.index:
@@ -527,23 +591,88 @@ class HtslibVariantSet(datamodel.PysamDatamodelMixin, AbstractVariantSet):
     def _populateFromVariantFile(self, varFile, dataUrl, indexFile):
         """
         Populates the instance variables of this VariantSet from the specified
-        pysam VariantFile object.
+        pysam VariantFile object, and returns the list of (contig,
+        partition, first start, last start, end, dataUrl, indexFile) ranges
+        of the records of each contig in the file.
         """
         if varFile.index is None:
             raise exceptions.NotIndexedException(dataUrl)
+        partition = self._updateCallSetIds(varFile)
+        shards = []
         for chrom in varFile.index:
             # Unlike Tabix indices, CSI indices include all contigs defined
             # in the BCF header.  Thus we must test each one to see if
             # records exist or else they are likely to trigger spurious
             # overlapping errors.
             chrom, _, _ = self.sanitizeVariantFileFetch(chrom)
-            if not isEmptyIter(varFile.fetch(chrom)):
-                if chrom in self._chromFileMap:
-                    raise exceptions.OverlappingVcfException(dataUrl, chrom)
-            self._chromFileMap[chrom] = dataUrl, indexFile
+            firstStart, lastStart, end = None, None, None
+            for record in varFile.fetch(chrom):
+                if firstStart is None:
+                    firstStart, end = record.start, record.stop
+                lastStart = record.start
+                end = max(end, record.stop)
+            if firstStart is not None:
+                shards.append((
+                    chrom, partition, firstStart, lastStart, end, dataUrl,
+                    indexFile))
         self._updateMetadata(varFile)
-        self._updateCallSetIds(varFile)
         self._updateVariantAnnotationSets(varFile, dataUrl)
+        return shards
+
+    def _addShards(self, shards):
+        """
+        Adds the specified (contig, partition, first start, last start,
+        end, dataUrl, indexFile) record ranges to the shards of their
+        contigs. The records of the shards of a contig within a partition
+        must not interleave, so that chaining them gives the records in
+        coordinate order.
+        """
+        lastStarts = {}
+        for (chrom, partition, firstStart, lastStart, end, dataUrl,
+                indexFile) in sorted(shards):
+            key = chrom, partition
+            if key in lastStarts and firstStart < lastStarts[key]:
+                raise exceptions.OverlappingVcfException(dataUrl, chrom)
+            lastStarts[key] = lastStart
+            self._chromFileMap.setdefault(chrom, []).append(
+                (firstStart, end, dataUrl, indexFile, partition))
+        for chromShards in self._chromFileMap.values():
+            chromShards.sort(key=lambda shard: (shard[4],) + shard[:4])
+        self._indexShards()
+
+    def _indexShards(self):
+        """
+        Builds the interval index of the shards of each contig and
+        partition.
+        """
+        self._chromShardIndex = {}
+        for chrom, chromShards in self._chromFileMap.items():
+            for shard in chromShards:
+                shards, starts, maxEnds = self._chromShardIndex.setdefault(
+                    (chrom, shard[4]), ([], [], []))
+                shards.append(shard)
+                starts.append(shard[0])
+                maxEnds.append(max(maxEnds[-1:] + [shard[1]]))
+
+    def getShards(self, referenceName, start=None, end=None, partition=0):
+        """
+        Returns the list of the (start, end, dataUrl, indexFile, partition)
+        shards of the specified partition with records overlapping the
+        specified region of the specified reference, in coordinate order.
+        """
+        key = referenceName, partition
+        if key not in self._chromShardIndex:
+            return []
+        shards, starts, maxEnds = self._chromShardIndex[key]
+        firstIndex = 0
+        if start is not None:
+            firstIndex = bisect.bisect_right(maxEnds, start)
+        lastIndex = len(shards)
+        if end is not None:
+            lastIndex = bisect.bisect_left(starts, end)
+        return [
+            shard for shard in shards[firstIndex:lastIndex]
+            if start is None or shard[1] > start]
 
     def _updateVariantAnnotationSets(self, variantFile, dataUrl):
         """
@@ -605,15 +734,19 @@ class HtslibVariantSet(datamodel.PysamDatamodelMixin, AbstractVariantSet):
 
     def _checkCallSetIds(self, variantFile):
         """
-        Checks callSetIds for consistency
-        """
-        if len(self._callSetIdMap) > 0:
-            callSetIds = set([
-                self.getCallSetId(sample)
-                for sample in variantFile.header.samples])
-            if callSetIds != set(self._callSetIdMap.keys()):
-                raise exceptions.InconsistentCallSetIdException(
-                    variantFile.filename)
+        Checks callSetIds for consistency. The samples of each file must be
+        those of a partition of the call sets, and must not be in any other
+        partition.
+        """
+        samples = set(variantFile.header.samples)
+        partitionSamples = [
+            set(partition) for partition in self.getCallSetPartitions()]
+        if len(self._callSetIdMap) > 0 and (
+                samples not in partitionSamples or any(
+                    other != samples and not other.isdisjoint(samples)
+                    for other in partitionSamples)):
+            raise exceptions.InconsistentCallSetIdException(
+                variantFile.filename)
 
     def getNumVariants(self):
         """
@@ -624,11 +757,35 @@ class HtslibVariantSet(datamodel.PysamDatamodelMixin, AbstractVariantSet):
 
     def _updateCallSetIds(self, variantFile):
         """
-        Updates the call set IDs based on the specified variant file.
-        """
-        if len(self._callSetIdMap) == 0:
-            for sample in variantFile.header.samples:
+        Updates the call set IDs based on the specified variant file, and
+        returns the index of the partition of the call sets holding its
+        samples. The samples of a file unlike those seen so far start a new
+        partition, and are added as call sets.
+        """
+        samples = list(variantFile.header.samples)
+        # The single partition of a variant set read from a repository
+        # written before call sets could be partitioned is made explicit
+        # once its call sets are known
+        self._callSetPartitions = self.getCallSetPartitions()
+        for index, partition in enumerate(self._callSetPartitions):
+            if sorted(partition) == sorted(samples):
+                return index
+        self._callSetPartitions.append(samples)
+        for sample in samples:
+            if sample not in self._callSetNameMap:
                 self.addCallSetFromName(sample)
+        self._indexCallSetPartitions()
+        return len(self._callSetPartitions) - 1
+
+    def _indexCallSetPartitions(self):
+        """
+        Maps the call set IDs to the indexes of their partitions.
+        """
+        self._callSetPartitionMap = {}
+        for index, partition in enumerate(self._callSetPartitions or []):
+            for sample in partition:
+                self._callSetPartitionMap.setdefault(
+                    self.getCallSetId(sample), index)
 
     def openFile(self, dataUrlIndexFilePair):
         dataUrl, indexFile = dataUrlIndexFilePair
@@ -655,11 +812,14 @@ class HtslibVariantSet(datamodel.PysamDatamodelMixin, AbstractVariantSet):
             call.info[key].values.extend(info[key])
         return call
 
-    def convertVariant(self, record, callSetIds):
+    def convertVariant(self, record, callSetIds, partitionRecords=None):
         """
         Converts the specified pysam variant record into a GA4GH Variant
         object. Only calls for the specified list of callSetIds will
-        be included.
+        be included. If partitionRecords is given, it maps the indexes of
+        the partitions of the call sets to their records of the variant,
+        from which the calls are taken; the call sets of partitions without
+        a record of the variant have no calls.
         """
         variant = self._createGaVariant()
         variant.reference_name = record.contig
@@ -679,25 +839,28 @@ class HtslibVariantSet(datamodel.PysamDatamodelMixin, AbstractVariantSet):
                 variant.info[key].values.extend(_encodeValue(value))
         for callSetId in callSetIds:
             callSet = self.getCallSet(callSetId)
-            pysamCall = record.samples[str(callSet.getSampleName())]
+            callSetRecord = record
+            if partitionRecords is not None:
+                callSetRecord = partitionRecords.get(
+                    self.getCallSetPartition(callSetId))
+                if callSetRecord is None:
+                    continue
+            pysamCall = callSetRecord.samples[str(callSet.getSampleName())]
             variant.calls.add().CopyFrom(
                 self._convertGaCall(callSet, pysamCall))
         variant.id = self.getVariantId(variant)
         return variant
 
     def getVariant(self, compoundId):
-        if compoundId.reference_name in self._chromFileMap:
-            varFileName = self._chromFileMap[compoundId.reference_name]
-        else:
+        if compoundId.reference_name not in self._chromFileMap:
             raise exceptions.ObjectNotFoundException(compoundId)
         start = int(compoundId.start)
-        referenceName, startPosition, endPosition = \
-            self.sanitizeVariantFileFetch(
-                compoundId.reference_name, start, start + 1)
-        cursor = self.getFileHandle(varFileName).fetch(
-            referenceName, startPosition, endPosition)
-        for record in cursor:
-            variant = self.convertVariant(record, self._callSetIds)
+        cursor = self._getJoinedPysamVariants(
+            compoundId.reference_name, start, start + 1,
+            self._getPartitions(self._callSetIds))
+        for record, partitionRecords in cursor:
+            variant = self.convertVariant(
+                record, self._callSetIds, partitionRecords)
             if (record.start == start and
                     compoundId.md5 == self.hashVariant(variant)):
                 return variant
@@ -705,20 +868,71 @@ class HtslibVariantSet(datamodel.PysamDatamodelMixin, AbstractVariantSet):
                 raise exceptions.ObjectNotFoundException()
         raise exceptions.ObjectNotFoundException(compoundId)
 
-    def getPysamVariants(self, referenceName, startPosition, endPosition):
+    def getPysamVariants(
+            self, referenceName, startPosition, endPosition, partition=0):
         """
-        Returns an iterator over the pysam VCF records corresponding to the
-        specified query.
+        Returns an iterator over the pysam VCF records of the specified
+        partition of the call sets corresponding to the specified query.
+        Only the shards overlapping the query are read, one after the
+        other, each being opened when it is reached.
         """
         if referenceName in self._chromFileMap:
-            varFileName = self._chromFileMap[referenceName]
             referenceName, startPosition, endPosition = \
                 self.sanitizeVariantFileFetch(
                     referenceName, startPosition, endPosition)
-            cursor = self.getFileHandle(varFileName).fetch(
-                referenceName, startPosition, endPosition)
-            for record in cursor:
-                yield record
+            for _, _, dataUrl, indexFile, _ in self.getShards(
+                    referenceName, startPosition, endPosition, partition):
+                with self.fileHandle((dataUrl, indexFile)) as variantFile:
+                    cursor = variantFile.fetch(
+                        referenceName, startPosition, endPosition)
+                    for record in cursor:
+                        yield record
+
+    def _getPartitions(self, callSetIds):
+        """
+        Returns the sorted list of the indexes of the partitions holding
+        the specified call sets. The sites are read from the first partition
+        if no call sets are given.
+        """
+        partitions = set(
+            self.getCallSetPartition(callSetId) for callSetId in callSetIds)
+        return sorted(partitions) or [0]
+
+    def _getJoinedPysamVariants(
+            self, referenceName, startPosition, endPosition, partitions):
+        """
+        Returns an iterator over the (record, partitionRecords) pairs of the
+        variants of the specified partitions corresponding to the specified
+        query. The records of the partitions are read in lockstep, one
+        position at a time, and joined on (position, ref, alts).
+        partitionRecords maps the partitions to their records of each
+        variant, and record is that of the first of them, from which the
+        variant's fields are taken.
+        """
+        if len(partitions) == 1:
+            for record in self.getPysamVariants(
+                    referenceName, startPosition, endPosition, partitions[0]):
+                yield record, None
+            return
+        cursors = [
+            itertools.groupby(
+                self.getPysamVariants(
+                    referenceName, startPosition, endPosition, partition),
+                key=lambda record: record.start)
+            for partition in partitions]
+        heads = [next(cursor, None) for cursor in cursors]
+        while any(head is not None for head in heads):
+            position = min(head[0] for head in heads if head is not None)
+            joined = collections.OrderedDict()
+            for index, partition in enumerate(partitions):
+                if heads[index] is None or heads[index][0] != position:
+                    continue
+                for record in heads[index][1]:
+                    key = record.ref, tuple(record.alts or ())
+                    joined.setdefault(key, {})[partition] = record
+                heads[index] = next(cursors[index], None)
+            for partitionRecords in joined.values():
+                yield partitionRecords[min(partitionRecords)], partitionRecords
 
     def getVariants(self, referenceName, startPosition, endPosition,
                     callSetIds=[]):
@@ -733,9 +947,10 @@ class HtslibVariantSet(datamodel.PysamDatamodelMixin, AbstractVariantSet):
                 if callSetId not in self._callSetIds:
                     raise exceptions.CallSetNotInVariantSetException(
                         callSetId, self.getId())
-        for record in self.getPysamVariants(
-                referenceName, startPosition, endPosition):
-            yield self.convertVariant(record, callSetIds)
+        for record, partitionRecords in self._getJoinedPysamVariants(
+                referenceName, startPosition, endPosition,
+                self._getPartitions(callSetIds)):
+            yield self.convertVariant(record, callSetIds, partitionRecords)
 
     def getMetadataId(self, metadata):
         """
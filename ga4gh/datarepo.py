@@ -36,6 +36,8 @@ class AbstractDataRepository(object):
         self._referenceSetIdMap = {}
         self._referenceSetNameMap = {}
         self._referenceSetIds = []
+        self._referenceSetMd5ChecksumMap = None
+        self._referenceSetAccessionMap = None
         self._ontologyNameMap = {}
         self._ontologyIdMap = {}
         self._ontologyIds = []
@@ -57,6 +59,8 @@ class AbstractDataRepository(object):
         self._referenceSetIdMap[id_] = referenceSet
         self._referenceSetNameMap[referenceSet.getLocalId()] = referenceSet
         self._referenceSetIds.append(id_)
+        self._referenceSetMd5ChecksumMap = None
+        self._referenceSetAccessionMap = None
 
     def addOntology(self, ontology):
         """
@@ -113,6 +117,22 @@ class AbstractDataRepository(object):
         """
         return len(self._referenceSetIds)
 
+    def getDataFiles(self):
+        """
+        Returns a list of (dataFile, datamodelObject) tuples for the
+        files opened through the file handle cache by the reference
+        sets, read group sets and variant sets in this data repository.
+        """
+        datamodelObjects = list(self.getReferenceSets())
+        for dataset in self.getDatasets():
+            datamodelObjects.extend(dataset.getReadGroupSets())
+            datamodelObjects.extend(dataset.getVariantSets())
+        return [
+            (dataFile, datamodelObject)
+            for datamodelObject in datamodelObjects
+            if isinstance(datamodelObject, datamodel.PysamDatamodelMixin)
+            for dataFile in datamodelObject.getDataFiles()]
+
     def getOntology(self, id_):
         """
         Returns the ontology with the specified ID.
@@ -150,6 +170,51 @@ class AbstractDataRepository(object):
         """
         return self._referenceSetIdMap[self._referenceSetIds[index]]
 
+    def _indexReferenceSets(self):
+        """
+        Builds the maps from MD5 checksums and accessions to the reference
+        sets in this repository. These are built on first use, once the
+        repository has been loaded, and kept until a reference set is added.
+        """
+        md5ChecksumMap = {}
+        accessionMap = {}
+        for referenceSet in self.getReferenceSets():
+            md5ChecksumMap.setdefault(
+                referenceSet.getMd5Checksum(), []).append(referenceSet)
+            for accession in referenceSet.getSourceAccessions():
+                accessionMap.setdefault(accession, []).append(referenceSet)
+        self._referenceSetMd5ChecksumMap = md5ChecksumMap
+        self._referenceSetAccessionMap = accessionMap
+
+    def getReferenceSetsByMd5Checksum(self, md5checksum):
+        """
+        Returns the list of ReferenceSets with the specified MD5 checksum.
+        """
+        if self._referenceSetMd5ChecksumMap is None:
+            self._indexReferenceSets()
+        return self._referenceSetMd5ChecksumMap.get(md5checksum, [])
+
+    def getReferenceSetsByAccession(self, accession):
+        """
+        Returns the list of ReferenceSets with the specified source
+        accession.
+        """
+        if self._referenceSetAccessionMap is None:
+            self._indexReferenceSets()
+        return self._referenceSetAccessionMap.get(accession, [])
+
+    def getReferenceByMd5Checksum(self, md5checksum):
+        """
+        Returns the first Reference in this repository with the specified
+        MD5 checksum, or raises a SequenceNotFoundException if there is
+        none.
+        """
+        for referenceSet in self.getReferenceSets():
+            references = referenceSet.getReferencesByMd5Checksum(md5checksum)
+            if len(references) > 0:
+                return references[0]
+        raise exceptions.SequenceNotFoundException(md5checksum)
+
     def getReferenceSetByName(self, name):
         """
         Returns the reference set with the specified name.
@@ -413,7 +478,7 @@ class SqlDataRepository(AbstractDataRepository):
         def __str__(self):
             return "{}.{}".format(self.major, self.minor)
 
-    version = SchemaVersion("2.1")
+    version = SchemaVersion("2.4")
     systemKeySchemaVersion = "schemaVersion"
     systemKeyCreationTimeStamp = "creationTimeStamp"
 
@@ -544,14 +609,14 @@ class SqlDataRepository(AbstractDataRepository):
                 max_variants = 10
                 max_annotations = 10
                 refMap = variantSet.getReferenceToDataUrlIndexMap()
-                for referenceName, (dataUrl, indexFile) in refMap.items():
+                for referenceName, shards in refMap.items():
                     variants = variantSet.getVariants(referenceName, 0, 2**31)
                     for i, variant in enumerate(variants):
                         if i == max_variants:
                             break
                     print(
                         "\t\tRead", i, "variants from reference",
-                        referenceName, "@", dataUrl)
+                        referenceName, "@", shards[0][2])
                 for annotationSet in variantSet.getVariantAnnotationSets():
                     print(
                         "\t\tVerifying VariantAnnotationSet",
@@ -911,6 +976,7 @@ class SqlDataRepository(AbstractDataRepository):
                 stats TEXT NOT NULL,
                 dataUrl TEXT NOT NULL,
                 indexFile TEXT NOT NULL,
+                dataFiles TEXT,
                 UNIQUE (datasetId, name),
                 FOREIGN KEY(datasetId) REFERENCES Dataset(id)
                     ON DELETE CASCADE,
@@ -926,13 +992,20 @@ class SqlDataRepository(AbstractDataRepository):
         sql = """
             INSERT INTO ReadGroupSet (
                 id, datasetId, referenceSetId, name, programs, stats,
-                dataUrl, indexFile)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?);
+                dataUrl, indexFile, dataFiles)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);
         """
         programsJson = json.dumps(
             [protocol.toJsonDict(program) for program in
              readGroupSet.getPrograms()])
         statsJson = json.dumps(protocol.toJsonDict(readGroupSet.getStats()))
+        # The dataUrl and indexFile columns hold the first file, and the
+        # dataFiles column all of them with the read groups they hold.
+        dataFilesJson = json.dumps([{
+            "dataUrl": dataUrl,
+            "indexFile": readGroupSet.getIndexFile(dataUrl),
+            "readGroupNames": readGroupSet.getReadGroupNames(dataUrl)}
+            for dataUrl in readGroupSet.getDataUrls()])
         cursor = self._dbConnection.cursor()
         try:
             cursor.execute(sql, (
@@ -941,7 +1014,7 @@ class SqlDataRepository(AbstractDataRepository):
                 readGroupSet.getReferenceSet().getId(),
                 readGroupSet.getLocalId(),
                 programsJson, statsJson, readGroupSet.getDataUrl(),
-                readGroupSet.getIndexFile()))
+                readGroupSet.getIndexFile(), dataFilesJson))
         except sqlite3.IntegrityError:
             raise exceptions.DuplicateNameException(
                 readGroupSet.getLocalId(),
@@ -1089,6 +1162,7 @@ class SqlDataRepository(AbstractDataRepository):
                 updated TEXT,
                 metadata TEXT,
                 dataUrlIndexMap TEXT NOT NULL,
+                callSetPartitions TEXT,
                 UNIQUE (datasetID, name),
                 FOREIGN KEY(datasetId) REFERENCES Dataset(id)
                     ON DELETE CASCADE,
@@ -1104,8 +1178,8 @@ class SqlDataRepository(AbstractDataRepository):
         sql = """
             INSERT INTO VariantSet (
                 id, datasetId, referenceSetId, name, created, updated,
-                metadata, dataUrlIndexMap)
-            VALUES (?, ?, ?, ?, datetime('now'), datetime('now'), ?, ?);
+                metadata, dataUrlIndexMap, callSetPartitions)
+            VALUES (?, ?, ?, ?, datetime('now'), datetime('now'), ?, ?, ?);
         """
         cursor = self._dbConnection.cursor()
         # We cheat a little here with the VariantSetMetadata, and encode these
@@ -1115,11 +1189,12 @@ class SqlDataRepository(AbstractDataRepository):
             [protocol.toJsonDict(metadata) for metadata in
              variantSet.getMetadata()])
         urlMapJson = json.dumps(variantSet.getReferenceToDataUrlIndexMap())
+        partitionsJson = json.dumps(variantSet.getCallSetPartitions())
         try:
             cursor.execute(sql, (
                 variantSet.getId(), variantSet.getParentContainer().getId(),
                 variantSet.getReferenceSet().getId(), variantSet.getLocalId(),
-                metadataJson, urlMapJson))
+                metadataJson, urlMapJson, partitionsJson))
         except sqlite3.IntegrityError:
             raise exceptions.DuplicateNameException(
                 variantSet.getLocalId(),
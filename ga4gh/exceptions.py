@@ -117,6 +117,33 @@ class BadRequestIntegerException(BadRequestException):
                 attrName, intString)
 
 
+class BadRequestFloatException(BadRequestException):
+    def __init__(self, attrName, floatString):
+        self.message = \
+            "{} argument '{}' could not be parsed as a number".format(
+                attrName, floatString)
+
+
+class BasesBatchTooLargeException(BadRequestException):
+    def __init__(self, length, maxLength):
+        self.message = (
+            "Batch of {} bases exceeds the maximum of {} bases".format(
+                length, maxLength))
+
+
+class BadCoverageBinCountException(BadRequestException):
+    def __init__(self, numBins, maxNumBins):
+        self.message = (
+            "Number of coverage bins '{}' is not between 1 and {}".format(
+                numBins, maxNumBins))
+
+
+class BadRequestExtensionException(BadRequestException):
+    def __init__(self, attrName, value):
+        self.message = "Request argument {} '{}' is invalid".format(
+            attrName, value)
+
+
 class BadPageSizeException(BadRequestException):
     def __init__(self, pageSize):
         self.message = "Request page size '{}' is invalid".format(pageSize)
@@ -257,6 +284,12 @@ class ReadGroupNotFoundException(ObjectNotFoundException):
         self.message = "readGroupId '{}' not found".format(readGroupId)
 
 
+class ReadAlignmentNotFoundException(ObjectNotFoundException):
+    def __init__(self, readAlignmentId):
+        self.message = "readAlignmentId '{}' not found".format(
+            readAlignmentId)
+
+
 class ReferenceSetNotFoundException(ObjectNotFoundException):
     def __init__(self, referenceSetId):
         self.message = "referenceSetId '{}' not found".format(referenceSetId)
@@ -267,6 +300,12 @@ class ReferenceNotFoundException(ObjectNotFoundException):
         self.message = "referenceId '{}' not found".format(referenceId)
 
 
+class SequenceNotFoundException(ObjectNotFoundException):
+    def __init__(self, checksum):
+        self.message = "No sequence with checksum '{}' found".format(
+            checksum)
+
+
 class OntologyNotFoundException(ObjectNotFoundException):
     def __init__(self, ontologyId):
         self.message = "ontologyId '{}' not found".format(ontologyId)
@@ -303,6 +342,17 @@ class ReferenceRangeErrorException(RangeErrorException):
                 start, end, referenceId))
 
 
+class ByteRangeErrorException(RangeErrorException):
+    """
+    Exception raised when the HTTP Range requested by the client is
+    outside of the resource.
+    """
+    def __init__(self, byteRange, length):
+        self.message = (
+            "Range '{}' not satisfiable for a resource of {} bytes".format(
+                byteRange, length))
+
+
 class MethodNotAllowedException(RuntimeException):
     httpStatus = 405
     message = "Method not allowed"
@@ -563,13 +613,14 @@ class NotIndexedException(MalformedException):
 class OverlappingVcfException(MalformedException):
     """
     Exception thrown when two VCF files within a VariantSet directory
-    contain records for the same contig.
+    contain records for overlapping ranges of the same contig.
     """
     def __init__(self, fileName, contig):
         self.message = (
             "VCF file '{}' contains records for contig '{}'. Other files"
-            " in this VariantSet have records for this contig, and overlapping"
-            " VCFs are not permitted.".format(fileName, contig))
+            " in this VariantSet have records in the same range of this"
+            " contig, and overlapping VCFs are not permitted.".format(
+                fileName, contig))
 
 
 class InconsistentMetaDataException(MalformedException):
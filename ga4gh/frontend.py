@@ -8,10 +8,15 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import os
+import atexit
 import datetime
+import json
 import socket
+import threading
 import urlparse
 import functools
+import zlib
+import multiprocessing.pool
 
 import flask
 import flask.ext.cors as cors
@@ -25,6 +30,7 @@ import requests
 import ga4gh
 import ga4gh.backend as backend
 import ga4gh.datamodel as datamodel
+import ga4gh.datamodel.reads as reads
 import ga4gh.protocol as protocol
 import ga4gh.exceptions as exceptions
 import ga4gh.datarepo as datarepo
@@ -89,6 +95,14 @@ class ServerStatus(object):
         ]
         return [(k, app.config[k]) for k in keys]
 
+    def getFileHandleCacheMetrics(self):
+        """
+        Returns a list of (handleType, metrics) tuples describing the use
+        of the file handle cache for each type of file.
+        """
+        metrics = datamodel.fileHandleCache.getMetrics()
+        return sorted(metrics.items(), key=lambda item: str(item[0]))
+
     def getPreciseUptime(self):
         """
         Returns the server precisely.
@@ -184,6 +198,145 @@ class ServerStatus(object):
             datasetId).getRnaQuantificationSets()
 
 
+class DataFileWarmUp(object):
+    """
+    Preloads the file handles of data files into the file handle cache
+    in a pool of background threads, so that the first requests touching
+    each file do not pay for opening it and loading its index. The files
+    are the ones listed explicitly, followed by the most used files
+    according to the recorded access counts. The preloaded handles are
+    idle handles in the cache, which any request thread can check out.
+
+    Neither the warm up threads nor the cached handles survive a fork, so
+    in a prefork server the warm up is started again in each worker
+    process by restartAfterFork, on its first request.
+    """
+    def __init__(
+            self, dataRepository, dataFilePaths=None, numDataFiles=0,
+            accessCounts=None, numThreads=4):
+        if dataFilePaths is None:
+            dataFilePaths = []
+        if accessCounts is None:
+            accessCounts = {}
+        self._numThreads = numThreads
+        self._dataFiles = []
+        dataFiles = dataRepository.getDataFiles()
+        filePaths = list(dataFilePaths) + sorted(
+            accessCounts.keys(), key=lambda path: -accessCounts[path]
+            )[:numDataFiles]
+        selected = set()
+        for filePath in filePaths:
+            for dataFile, datamodelObject in dataFiles:
+                if (datamodel.getDataFilePath(dataFile) == filePath and
+                        dataFile not in selected):
+                    selected.add(dataFile)
+                    self._dataFiles.append((dataFile, datamodelObject))
+        self._pid = None
+
+    def start(self):
+        """
+        Starts warming up the data files in the background.
+        """
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._numWarmed = 0
+        self._failedFiles = []
+        self._finished = threading.Event()
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def restartAfterFork(self):
+        """
+        Starts warming up the data files again if this process was forked
+        from the one the warm up was started in.
+        """
+        if self._pid is not None and self._pid != os.getpid():
+            self.start()
+
+    def _run(self):
+        pool = multiprocessing.pool.ThreadPool(self._numThreads)
+        try:
+            pool.map(self._warmUp, self._dataFiles)
+        finally:
+            pool.close()
+            self._finished.set()
+
+    def _warmUp(self, dataFileObjectPair):
+        dataFile, datamodelObject = dataFileObjectPair
+        try:
+            datamodelObject.preloadFileHandle(dataFile)
+        except Exception:
+            with self._lock:
+                self._failedFiles.append(datamodel.getDataFilePath(dataFile))
+        with self._lock:
+            self._numWarmed += 1
+
+    def isReady(self):
+        """
+        Returns True once all the data files have been warmed up.
+        """
+        return self._finished.is_set()
+
+    def waitUntilReady(self, timeout=None):
+        """
+        Blocks until all the data files have been warmed up, or the
+        specified number of seconds have passed.
+        """
+        self._finished.wait(timeout)
+
+    def getProgress(self):
+        """
+        Returns a dictionary describing the progress of the warm up.
+        """
+        with self._lock:
+            return {
+                "ready": self.isReady(),
+                "filesWarmed": self._numWarmed,
+                "filesTotal": len(self._dataFiles),
+                "filesFailed": list(self._failedFiles),
+            }
+
+
+def loadAccessCounts(statisticsFile):
+    """
+    Returns the data file access counts recorded in the specified file,
+    or an empty dictionary if it does not exist.
+    """
+    if not os.path.exists(statisticsFile):
+        return {}
+    with open(statisticsFile) as statisticsFileHandle:
+        return json.load(statisticsFileHandle)
+
+
+def saveAccessCounts(statisticsFile):
+    """
+    Adds the access counts of the file handle cache to those recorded in
+    the specified file.
+    """
+    accessCounts = loadAccessCounts(statisticsFile)
+    for filePath, count in datamodel.fileHandleCache.getAccessCounts(
+            ).items():
+        accessCounts[filePath] = accessCounts.get(filePath, 0) + count
+    with open(statisticsFile, "w") as statisticsFileHandle:
+        json.dump(accessCounts, statisticsFileHandle)
+
+
+def _saveConfiguredAccessCounts():
+    """
+    Saves the access counts of the file handle cache to the statistics
+    file of the current configuration, if there is one.
+    """
+    statisticsFile = app.config.get("FILE_ACCESS_STATISTICS_FILE")
+    if statisticsFile is not None:
+        saveAccessCounts(statisticsFile)
+
+
+# Whether _saveConfiguredAccessCounts is registered to run at exit, which
+# is done once however many times the app is configured
+_accessCountsSaverRegistered = False
+
+
 def reset():
     """
     Resets the flask app; used in testing
@@ -199,6 +352,7 @@ def configure(configFile=None, baseConfig="ProductionConfig",
     TODO Document this critical function! What does it do? What does
     it assume?
     """
+    global _accessCountsSaverRegistered
     file_handler = StreamHandler()
     file_handler.setLevel(logging.WARNING)
     app.logger.addHandler(file_handler)
@@ -212,6 +366,11 @@ def configure(configFile=None, baseConfig="ProductionConfig",
     # Setup file handle cache max size
     datamodel.fileHandleCache.setMaxCacheSize(
         app.config["FILE_HANDLE_CACHE_MAX_SIZE"])
+    for handleType, size in app.config[
+            "FILE_HANDLE_CACHE_MAX_SIZES"].items():
+        datamodel.fileHandleCache.setMaxCacheSize(size, handleType)
+    reads.cramSliceCache.setMaxCacheSize(
+        app.config["CRAM_SLICE_CACHE_MAX_SIZE"])
     # Setup CORS
     cors.CORS(app, allow_headers='Content-Type')
     app.serverStatus = ServerStatus()
@@ -264,6 +423,22 @@ def configure(configFile=None, baseConfig="ProductionConfig",
     theBackend.setDefaultPageSize(app.config["DEFAULT_PAGE_SIZE"])
     theBackend.setMaxResponseLength(app.config["MAX_RESPONSE_LENGTH"])
     app.backend = theBackend
+    # Warm up the most used data files
+    app.warmUp = None
+    statisticsFile = app.config["FILE_ACCESS_STATISTICS_FILE"]
+    accessCounts = {}
+    if statisticsFile is not None:
+        accessCounts = loadAccessCounts(statisticsFile)
+        if not _accessCountsSaverRegistered:
+            atexit.register(_saveConfiguredAccessCounts)
+            _accessCountsSaverRegistered = True
+    if (len(app.config["WARM_UP_DATA_FILES"]) > 0 or
+            app.config["WARM_UP_NUM_DATA_FILES"] > 0):
+        app.warmUp = DataFileWarmUp(
+            dataRepository, app.config["WARM_UP_DATA_FILES"],
+            app.config["WARM_UP_NUM_DATA_FILES"], accessCounts,
+            app.config["WARM_UP_NUM_THREADS"])
+        app.warmUp.start()
     app.secret_key = os.urandom(SECRET_KEY_LENGTH)
     app.oidcClient = None
     app.tokenMap = None
@@ -319,6 +494,47 @@ def getFlaskResponse(responseString, httpStatus=200):
     return flask.Response(responseString, status=httpStatus, mimetype=MIMETYPE)
 
 
+def gzipChunks(chunks):
+    """
+    Yields the gzip compressed stream of the specified chunks of data.
+    """
+    compressor = zlib.compressobj(
+        zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if len(compressed) > 0:
+            yield compressed
+    yield compressor.flush()
+
+
+def streamBases(reference, start, end, flaskRequest):
+    """
+    Returns a streaming plain text response with the bases of the
+    specified region of the specified reference. A byte Range header
+    selects a part of the region, and the response is gzip compressed if
+    the client accepts it and no Range is given.
+    """
+    headers = {"Accept-Ranges": "bytes", "Vary": "Accept-Encoding"}
+    status = 200
+    byteRange = flaskRequest.range
+    if byteRange is not None:
+        rangeForLength = byteRange.range_for_length(end - start)
+        if rangeForLength is None:
+            raise exceptions.ByteRangeErrorException(
+                byteRange.to_header(), end - start)
+        contentRange = byteRange.make_content_range(end - start)
+        headers["Content-Range"] = contentRange.to_header()
+        start, end = start + rangeForLength[0], start + rangeForLength[1]
+        status = 206
+    chunks = app.backend.iterReferenceBases(reference, start, end)
+    if byteRange is None and "gzip" in flaskRequest.accept_encodings:
+        headers["Content-Encoding"] = "gzip"
+        chunks = gzipChunks(chunks)
+    return flask.Response(
+        flask.stream_with_context(chunks), status=status, headers=headers,
+        mimetype="text/plain")
+
+
 def handleHttpPost(request, endpoint):
     """
     Handles the specified HTTP POST request, which maps to the specified
@@ -395,6 +611,17 @@ def startLogin():
     return flask.redirect(result.url)
 
 
+@app.before_request
+def restartWarmUpAfterFork():
+    """
+    Restarts the warm up of the data files in each worker process forked
+    by a prefork server from the process the app was configured in.
+    """
+    warmUp = getattr(app, "warmUp", None)
+    if warmUp is not None:
+        warmUp.restartAfterFork()
+
+
 @app.before_request
 def checkAuthentication():
     """
@@ -494,6 +721,20 @@ def index():
     return flask.render_template('index.html', info=app.serverStatus)
 
 
+@app.route('/ready')
+def ready():
+    """
+    Reports the progress of the warm up of the data files, with a 503
+    status until it is complete.
+    """
+    progress = {"ready": True}
+    if app.warmUp is not None:
+        progress = app.warmUp.getProgress()
+    httpStatus = 200 if progress["ready"] else 503
+    return flask.Response(
+        json.dumps(progress), status=httpStatus, mimetype="application/json")
+
+
 @app.route('/favicon.ico')
 @app.route('/robots.txt')
 def robots():
@@ -519,6 +760,26 @@ def listReferenceBases(id):
         id, flask.request, app.backend.runListReferenceBases)
 
 
+@DisplayedRoute('/referencebases/batch', postMethod=True)
+def listReferenceBasesBatch():
+    return handleFlaskPostRequest(
+        flask.request, app.backend.runListReferenceBasesBatch)
+
+
+@DisplayedRoute('/references/<id>/rawbases')
+def streamReferenceBases(id):
+    reference, start, end = app.backend.getReferenceRegion(
+        id, flask.request.args)
+    return streamBases(reference, start, end, flask.request)
+
+
+@DisplayedRoute('/sequences/<checksum>')
+def streamSequence(checksum):
+    reference, start, end = app.backend.getSequenceRegion(
+        checksum, flask.request.args)
+    return streamBases(reference, start, end, flask.request)
+
+
 @DisplayedRoute('/callsets/search', postMethod=True)
 def searchCallSets():
     return handleFlaskPostRequest(
@@ -667,6 +928,26 @@ def getReadGroup(id):
         id, flask.request, app.backend.runGetReadGroup)
 
 
+@DisplayedRoute('/readgroupsets/<id>/coverage')
+def getReadGroupSetCoverage(id):
+    return handleFlaskListRequest(
+        id, flask.request, app.backend.runGetReadGroupSetCoverage)
+
+
+@DisplayedRoute('/readgroups/<id>/coverage')
+def getReadGroupCoverage(id):
+    return handleFlaskListRequest(
+        id, flask.request, app.backend.runGetReadGroupCoverage)
+
+
+@DisplayedRoute(
+    '/reads/<no(search):id>',
+    pathDisplay='/reads/<id>')
+def getReadAlignments(id):
+    return handleFlaskGetRequest(
+        id, flask.request, app.backend.runGetReadAlignments)
+
+
 @DisplayedRoute(
     '/callsets/<no(search):id>',
     pathDisplay='/callsets/<id>')
@@ -691,6 +972,18 @@ def getFeature(id):
         id, flask.request, app.backend.runGetFeature)
 
 
+@DisplayedRoute('/features/<id>/subtree')
+def listFeatureSubtree(id):
+    return handleFlaskListRequest(
+        id, flask.request, app.backend.runListFeatureSubtree)
+
+
+@DisplayedRoute('/rnaquantificationsets/<id>/expressionmatrix')
+def getExpressionMatrix(id):
+    return handleFlaskListRequest(
+        id, flask.request, app.backend.runGetExpressionMatrix)
+
+
 @DisplayedRoute(
     '/rnaquantificationsets/<no(search):id>',
     pathDisplay='/rnaquantificationsets/<id>')
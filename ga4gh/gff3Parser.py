@@ -14,6 +14,8 @@ import re
 import gzip
 import bz2
 import collections
+import itertools
+import multiprocessing
 
 GFF3_HEADER = "##gff-version 3"
 
@@ -222,18 +224,43 @@ class Gff3Set(object):
             self._writeRec(fh, root)
 
 
+def _parseLines(args):
+    """
+    Parses a chunk of lines from a GFF3 file in a worker process.
+
+    :param args: tuple of the file name, the number of lines in the file
+        before the chunk, and the list of lines in the chunk.
+    :return: the list of Features parsed from the chunk
+    """
+    fileName, lineNumber, lines = args
+    parser = Gff3Parser(fileName)
+    parser.lineNumber = lineNumber
+    features = []
+    for line in lines:
+        parser.lineNumber += 1
+        feature = parser._parseLine(line)
+        if feature is not None:
+            features.append(feature)
+    return features
+
+
 class Gff3Parser(object):
     """
     Parses a GFF3 file into a Gff3Set. Performs basic validation,
     but does not fully test for conformance to GFF3 spec.
     """
+    chunkSize = 10000  # lines handed to a worker process at a time
 
-    def __init__(self, fileName):
+    def __init__(self, fileName, numProcesses=1):
         """
         :param str fileName: Name of GFF3 file to parse,
             compressed files (.gz or .bz2) will be automatically decompressed.
+        :param int numProcesses: Number of worker processes parsing
+            chunks of the file. Lines are read (and decompressed) by the
+            calling process.
         """
         self.fileName = fileName
+        self.numProcesses = numProcesses
         self.lineNumber = 0
 
     def _open(self):
@@ -284,9 +311,9 @@ class Gff3Parser(object):
 
     GFF3_NUM_COLS = 9
 
-    def _parseRecord(self, gff3Set, line):
+    def _parseRecord(self, line):
         """
-        Parse one record.
+        Parse one record, returning the corresponding Feature.
         """
         row = line.split("\t")
         if len(row) != self.GFF3_NUM_COLS:
@@ -294,14 +321,13 @@ class Gff3Parser(object):
                 "Wrong number of columns, expected {}, got {}".format(
                     self.GFF3_NUM_COLS, len(row)),
                 self.fileName, self.lineNumber)
-        feature = Feature(
+        return Feature(
             urllib.unquote(row[0]),
             urllib.unquote(row[1]),
             urllib.unquote(row[2]),
             int(row[3]), int(row[4]),
             row[5], row[6], row[7],
             self._parseAttrs(row[8]))
-        gff3Set.add(feature)
 
     # spaces or comment line
     IGNORED_LINE_RE = re.compile("(^[ ]*$)|(^[ ]*#.*$)")
@@ -317,23 +343,73 @@ class Gff3Parser(object):
                 "First line is not GFF3 header ({}), got: {}".format(
                     GFF3_HEADER, line), self.fileName, self.lineNumber)
 
-    def _parseLine(self, gff3Set, line):
+    def _parseLine(self, line):
+        """
+        Parse one line, returning the corresponding Feature or None
+        if the line does not hold a record.
+        """
         if self.lineNumber == 1:
             self._checkHeader(line)
         elif not self._isIgnoredLine(line):
-            self._parseRecord(gff3Set, line)
+            return self._parseRecord(line)
+        return None
 
-    def parse(self):
+    def iterFeatures(self):
         """
-        Run the parse and return the resulting Gff3Set object.
+        Yields the features in the file one line at a time. Features
+        are not linked to their parents and children, so that large
+        files can be processed without holding them in memory.
         """
+        if self.numProcesses > 1:
+            features = self._iterFeaturesInParallel()
+        else:
+            features = self._iterFeaturesSerially()
+        for feature in features:
+            yield feature
+
+    def _iterFeaturesSerially(self):
         fh = self._open()
         try:
-            gff3Set = Gff3Set(self.fileName)
             for line in fh:
                 self.lineNumber += 1
-                self._parseLine(gff3Set, line[0:-1])
+                feature = self._parseLine(line[0:-1])
+                if feature is not None:
+                    yield feature
         finally:
             fh.close()
+
+    def _iterFeaturesInParallel(self):
+        """
+        Hands chunks of lines to a pool of worker processes and yields
+        the parsed features in file order. Only a few chunks per worker
+        are in flight at any time, to keep memory use bounded.
+        """
+        pool = multiprocessing.Pool(self.numProcesses)
+        pending = collections.deque()
+        fh = self._open()
+        try:
+            lines = (line[0:-1] for line in fh)
+            while True:
+                chunk = list(itertools.islice(lines, self.chunkSize))
+                if len(chunk) > 0:
+                    args = (self.fileName, self.lineNumber, chunk)
+                    pending.append(pool.apply_async(_parseLines, (args,)))
+                    self.lineNumber += len(chunk)
+                if len(pending) == 0:
+                    break
+                if len(chunk) == 0 or len(pending) >= 2 * self.numProcesses:
+                    for feature in pending.popleft().get():
+                        yield feature
+        finally:
+            fh.close()
+            pool.terminate()
+
+    def parse(self):
+        """
+        Run the parse and return the resulting Gff3Set object.
+        """
+        gff3Set = Gff3Set(self.fileName)
+        for feature in self.iterFeatures():
+            gff3Set.add(feature)
         gff3Set.linkChildFeaturesToParents()
         return gff3Set
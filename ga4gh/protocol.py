@@ -147,6 +147,7 @@ class SearchResponseBuilder(object):
         self._protoObject = responseClass()
         self._valueListName = getValueListName(responseClass)
         self._bufferSize = self._protoObject.ByteSize()
+        self._extensionValues = {}
 
     def getPageSize(self):
         """
@@ -188,6 +189,20 @@ class SearchResponseBuilder(object):
         obj = attr.add()
         obj.CopyFrom(protocolElement)
 
+    def getValues(self):
+        """
+        Returns the value list of the response built so far.
+        """
+        return getattr(self._protoObject, self._valueListName)
+
+    def setExtensionValues(self, name, protocolElements):
+        """
+        Sets the list of protocolElements serialised in the response as
+        the attribute of the specified name, which is not part of the
+        response class.
+        """
+        self._extensionValues[name] = protocolElements
+
     def isFull(self):
         """
         Returns True if the response buffer is full, and False otherwise.
@@ -209,8 +224,14 @@ class SearchResponseBuilder(object):
         been built by this SearchResponseBuilder.
         """
         self._protoObject.next_page_token = pb.string(self._nextPageToken)
-        s = toJson(self._protoObject)
-        return s
+        if len(self._extensionValues) == 0:
+            return toJson(self._protoObject)
+        js = json_format._MessageToJsonObject(self._protoObject, True)
+        for name, protocolElements in self._extensionValues.items():
+            js[name] = [
+                json_format._MessageToJsonObject(protocolElement, True)
+                for protocolElement in protocolElements]
+        return json.dumps(js)
 
 
 def getProtocolClasses(superclass=message.Message):
@@ -0,0 +1,381 @@
+"""
+Bulk loading of RNA quantification files into the sqlite DB format
+served by ga4gh.datamodel.rna_quantification.
+"""
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import collections
+import multiprocessing
+import os
+import sqlite3
+
+import ga4gh.exceptions as exceptions
+
+
+# feature_set_ids is a comma separated list
+_rnaQuantificationTableSQL = '''CREATE TABLE RnaQuantification (
+                       id text,
+                       feature_set_ids text,
+                       description text,
+                       name text,
+                       read_group_ids text,
+                       programs text)'''
+
+_expressionTableSQL = '''CREATE TABLE Expression (
+                       id text,
+                       rna_quantification_id text,
+                       name text,
+                       feature_id text,
+                       expression real,
+                       is_normalized boolean,
+                       raw_read_count real,
+                       score real,
+                       units integer,
+                       conf_low real,
+                       conf_hi real)'''
+
+_indexSQL = [
+    "CREATE INDEX Expression_quantification_expression "
+    "ON Expression (rna_quantification_id, expression)",
+    "CREATE INDEX Expression_id ON Expression (id)",
+]
+
+
+def createTables(cursor):
+    """
+    Creates the RnaQuantification and Expression tables.
+    """
+    cursor.execute(_rnaQuantificationTableSQL)
+    cursor.execute(_expressionTableSQL)
+
+
+def createIndices(cursor):
+    """
+    Indexes the Expression table for the server's queries. Expression
+    levels are searched and paged through in order of expression within
+    a quantification, and fetched individually by id.
+    """
+    for sql in _indexSQL:
+        cursor.execute(sql)
+
+
+class AbstractQuantificationParser(object):
+    """
+    Base class for the parsers of the tab delimited output files of the
+    supported quantification programs. Subclasses give the columns
+    holding each of the expression level fields.
+    """
+    isNormalized = True
+    units = 0  # EXPRESSION_UNIT_UNSPECIFIED
+    expressionLevelCol = None
+    idCol = None
+    nameCol = None
+    featureCol = None
+    countCol = None
+    confColLow = None
+    confColHi = None
+
+    def __init__(self, featureType="gene"):
+        self._featureType = featureType
+
+    def parse(self, rnaQuantificationId, quantFile):
+        """
+        Yields a tuple of Expression table values for each row of the
+        specified quantification file. The feature_id value is the name
+        of the feature, which is resolved to a feature ID by the loader.
+        """
+        quantFile.readline()  # skip header
+        return self.parseLines(rnaQuantificationId, quantFile)
+
+    def parseLines(self, rnaQuantificationId, lines):
+        """
+        Yields a tuple of Expression table values for each of the specified
+        lines of a quantification file, which must not include the header.
+        """
+        for line in lines:
+            fields = line.strip().split("\t")
+            rawCount = 0.0
+            if self.countCol is not None:
+                rawCount = float(fields[self.countCol])
+            confidenceLow = 0.0
+            confidenceHi = 0.0
+            score = 0.0
+            if self.confColLow is not None and self.confColHi is not None:
+                confidenceLow = float(fields[self.confColLow])
+                confidenceHi = float(fields[self.confColHi])
+                score = (confidenceLow + confidenceHi) / 2
+            yield (
+                fields[self.idCol], rnaQuantificationId,
+                fields[self.nameCol], fields[self.featureCol],
+                float(fields[self.expressionLevelCol]), self.isNormalized,
+                rawCount, score, self.units, confidenceLow, confidenceHi)
+
+
+class CufflinksParser(AbstractQuantificationParser):
+    """
+    Parser for the isoform and gene tracking files written by Cufflinks.
+
+    cufflinks header:
+        tracking_id    class_code    nearest_ref_id    gene_id
+        gene_short_name    tss_id    locus    length    coverage    FPKM
+        FPKM_conf_lo    FPKM_conf_hi    FPKM_status
+    """
+    units = 1  # FPKM
+    expressionLevelCol = 9
+    idCol = 0
+    nameCol = 4
+    featureCol = 3
+    confColLow = 10
+    confColHi = 11
+
+
+class RsemParser(AbstractQuantificationParser):
+    """
+    Parser for the gene and transcript results files written by RSEM.
+    The confidence interval columns differ between the two, so the
+    feature type of the file must be given.
+
+    RSEM header (gene quantification):
+        gene_id    transcript_id(s)    length    effective_length
+        expected_count    TPM    FPKM    posterior_mean_count
+        posterior_standard_deviation_of_count    pme_TPM    pme_FPKM
+        TPM_ci_lower_bound    TPM_ci_upper_bound    FPKM_ci_lower_bound
+        FPKM_ci_upper_bound
+
+    RSEM header (transcript quantification):
+        transcript_id    gene_id    length    effective_length
+        expected_count    TPM    FPKM    IsoPct    posterior_mean_count
+        posterior_standard_deviation_of_count    pme_TPM    pme_FPKM
+        IsoPct_from_pme_TPM    TPM_ci_lower_bound    TPM_ci_upper_bound
+        FPKM_ci_lower_bound    FPKM_ci_upper_bound
+    """
+    units = 2  # TPM
+    expressionLevelCol = 5
+    idCol = 0
+    nameCol = 0
+    countCol = 4
+
+    def __init__(self, featureType="gene"):
+        super(RsemParser, self).__init__(featureType)
+        if featureType == "transcript":
+            self.featureCol = 1
+            self.confColLow = 13
+            self.confColHi = 14
+        else:
+            self.featureCol = 0
+            self.confColLow = 11
+            self.confColHi = 12
+
+
+class KallistoParser(AbstractQuantificationParser):
+    """
+    Parser for the abundance files written by kallisto.
+
+    kallisto header:
+        target_id    length    eff_length    est_counts    tpm
+    """
+    units = 2  # TPM
+    expressionLevelCol = 4
+    idCol = 0
+    nameCol = 0
+    featureCol = 0
+    countCol = 3
+
+
+_parserClasses = {
+    "cufflinks": CufflinksParser,
+    "rsem": RsemParser,
+    "kallisto": KallistoParser,
+}
+
+
+def getParser(fileType, featureType="gene"):
+    """
+    Returns a parser for quantification files of the specified type.
+    """
+    if fileType not in _parserClasses:
+        raise exceptions.RepoManagerException(
+            "Unknown RNA file type: {}".format(fileType))
+    return _parserClasses[fileType](featureType)
+
+
+# The approximate size in bytes of the chunks quantification files are
+# parsed in, which bounds the number of rows held in memory per chunk.
+_chunkSize = 4 * 1024 * 1024
+
+
+def _getFileChunks(fileName):
+    """
+    Yields (start, end) byte offsets splitting the lines of the specified
+    quantification file after its header into chunks of about _chunkSize
+    bytes.
+    """
+    with open(fileName, "rb") as quantFile:
+        quantFile.readline()  # skip header
+        start = quantFile.tell()
+        fileSize = os.fstat(quantFile.fileno()).st_size
+        while start < fileSize:
+            quantFile.seek(min(start + _chunkSize, fileSize) - 1)
+            quantFile.readline()
+            end = quantFile.tell()
+            yield start, end
+            start = end
+
+
+def _parseQuantificationChunk(args):
+    """
+    Parses the lines in the specified byte range of a quantification file
+    into a list of Expression table values. This is a module level
+    function so that it can be handed to worker processes.
+    """
+    rnaQuantificationId, fileName, fileType, featureType, start, end = args
+    parser = getParser(fileType, featureType)
+    with open(fileName, "rb") as quantFile:
+        quantFile.seek(start)
+        lines = quantFile.read(end - start).splitlines()
+    return list(parser.parseLines(rnaQuantificationId, lines))
+
+
+class RnaQuantification(object):
+    """
+    A quantification file to be loaded, with the values of its row in the
+    RnaQuantification table.
+    """
+    def __init__(
+            self, name, fileName, fileType, featureSet,
+            readGroupIds="", description="", programs=""):
+        self.name = name
+        self.fileName = fileName
+        self.fileType = fileType
+        self.featureSet = featureSet
+        self.readGroupIds = readGroupIds
+        self.description = description
+        self.programs = programs
+
+
+def readControlFile(dataset, dataFolder, controlFile):
+    """
+    Returns the list of RnaQuantifications listed in the specified control
+    file, resolving the feature sets and read group sets named in it within
+    the specified dataset. The control file is tab delimited, with a header
+    line and the columns:
+
+    rna_quant_name    filename        type    feature_set_name
+    read_group_set_name     description    programs
+    """
+    rnaQuantifications = []
+    with open(os.path.join(dataFolder, controlFile), "r") as controlFileHandle:
+        controlFileHandle.readline()  # skip header
+        for line in controlFileHandle:
+            fields = [field.strip() for field in line.split("\t")]
+            featureSet = dataset.getFeatureSetByName(fields[3])
+            readGroupSet = dataset.getReadGroupSetByName(fields[4])
+            readGroupIds = ",".join(
+                readGroup.getId() for readGroup in
+                readGroupSet.getReadGroups())
+            rnaQuantifications.append(RnaQuantification(
+                fields[0], os.path.join(dataFolder, fields[1]), fields[2],
+                featureSet, readGroupIds, fields[5], fields[6]))
+    return rnaQuantifications
+
+
+class RnaQuantificationLoader(object):
+    """
+    Loads many quantification files into a new RNA quantification DB.
+    Files are split into chunks of lines which are parsed in a pool of
+    worker processes, and the rows of each chunk are inserted with
+    executemany in a single transaction with synchronous writes turned
+    off. Only a few chunks are parsed ahead of the inserts, so memory use
+    does not grow with the size of the files. The Expression table is
+    indexed once everything is loaded, which is much faster than
+    maintaining the indexes through the inserts.
+    """
+    def __init__(self, sqlFilename, featureType="gene", numProcesses=1):
+        self._sqlFilename = sqlFilename
+        self._featureType = featureType
+        self._numProcesses = numProcesses
+        self._featureIds = {}
+
+    def _getFeatureId(self, featureSet, featureName):
+        """
+        Returns the ID of the feature with the specified name in the
+        specified feature set, or "" if there is none. Each distinct name
+        is looked up only once.
+        """
+        key = (featureSet.getId(), featureName)
+        if key not in self._featureIds:
+            featureId = ""
+            for feature, _ in featureSet.getFeatures(name=featureName):
+                featureId = feature.id
+            self._featureIds[key] = featureId
+        return self._featureIds[key]
+
+    def _getChunks(self, rnaQuantifications):
+        """
+        Yields (rnaQuantification, args) pairs for each chunk of the files
+        of the specified RnaQuantifications, where args are the arguments
+        of _parseQuantificationChunk.
+        """
+        for rnaQuant in rnaQuantifications:
+            for start, end in _getFileChunks(rnaQuant.fileName):
+                yield rnaQuant, (
+                    rnaQuant.name, rnaQuant.fileName, rnaQuant.fileType,
+                    self._featureType, start, end)
+
+    def _parseFiles(self, rnaQuantifications):
+        """
+        Yields (rnaQuantification, rows) pairs for each chunk of the files
+        of the specified RnaQuantifications, in order, where rows is the
+        list of Expression table values parsed from the chunk.
+        """
+        chunks = self._getChunks(rnaQuantifications)
+        if self._numProcesses <= 1:
+            for rnaQuant, args in chunks:
+                yield rnaQuant, _parseQuantificationChunk(args)
+            return
+        pool = multiprocessing.Pool(self._numProcesses)
+        try:
+            pending = collections.deque()
+            for rnaQuant, args in chunks:
+                pending.append((rnaQuant, pool.apply_async(
+                    _parseQuantificationChunk, (args,))))
+                if len(pending) > 2 * self._numProcesses:
+                    rnaQuant, result = pending.popleft()
+                    yield rnaQuant, result.get()
+            while len(pending) > 0:
+                rnaQuant, result = pending.popleft()
+                yield rnaQuant, result.get()
+        finally:
+            pool.terminate()
+
+    def load(self, rnaQuantifications):
+        """
+        Writes the specified RnaQuantifications and their expression levels
+        to the DB, which must not already exist.
+        """
+        if os.path.exists(self._sqlFilename):
+            raise exceptions.RepoManagerException(
+                "File '{}' already exists".format(self._sqlFilename))
+        dbConn = sqlite3.connect(self._sqlFilename)
+        try:
+            dbConn.execute("PRAGMA synchronous = OFF")
+            cursor = dbConn.cursor()
+            createTables(cursor)
+            cursor.executemany(
+                "INSERT INTO RnaQuantification VALUES (?,?,?,?,?,?)", [
+                    (rnaQuant.name, rnaQuant.featureSet.getId(),
+                     rnaQuant.description, rnaQuant.name,
+                     rnaQuant.readGroupIds, rnaQuant.programs)
+                    for rnaQuant in rnaQuantifications])
+            for rnaQuant, rows in self._parseFiles(rnaQuantifications):
+                featureSet = rnaQuant.featureSet
+                cursor.executemany(
+                    "INSERT INTO Expression VALUES (?,?,?,?,?,?,?,?,?,?,?)",
+                    (row[:3] + (self._getFeatureId(featureSet, row[3]),) +
+                     row[4:] for row in rows))
+            createIndices(cursor)
+            dbConn.commit()
+        finally:
+            dbConn.close()
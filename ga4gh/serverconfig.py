@@ -34,7 +34,24 @@ class BaseConfig(object):
     SIMULATED_BACKEND_NUM_RNA_QUANTIFICATION_SETS = 2
     SIMULATED_BACKEND_NUM_EXPRESSION_LEVELS_PER_RNA_QUANT_SET = 2
 
+    # Maximum number of idle file handles kept open for reuse by requests
     FILE_HANDLE_CACHE_MAX_SIZE = 50
+    # Maximum numbers of idle file handles for specific types of file
+    # ("reads", "variants" or "references"), overriding the above
+    FILE_HANDLE_CACHE_MAX_SIZES = {}
+
+    # Data files to open at startup, before /ready reports the server as
+    # ready: the paths listed, followed by the given number of the most
+    # used files recorded in FILE_ACCESS_STATISTICS_FILE
+    WARM_UP_DATA_FILES = []
+    WARM_UP_NUM_DATA_FILES = 0
+    WARM_UP_NUM_THREADS = 4
+    # JSON file in which the number of accesses to each data file is
+    # accumulated when the server exits
+    FILE_ACCESS_STATISTICS_FILE = None
+
+    # Number of slices of decoded CRAM records cached in each process
+    CRAM_SLICE_CACHE_MAX_SIZE = 32
 
     LANDING_MESSAGE_HTML = "landing_message.html"
 
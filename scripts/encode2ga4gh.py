@@ -173,6 +173,9 @@ def main(argv):
                     options.description, options.annotationId, subset,
                     options.readGroupId)
     rnaDB.batchAddRNAQuantification()
+    # Indexed once all the expression levels are loaded, for the server's
+    # paging through them in order of expression
+    rnaDB.createIndices()
     log("DONE")
 
 
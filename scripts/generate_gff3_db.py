@@ -19,13 +19,15 @@ import sqlite3
 import utils
 utils.ga4ghImportGlue()
 import ga4gh.gff3Parser as gff3  # NOQA
+import ga4gh.datamodel.sequenceAnnotations as sequenceAnnotations  # NOQA
 
 # TODO: Shift this to use the Gff3DbBackend class.
 
 # The columns of the FEATURE table correspond to the columns of a GFF3,
 # with three additional columns prepended representing the ID of this feature,
 # the ID of its parent (if any), and a whitespace separated array
-# of its child IDs.
+# of its child IDs. The trailing payload column holds the serialized
+# protocol.Feature that the server sends out for the row.
 
 _dbTableSQL = (
     "CREATE TABLE FEATURE( "
@@ -42,65 +44,117 @@ _dbTableSQL = (
     "name TEXT,"
     "gene_name TEXT,"
     "transcript_name TEXT,"
-    "attributes TEXT);")
+    "attributes TEXT,"
+    "payload BLOB);")
+
+# Trigram index over feature names and gene symbols, used by the server
+# to answer substring searches ('*RCA*') without scanning FEATURE.
+_ftsTableSQL = (
+    "CREATE VIRTUAL TABLE FEATURE_FTS USING fts5("
+    "name, gene_name, content='feature', content_rowid='id', "
+    "tokenize='trigram case_sensitive 1');")
 
 
 def _db_serialize(pyData):
     return json.dumps(pyData, separators=(',', ':'))
 
 
+# Staging tables for the first pass over the GFF3 file. RECORD holds
+# the columns of each feature that are known from its own line, and
+# PARENT_NAME the names listed in its Parent attribute. Both are resolved
+# into FEATURE rows by the second pass.
+_recordTableSQL = (
+    "CREATE TEMP TABLE RECORD( "
+    "id INTEGER PRIMARY KEY NOT NULL, "
+    "reference_name TEXT, "
+    "source TEXT, "
+    "type TEXT, "
+    "start INT, "
+    "end INT, "
+    "score REAL, "
+    "strand TEXT, "
+    "name TEXT,"
+    "gene_name TEXT,"
+    "transcript_name TEXT,"
+    "attributes TEXT);")
+
+_parentNameTableSQL = (
+    "CREATE TEMP TABLE PARENT_NAME( "
+    "child_id INTEGER NOT NULL, "
+    "parent_name TEXT NOT NULL);")
+
+# Resolves every (child, parent name) pair into (child, parent) ID pairs.
+# A discontinuous parent has several records sharing its name, all of
+# which are linked to the child.
+_linkTableSQL = (
+    "CREATE TEMP TABLE LINK AS "
+    "SELECT PARENT_NAME.child_id AS child_id, RECORD.id AS parent_id "
+    "FROM PARENT_NAME JOIN RECORD ON RECORD.name = PARENT_NAME.parent_name;")
+
+# Reads a batch of records back in ID order together with their links.
+# Only the first parent of a feature is kept.
+_linkedRecordsSQL = (
+    "SELECT RECORD.*, "
+    "(SELECT MIN(LINK.parent_id) FROM LINK "
+    "WHERE LINK.child_id = RECORD.id) AS parent_id, "
+    "(SELECT group_concat(child_id) FROM ("
+    "SELECT LINK.child_id FROM LINK WHERE LINK.parent_id = RECORD.id "
+    "ORDER BY LINK.child_id)) AS child_ids "
+    "FROM RECORD WHERE RECORD.id > ? ORDER BY RECORD.id LIMIT ?;")
+
+
 class Gff32Db(object):
     """
     Represents a unit of work for this script: Parse a GFF3 file
-    using an external GFF3 parser, and create a corresponding SQLite DB file
-    by iterating through the resulting parsed dictionary object
-    (gff3Data.byfeatureName).
+    using an external GFF3 parser, and create a corresponding SQLite DB file.
+    The GFF3 file is streamed through in two passes so that memory use
+    does not depend on its size. The first pass writes each record as it
+    is parsed into temporary tables, and the second links features to
+    their parents and children within SQLite before writing the FEATURE
+    table. Features are numbered in the order they appear in the file.
     """
-    def __init__(self, inputFile, outputFile):
+    def __init__(self, inputFile, outputFile, numProcesses=1):
         """
         :param inputFile: source GFF3 filename (can be a full path)
         :param outputFile: destination sqlite filename (ditto)
+        :param numProcesses: number of processes parsing the GFF3 file
         """
         self.gff3File = inputFile
         self.dbFile = outputFile
-        self.valueList = []
-        self.batchSize = 100
+        self.numProcesses = numProcesses
+        self.batchSize = 10000
         if os.path.exists(outputFile):
             print("DB output file already exists, please remove or rename.",
                   file=sys.stderr)
             exit()
 
-    def _batchInsertValues(self, values, dbcur, dbconn):
-        self.valueList.append(values)
-        if len(self.valueList) >= self.batchSize:
-            self._insertValues(dbcur, dbconn)
-
-    def _insertValues(self, dbcur, dbconn):
-        if len(self.valueList) > 0:
-            sql = "INSERT INTO Feature VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)"
-            dbcur.executemany(sql, self.valueList)
-            dbconn.commit()
-            self.valueList = []
-
-    def run(self):
-        gff3Data = gff3.Gff3Parser(self.gff3File).parse()
-        dbconn = sqlite3.connect(self.dbFile)
-        dbcur = dbconn.cursor()
-        dbcur.execute(_dbTableSQL)  # create table
-        dbcur.execute("PRAGMA journal_mode=WAL")
-        dbconn.commit()
+    def _batches(self, values):
+        """
+        Groups the specified iterable of values into lists of at most
+        batchSize, so that each can be written in one transaction.
+        """
+        batch = []
+        for value in values:
+            batch.append(value)
+            if len(batch) >= self.batchSize:
+                yield batch
+                batch = []
+        if len(batch) > 0:
+            yield batch
 
-        for i, featureName in enumerate(gff3Data.byFeatureName.keys()):
-            for feature in gff3Data.byFeatureName[featureName]:
-                # Ignores any parent IDs besides the first one.
-                parentIds = [parent.uniqueId for parent in feature.parents]
-                parentId = parentIds[0] if len(parentIds) > 0 else ''
-                # FIXME: No current code to ensure childIDs in correct order.
-                childIds = [child.uniqueId for child in feature.children]
-                values = (
-                    feature.uniqueId,
-                    parentId,
-                    _db_serialize(childIds),
+    def _insertRecords(self, dbconn):
+        """
+        First pass: writes the features in the GFF3 file to the RECORD
+        and PARENT_NAME tables, as they are parsed.
+        """
+        parser = gff3.Gff3Parser(self.gff3File, self.numProcesses)
+        features = enumerate(parser.iterFeatures(), 1)
+        for batch in self._batches(features):
+            records = []
+            parentNames = []
+            for featureId, feature in batch:
+                records.append((
+                    featureId,
                     feature.seqname,
                     feature.source,
                     feature.type,
@@ -111,12 +165,122 @@ class Gff32Db(object):
                     feature.featureName,
                     feature.attributes.get("gene_name", [None])[0],
                     feature.attributes.get("transcript_name", [None])[0],
-                    _db_serialize(feature.attributes))
-                self._batchInsertValues(values, dbcur, dbconn)
-        self._insertValues(dbcur, dbconn)
+                    _db_serialize(feature.attributes)))
+                for parentName in feature.attributes.get("Parent", []):
+                    parentNames.append((featureId, parentName))
+            dbconn.executemany(
+                "INSERT INTO RECORD VALUES (?,?,?,?,?,?,?,?,?,?,?,?)",
+                records)
+            dbconn.executemany(
+                "INSERT INTO PARENT_NAME VALUES (?,?)", parentNames)
+            dbconn.commit()
+
+    def _linkRecords(self, dbconn):
+        """
+        Resolves the parent names of all features into feature IDs.
+        """
+        dbconn.execute("CREATE INDEX temp.record_name on RECORD(name)")
+        missing = dbconn.execute(
+            "SELECT parent_name FROM PARENT_NAME WHERE parent_name NOT IN "
+            "(SELECT name FROM RECORD WHERE name IS NOT NULL) "
+            "LIMIT 1").fetchone()
+        if missing is not None:
+            raise gff3.GFF3Exception(
+                "Parent feature does not exist: {}".format(missing[0]),
+                self.gff3File)
+        dbconn.execute(_linkTableSQL)
+        dbconn.execute("CREATE INDEX temp.link_child on LINK(child_id)")
+        dbconn.execute("CREATE INDEX temp.link_parent on LINK(parent_id)")
+        dbconn.commit()
+
+    def _featureValues(self, row):
+        """
+        Returns the values of the FEATURE row for the specified row
+        of linked records.
+        """
+        parentId = row[b'parent_id']
+        if parentId is None:
+            parentId = ''
+        if row[b'child_ids'] is None:
+            childIds = []
+        else:
+            childIds = [int(i) for i in row[b'child_ids'].split(',')]
+        payload = sequenceAnnotations.featurePayloadForRecord({
+            'id': row[b'id'],
+            'parent_id': parentId,
+            'child_ids': childIds,
+            'reference_name': row[b'reference_name'],
+            'type': row[b'type'],
+            'start': row[b'start'],
+            'end': row[b'end'],
+            'strand': row[b'strand'],
+            'name': row[b'name'],
+            'attributes': json.loads(row[b'attributes'])})
+        return (
+            row[b'id'],
+            parentId,
+            _db_serialize(childIds),
+            row[b'reference_name'],
+            row[b'source'],
+            row[b'type'],
+            row[b'start'],
+            row[b'end'],
+            row[b'score'],
+            row[b'strand'],
+            row[b'name'],
+            row[b'gene_name'],
+            row[b'transcript_name'],
+            row[b'attributes'],
+            sqlite3.Binary(payload))
+
+    def _insertFeatures(self, dbconn):
+        """
+        Second pass: writes the linked records to the FEATURE table,
+        one batch of IDs at a time.
+        """
+        sql = "INSERT INTO Feature VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)"
+        lastId = 0
+        while True:
+            rows = dbconn.execute(
+                _linkedRecordsSQL, (lastId, self.batchSize)).fetchall()
+            if len(rows) == 0:
+                break
+            dbconn.executemany(sql, [self._featureValues(r) for r in rows])
+            dbconn.commit()
+            lastId = rows[-1][b'id']
+
+    def run(self):
+        dbconn = sqlite3.connect(self.dbFile)
+        dbconn.execute(_dbTableSQL)  # create table
+        dbconn.execute("PRAGMA journal_mode=WAL")
+        # The output is rebuilt from scratch if the build fails, so there
+        # is no need to wait for each batch to reach the disk.
+        dbconn.execute("PRAGMA synchronous=OFF")
+        dbconn.execute("PRAGMA temp_store=FILE")
+        dbconn.row_factory = sqlite3.Row
+        dbconn.execute(_recordTableSQL)
+        dbconn.execute(_parentNameTableSQL)
+        dbconn.commit()
+        self._insertRecords(dbconn)
+        self._linkRecords(dbconn)
+        self._insertFeatures(dbconn)
+        dbcur = dbconn.cursor()
         dbcur.execute((
             "create INDEX idx1 "
             "on feature(start, end, reference_name)"))
+        dbcur.execute("create INDEX idx2 on feature(name)")
+        dbcur.execute("create INDEX idx3 on feature(gene_name)")
+        dbcur.execute("create INDEX idx4 on feature(parent_id)")
+        try:
+            dbcur.execute(_ftsTableSQL)
+        except sqlite3.OperationalError:
+            utils.log(
+                "SQLite has no FTS5 trigram support, skipping the full "
+                "text index of feature names")
+        else:
+            dbcur.execute(
+                "INSERT INTO FEATURE_FTS(FEATURE_FTS) VALUES('rebuild')")
+        dbconn.commit()
         dbcur.execute("PRAGMA INDEX_LIST('feature')")
 
         dbcur.close()
@@ -135,9 +299,12 @@ def main():
         "--inputFile", "-i",
         help="Path to input GFF3 file.",
         default='.')
+    parser.add_argument(
+        "--numProcesses", "-p", type=int, default=1,
+        help="The number of processes parsing the GFF3 file.")
     parser.add_argument('--verbose', '-v', action='count', default=0)
     args = parser.parse_args()
-    g2d = Gff32Db(args.inputFile, args.outputFile)
+    g2d = Gff32Db(args.inputFile, args.outputFile, args.numProcesses)
     g2d.run()
 
 
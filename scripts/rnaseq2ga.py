@@ -5,7 +5,6 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
-import os
 import sqlite3
 import argparse
 
@@ -14,6 +13,8 @@ import utils
 utils.ga4ghImportGlue()
 
 import ga4gh.datarepo as datarepo  # NOQA
+import ga4gh.datamodel.rna_quantification as rna_quantification  # NOQA
+import ga4gh.rnaseqLoader as rnaseqLoader  # NOQA
 
 
 def data_repo(path):
@@ -41,26 +42,11 @@ class RNASqliteStore(object):
         self._expressionValueList = []
 
     def createTables(self, cursor):
-        # annotationIds is a comma separated list
-        cursor.execute('''CREATE TABLE RnaQuantification (
-                       id text,
-                       feature_set_ids text,
-                       description text,
-                       name text,
-                       read_group_ids text,
-                       programs text)''')
-        cursor.execute('''CREATE TABLE Expression (
-                       id text,
-                       rna_quantification_id text,
-                       name text,
-                       feature_id text,
-                       expression real,
-                       is_normalized boolean,
-                       raw_read_count real,
-                       score real,
-                       units integer,
-                       conf_low real,
-                       conf_hi real)''')
+        rnaseqLoader.createTables(cursor)
+
+    def createIndices(self):
+        rnaseqLoader.createIndices(self._cursor)
+        self._dbConn.commit()
 
     def addRNAQuantification(self, datafields):
         """
@@ -99,56 +85,28 @@ class RNASqliteStore(object):
 
 class AbstractWriter(object):
     """
-    Base class to use for the rna quantification writers
+    Base class to use for the rna quantification writers. The files are
+    parsed by the ga4gh.rnaseqLoader parser given by parserClass.
     """
+    parserClass = None
+
     def __init__(self, rnaDB, repoPath, featureType="gene"):
         self._db = rnaDB
-        self._isNormalized = None
-        self._units = 0  # EXPRESSION_UNIT_UNSPECIFIED
-        self._expressionLevelCol = None
-        self._idCol = None
-        self._nameCol = None
-        self._featureCol = None
-        self._countCol = None
-        self._confColLow = None
-        self._confColHi = None
         self._dataRepo = data_repo(repoPath)
-        self._featureType = featureType
+        self._parser = self.parserClass(featureType)
 
     def writeExpression(self, rnaQuantificationId, quantfile):
         """
         Reads the quantification results file and adds entries to the
         specified database.
         """
-        isNormalized = self._isNormalized
-        units = self._units
-        quantfile.readline()  # skip header
-        for expression in quantfile:
-            fields = expression.strip().split("\t")
-            expressionLevel = fields[self._expressionLevelCol]
-            expressionId = fields[self._idCol]
-            name = fields[self._nameCol]
-            rawCount = 0.0
-            if self._countCol is not None:
-                rawCount = fields[self._countCol]
-            confidenceLow = 0.0
-            confidenceHi = 0.0
-            score = 0.0
-            if (self._confColLow is not None and self._confColHi is not None):
-                confidenceLow = float(fields[self._confColLow])
-                confidenceHi = float(fields[self._confColHi])
-                score = (confidenceLow + confidenceHi)/2
-
-            featureName = fields[self._featureCol]
-            dataset = self._dataRepo.getDatasets()[0]
-            featureSet = dataset.getFeatureSets()[0]
+        dataset = self._dataRepo.getDatasets()[0]
+        featureSet = dataset.getFeatureSets()[0]
+        for row in self._parser.parse(rnaQuantificationId, quantfile):
             featureId = ""
-            for feature in featureSet.getFeatures(name=featureName):
-                featureId = feature[0].id
-            datafields = (expressionId, rnaQuantificationId, name, featureId,
-                          expressionLevel, isNormalized,
-                          rawCount, score, units, confidenceLow, confidenceHi)
-            self._db.addExpression(datafields)
+            for feature, _ in featureSet.getFeatures(name=row[3]):
+                featureId = feature.id
+            self._db.addExpression(row[:3] + (featureId,) + row[4:])
         self._db.batchAddExpression()
 
 
@@ -156,78 +114,24 @@ class CufflinksWriter(AbstractWriter):
     """
     Class to parse and write expression data from an input file generated by
     Cufflinks.
-
-    cufflinks header:
-        tracking_id    class_code    nearest_ref_id    gene_id
-        gene_short_name    tss_id    locus    length    coverage    FPKM
-        FPKM_conf_lo    FPKM_conf_hi    FPKM_status
     """
-    def __init__(self, rnaDB, repoPath, featureType):
-        super(CufflinksWriter, self).__init__(rnaDB, repoPath, featureType)
-        self._isNormalized = True
-        self._units = 1  # FPKM
-        self._expressionLevelCol = 9
-        self._idCol = 0
-        self._nameCol = 4
-        self._featureCol = 3
-        self._confColLow = 10
-        self._confColHi = 11
+    parserClass = rnaseqLoader.CufflinksParser
 
 
 class RsemWriter(AbstractWriter):
     """
     Class to parse and write expression data from an input file generated by
     RSEM.
-
-    RSEM header (gene quantification):
-    gene_id    transcript_id(s)    length    effective_length    expected_count
-    TPM    FPKM    posterior_mean_count
-    posterior_standard_deviation_of_count    pme_TPM    pme_FPKM
-    TPM_ci_lower_bound    TPM_ci_upper_bound    FPKM_ci_lower_bound
-    FPKM_ci_upper_bound
-
-    RSEM header (transcript quantification):
-    transcript_id    gene_id    length    effective_length    expected_count
-    TPM    FPKM    IsoPct    posterior_mean_count
-    posterior_standard_deviation_of_count    pme_TPM    pme_FPKM
-    IsoPct_from_pme_TPM    TPM_ci_lower_bound    TPM_ci_upper_bound
-    FPKM_ci_lower_bound    FPKM_ci_upper_bound
     """
-    def __init__(self, rnaDB, repoPath, featureType):
-        super(RsemWriter, self).__init__(rnaDB, repoPath, featureType)
-        self._isNormalized = True
-        self._units = 2  # TPM
-        self._expressionLevelCol = 5
-        self._idCol = 0
-        self._nameCol = self._idCol
-        self._countCol = 4
-        if self._featureType is "transcript":
-            self._featureCol = 1
-            self._confColLow = 13
-            self._confColHi = 14
-        else:
-            self._featureCol = 0
-            self._confColLow = 11
-            self._confColHi = 12
+    parserClass = rnaseqLoader.RsemParser
 
 
 class KallistoWriter(AbstractWriter):
     """
     Class to parse and write expression data from an input file generated by
-    RSEM.
-
-    kallisto header:
-        target_id    length    eff_length    est_counts    tpm
+    kallisto.
     """
-    def __init__(self, rnaDB):
-        super(KallistoWriter, self).__init__(rnaDB)
-        self._isNormalized = True
-        self._units = 2  # TPM
-        self._expressionLevelCol = 4
-        self._idCol = 0
-        self._nameCol = 0
-        self._featureCol = 0
-        self._countCol = 3
+    parserClass = rnaseqLoader.KallistoParser
 
 
 def writeRnaseqTable(rnaDB, analysisIds, description, annotationId,
@@ -258,39 +162,17 @@ def rnaseq2ga(dataFolder, sqlFilename, repoPath="ga4gh-example-data/repo.db",
 
     Supports the following quantification output type:
     Cufflinks, kallisto, RSEM
+
+    The expression matrix used by the server to compare features across
+    quantifications is written next to the database, with a .matrix suffix.
     """
-    controlFilePath = os.path.join(dataFolder, controlFile)
-    dataRepo = data_repo(repoPath)
-    rnaDB = RNASqliteStore(sqlFilename, repoPath)
-    with open(controlFilePath, "r") as rnaDatasetsFile:
-        rnaDatasetsFile.readline()  # skip header
-        for line in rnaDatasetsFile:
-            fields = line.split("\t")
-            rnaType = fields[2]
-            dataset = dataRepo.getDatasets()[0]
-            annotationId = fields[3].strip()
-            featureSet = dataset.getFeatureSetByName(annotationId)
-            if rnaType == "cufflinks":
-                writer = CufflinksWriter(rnaDB, repoPath)
-            elif rnaType == "kallisto":
-                writer = KallistoWriter(rnaDB, repoPath)
-            elif rnaType == "rsem":
-                writer = RsemWriter(rnaDB, repoPath, featureType)
-            else:
-                raise Exception("Unknown RNA file type: {}".format(rnaType))
-            rnaQuantId = fields[0].strip()
-            quantFilename = os.path.join(dataFolder, fields[1].strip())
-            readGroupSetName = fields[4].strip()
-            readGroupSet = dataset.getReadGroupSetByName(readGroupSetName)
-            readGroupIds = ",".join(
-                [x.getId() for x in readGroupSet.getReadGroups()])
-            description = fields[5].strip()
-            programs = fields[6].strip()
-            writeRnaseqTable(rnaDB, [rnaQuantId], description,
-                             featureSet.getId(),
-                             readGroupId=readGroupIds, programs=programs)
-            quantFile = open(quantFilename, "r")
-            writeExpressionTable(writer, [(rnaQuantId, quantFile)])
+    dataset = data_repo(repoPath).getDatasets()[0]
+    rnaQuantifications = rnaseqLoader.readControlFile(
+        dataset, dataFolder, controlFile)
+    loader = rnaseqLoader.RnaQuantificationLoader(sqlFilename, featureType)
+    loader.load(rnaQuantifications)
+    rna_quantification.ExpressionMatrix.build(
+        sqlFilename, sqlFilename + ".matrix")
 
 
 def parseArgs():
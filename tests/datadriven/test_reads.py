@@ -7,6 +7,8 @@ from __future__ import unicode_literals
 
 import collections
 import os
+import shutil
+import tempfile
 
 import ga4gh.backend as backend
 import ga4gh.datamodel as datamodel
@@ -115,15 +117,16 @@ class ReadGroupSetTest(datadriven.DataDrivenTest):
                 self._addReferenceSet(referenceSetName)
             else:
                 self.assertEqual(referenceSetName, name)
-            self._addReference(infoDict['SN'])
+            self._addReference(infoDict['SN'], infoDict['LN'])
 
     def _addReferenceSet(self, referenceSetName):
         self._referenceSet = references.AbstractReferenceSet(referenceSetName)
         self._backend.getDataRepository().addReferenceSet(self._referenceSet)
 
-    def _addReference(self, referenceName):
+    def _addReference(self, referenceName, length):
         reference = references.AbstractReference(
             self._referenceSet, referenceName)
+        reference.setLength(length)
         self._referenceSet.addReference(reference)
 
     def _readAlignmentInfo(self):
@@ -300,6 +303,69 @@ class ReadGroupSetTest(datadriven.DataDrivenTest):
                 self.assertGetReadAlignmentsRangeResult(
                     readGroup, reference, begin, begin, 0)
 
+    def _getExpectedDepths(self, readsObject, referenceName, end):
+        # The depth at each position before end, counting the aligned
+        # bases of the reads that samtools depth would count
+        depths = [0] * end
+        trackName = readsObject.getCoverageTrackName()
+        for read in self._samFile.fetch(referenceName, 0, end):
+            if read.flag & 0x704:
+                continue
+            if trackName != "" and dict(read.tags).get('RG') != trackName:
+                continue
+            for blockStart, blockEnd in read.get_blocks():
+                for position in range(blockStart, min(blockEnd, end)):
+                    depths[position] += 1
+        return depths
+
+    def assertDepthsEqual(self, depths, expectedDepths, binSize, length):
+        expectedMeans = []
+        for binStart in range(0, len(expectedDepths), binSize):
+            binEnd = min(binStart + binSize, length)
+            expectedMeans.append(
+                sum(expectedDepths[binStart:binEnd]) / (binEnd - binStart))
+        self.assertEqual(len(depths), len(expectedMeans))
+        for depth, expectedMean in zip(depths, expectedMeans):
+            self.assertAlmostEqual(depth, expectedMean, 5)
+
+    def testGetCoverage(self):
+        readGroupSet = self._gaObject
+        readsObjects = [readGroupSet] + readGroupSet.getReadGroups()
+        referenceNames = set(
+            name for readGroupInfo in self._readGroupInfos.values()
+            for name in readGroupInfo.mappedReads.keys())
+        tempDir = tempfile.mkdtemp()
+        try:
+            tileFilePath = os.path.join(tempDir, "coverage")
+            reads.CoverageTileFile.build(
+                self._dataPath, self._dataPath + ".bai", tileFilePath,
+                minBinSize=4096)
+            tileFile = reads.CoverageTileFile(tileFilePath)
+            for name in referenceNames:
+                reference = self._referenceSet.getReferenceByName(name)
+                length = reference.getLength()
+                end = min(length, 2**16)
+                for readsObject in readsObjects:
+                    expectedDepths = self._getExpectedDepths(
+                        readsObject, name, end)
+                    for binSize in [1, 16, 100]:
+                        _, binStart, depths = readsObject.getCoverage(
+                            reference, 0, end, binSize)
+                        self.assertEqual(binStart, 0)
+                        self.assertDepthsEqual(
+                            depths, expectedDepths[:len(depths) * binSize],
+                            binSize, length)
+                    for binSize in tileFile.getBinSizes(name):
+                        if end % binSize != 0 and end != length:
+                            continue
+                        depths = tileFile.getDepths(
+                            readsObject.getCoverageTrackName(), name,
+                            binSize, 0, end)
+                        self.assertDepthsEqual(
+                            depths, expectedDepths, binSize, length)
+        finally:
+            shutil.rmtree(tempDir)
+
     def assertGetReadAlignmentsRangeResult(
             self, readGroup, reference, start, end, result):
         alignments = list(readGroup.getReadAlignments(reference, start, end))
@@ -106,6 +106,17 @@ class ReferenceSetTest(datadriven.DataDrivenTest):
         referenceSetMd5 = referenceSet.getMd5Checksum()
         self.assertEqual(md5checksum, referenceSetMd5)
 
+    def testStreamedMd5checksums(self):
+        referenceSet = references.HtslibReferenceSet(
+            self._gaObject.getLocalId())
+        referenceSet.md5ChunkSize = 7
+        referenceSet.populateFromFile(self._dataPath, numProcesses=2)
+        self.assertEqual(
+            [(reference.getMd5Checksum(), reference.getLength())
+             for reference in self._gaObject.getReferences()],
+            [(reference.getMd5Checksum(), reference.getLength())
+             for reference in referenceSet.getReferences()])
+
     def doRangeTest(self, start=None, end=None):
         referenceSet = self._gaObject
         for gaReference in referenceSet.getReferences():
@@ -5,8 +5,13 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import os
+import shutil
+import tempfile
+
 import ga4gh.datarepo as datarepo
 import ga4gh.datamodel as datamodel
+import ga4gh.exceptions as exceptions
 import ga4gh.datamodel.datasets as datasets
 import ga4gh.datamodel.references as references
 import ga4gh.datamodel.rna_quantification as rna_quantification
@@ -174,3 +179,102 @@ class RnaQuantificationTest(datadriven.DataDrivenTest):
         self.assertEqual(
             _expressionTestData["num_expression_entries"],
             len(expressionLevels))
+
+    def testSearchExpressionLevelsPaging(self):
+        rnaQuantification = self._gaObject.getRnaQuantificationByIndex(0)
+        expressionLevels = [
+            expressionLevel for expressionLevel, _ in
+            rnaQuantification.searchExpressionLevels()]
+        self.assertEqual(
+            _expressionTestData["num_expression_entries"],
+            len(expressionLevels))
+        expressions = [e.expression for e in expressionLevels]
+        self.assertEqual(expressions, sorted(expressions))
+        pagedExpressionLevels = []
+        pageToken = None
+        while True:
+            for expressionLevel, nextPageToken in \
+                    rnaQuantification.searchExpressionLevels(
+                        pageToken=pageToken, pageSize=1):
+                pagedExpressionLevels.append(expressionLevel)
+            if nextPageToken is None:
+                break
+            pageToken = nextPageToken
+        self.assertEqual(pagedExpressionLevels, expressionLevels)
+        overThreshold = list(rnaQuantification.searchExpressionLevels(
+            threshold=100.0, pageSize=1))
+        self.assertEqual(
+            _expressionTestData["num_entries_over_threshold"],
+            len(overThreshold))
+        self.assertIsNone(overThreshold[-1][1])
+        pagedOverThreshold = []
+        pageToken = None
+        while True:
+            for expressionLevel, nextPageToken in \
+                    rnaQuantification.searchExpressionLevels(
+                        threshold=100.0, pageToken=pageToken, pageSize=1):
+                pagedOverThreshold.append(expressionLevel)
+            if nextPageToken is None:
+                break
+            pageToken = nextPageToken
+        self.assertEqual(
+            pagedOverThreshold, [e for e, _ in overThreshold])
+        for expressionLevel in pagedOverThreshold:
+            self.assertGreater(expressionLevel.expression, 100.0)
+        with self.assertRaises(exceptions.BadPageTokenException):
+            list(rnaQuantification.searchExpressionLevels(pageToken="x"))
+
+    def testGetExpressionMatrix(self):
+        featureIds, rnaQuantifications, rows = \
+            self._gaObject.getExpressionMatrix()
+        self.assertEqual(
+            (featureIds, rnaQuantifications, rows),
+            rna_quantification.AbstractRnaQuantificationSet.
+            getExpressionMatrix(self._gaObject))
+        self.assertEqual(
+            sorted(_expressionTestData["feature_ids"]), featureIds)
+        self.assertEqual(
+            self._gaObject.getRnaQuantifications(), rnaQuantifications)
+        featureId = _expressionTestData["feature_id"]
+        featureIds, _, rows = self._gaObject.getExpressionMatrix(
+            featureIds=[featureId, "unknown"])
+        self.assertEqual([featureId], featureIds)
+        self.assertEqual([[_expressionTestData["expression"]]], rows)
+        featureIds, _, _ = self._gaObject.getExpressionMatrix(
+            threshold=100.0)
+        self.assertEqual(
+            _expressionTestData["num_entries_over_threshold"],
+            len(featureIds))
+
+    def testGetExpressionMatrixFromFile(self):
+        tempDir = tempfile.mkdtemp()
+        try:
+            dbFile = os.path.join(tempDir, "rnaQuant.db")
+            shutil.copy(self._dataPath, dbFile)
+            matrixFile = dbFile + ".matrix"
+            rna_quantification.ExpressionMatrix.build(dbFile, matrixFile)
+            rnaQuantSet = self.getDataModelInstance(
+                self.getLocalId(), dbFile)
+            self.assertIsNotNone(rnaQuantSet._getExpressionMatrix())
+            for featureIds, threshold in [
+                    ([], None), ([], 100.0),
+                    ([_expressionTestData["feature_id"], "unknown"], None)]:
+                self.assertEqual(
+                    self._gaObject.getExpressionMatrix(
+                        featureIds, threshold)[::2],
+                    rnaQuantSet.getExpressionMatrix(
+                        featureIds, threshold)[::2])
+            # A matrix older than the DB is not used.
+            dbTime = os.path.getmtime(dbFile)
+            os.utime(matrixFile, (dbTime - 10, dbTime - 10))
+            rnaQuantSet = self.getDataModelInstance(
+                self.getLocalId(), dbFile)
+            self.assertIsNone(rnaQuantSet._getExpressionMatrix())
+            self.assertEqual(
+                self._gaObject.getExpressionMatrix()[::2],
+                rnaQuantSet.getExpressionMatrix()[::2])
+            self.assertEqual(
+                ["rnaQuant.db", "rnaQuant.db.matrix"],
+                sorted(os.listdir(tempDir)))
+        finally:
+            shutil.rmtree(tempDir)
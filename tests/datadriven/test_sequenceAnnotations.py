@@ -5,6 +5,11 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import os
+import shutil
+import sqlite3
+import tempfile
+
 import ga4gh.datarepo as datarepo
 import ga4gh.datamodel as datamodel
 import ga4gh.datamodel.datasets as datasets
@@ -13,6 +18,7 @@ import ga4gh.datamodel.sequenceAnnotations as sequenceAnnotations
 import ga4gh.protocol as protocol
 import tests.datadriven as datadriven
 import tests.paths as paths
+import tests.utils as utils
 
 _datasetName = "ds"
 
@@ -202,3 +208,156 @@ class FeatureSetTests(datadriven.DataDrivenTest):
             features.append(feature)
         self.assertEqual(len(features),
                          self._testData["sampleSiblings"])
+
+    def _buildFeatureSets(self, tempDir):
+        """
+        Builds the feature set's DB from its GFF3 file in the specified
+        directory with generate_gff3_db.py, and returns the feature sets
+        of this DB and of a copy of it without payloads or full text
+        index, as DBs built before these were introduced, whose features
+        are built from their columns and searched by name without index.
+        """
+        dbFilePath = os.path.join(tempDir, "built.db")
+        utils.getFeatureSetDbBuilder(
+            self._dataPath[:-len(".db")] + ".gff3", dbFilePath).run()
+        columnDbFilePath = os.path.join(tempDir, "columns.db")
+        shutil.copyfile(dbFilePath, columnDbFilePath)
+        dbConn = sqlite3.connect(columnDbFilePath)
+        try:
+            dbConn.execute("UPDATE FEATURE SET payload = NULL")
+            dbConn.execute("DROP TABLE IF EXISTS FEATURE_FTS")
+            dbConn.commit()
+        finally:
+            dbConn.close()
+        return (
+            self.getDataModelInstance(self.getLocalId(), dbFilePath),
+            self.getDataModelInstance(self.getLocalId(), columnDbFilePath))
+
+    def testFeaturePayloadMatchesColumns(self):
+        tempDir = tempfile.mkdtemp(prefix="ga4gh_payload_test")
+        try:
+            payloadFeatureSet, columnFeatureSet = self._buildFeatureSets(
+                tempDir)
+            with payloadFeatureSet._db as dataSource:
+                records = dataSource.searchFeaturesInDb()
+            self.assertTrue(all(
+                record['payload'] is not None for record in records))
+            with columnFeatureSet._db as dataSource:
+                records = dataSource.searchFeaturesInDb()
+            self.assertTrue(all(
+                record['payload'] is None for record in records))
+            args = (
+                self._testData["referenceName"], self._testData["region"][0],
+                self._testData["region"][1], None, None)
+            features = list(columnFeatureSet.getFeatures(*args))
+            self.assertEqual(len(features), self._testData["totalFeatures"])
+            self.assertEqual(
+                list(payloadFeatureSet.getFeatures(*args)), features)
+            for feature, _ in features:
+                compoundId = datamodel.FeatureCompoundId.parse(feature.id)
+                self.assertEqual(
+                    payloadFeatureSet.getFeature(compoundId), feature)
+                self.assertEqual(
+                    list(payloadFeatureSet.getFeatures(
+                        pageSize=1000, parentId=compoundId.featureId)),
+                    list(columnFeatureSet.getFeatures(
+                        pageSize=1000, parentId=compoundId.featureId)))
+        finally:
+            shutil.rmtree(tempDir)
+
+    def testFetchFeaturesByNameSubstringWithFullTextIndex(self):
+        tempDir = tempfile.mkdtemp(prefix="ga4gh_fts_test")
+        try:
+            indexedFeatureSet, columnFeatureSet = self._buildFeatureSets(
+                tempDir)
+            with indexedFeatureSet._db as dataSource:
+                self.assertTrue(dataSource._hasFullTextIndex())
+            with columnFeatureSet._db as dataSource:
+                self.assertFalse(dataSource._hasFullTextIndex())
+            features = [
+                feature for (feature, _) in columnFeatureSet.getFeatures(
+                    pageSize=1000)]
+            patterns = set()
+            for feature in features[::7]:
+                for value in [feature.name, feature.gene_symbol]:
+                    if len(value) > 0:
+                        patterns.update([
+                            value, value[1:-1], value[:2], value[-4:],
+                            value.lower()])
+            patterns.update(["*", "?", "[", "no such feature"])
+            numMatches = 0
+            for pattern in sorted(patterns):
+                for kwargs in [{"name": pattern}, {"geneSymbol": pattern}]:
+                    matches = list(indexedFeatureSet.getFeatures(
+                        pageSize=1000,
+                        nameMatch=sequenceAnnotations.NAME_MATCH_SUBSTRING,
+                        **kwargs))
+                    self.assertEqual(
+                        matches, list(columnFeatureSet.getFeatures(
+                            pageSize=1000,
+                            nameMatch=sequenceAnnotations.NAME_MATCH_SUBSTRING,
+                            **kwargs)))
+                    numMatches += len(matches)
+            self.assertGreater(numMatches, 0)
+        finally:
+            shutil.rmtree(tempDir)
+
+    def testFetchFeaturesByNamePattern(self):
+        idString = _getFeatureCompoundId(
+            _datasetName,
+            self._testData["featureSetName"],
+            self._testData["sampleFeatureId"])
+        sample = self._gaObject.getFeature(
+            datamodel.FeatureCompoundId.parse(idString))
+        self.assertGreater(len(sample.name), 2)
+        for pattern, nameMatch in [
+                (sample.name[:-1], sequenceAnnotations.NAME_MATCH_PREFIX),
+                (sample.name[1:-1], sequenceAnnotations.NAME_MATCH_SUBSTRING)]:
+            features = [
+                feature for (feature, _) in self._gaObject.getFeatures(
+                    pageSize=1000, name=pattern, nameMatch=nameMatch)]
+            self.assertIn(sample, features)
+            for feature in features:
+                self.assertIn(pattern, feature.name)
+        # Names are matched exactly by default, and '*' is not a wildcard
+        for name in [sample.name[:-1], sample.name[:-1] + "*"]:
+            self.assertEqual(
+                list(self._gaObject.getFeatures(pageSize=1000, name=name)),
+                [])
+            self.assertEqual(list(self._gaObject.getFeatures(
+                pageSize=1000, name=name + "*",
+                nameMatch=sequenceAnnotations.NAME_MATCH_PREFIX)), [])
+
+    def testGetFeatureSubtree(self):
+        rootId = self._testData["sampleParentId"]
+        if rootId is None:
+            rootId = self._testData["sampleFeatureId"]
+        compoundId = datamodel.FeatureCompoundId.parse(_getFeatureCompoundId(
+            _datasetName, self._testData["featureSetName"], rootId))
+        subtree = [
+            feature for (feature, _) in self._gaObject.getFeatureSubtree(
+                compoundId, 0, 1000)]
+        # Walk the tree one level at a time to get the expected features.
+        expectedIds = [str(compoundId)]
+        level = [compoundId.featureId]
+        while len(level) > 0:
+            children = []
+            for parentId in level:
+                for (feature, _) in self._gaObject.getFeatures(
+                        pageSize=1000, parentId=parentId):
+                    expectedIds.append(feature.id)
+                    children.append(datamodel.FeatureCompoundId.parse(
+                        feature.id).featureId)
+            level = children
+        self.assertEqual(subtree[0].id, str(compoundId))
+        self.assertEqual(
+            sorted(feature.id for feature in subtree), sorted(expectedIds))
+        # Paging through the subtree gives the same features.
+        pagedFeatures = []
+        pageToken = 0
+        while pageToken is not None:
+            for feature, nextPageToken in self._gaObject.getFeatureSubtree(
+                    compoundId, pageToken, 2):
+                pagedFeatures.append(feature)
+            pageToken = None if nextPageToken is None else int(nextPageToken)
+        self.assertEqual(pagedFeatures, subtree)
@@ -59,5 +59,9 @@ featuresPath = os.path.join(
 featuresPath2 = os.path.join(
     testDataDir, 'datasets/dataset1/sequenceAnnotations/specialCasesTest.db')
 
+# rna quantifications
+rnaQuantPath = os.path.join(
+    testDataDir, 'datasets/dataset1/rnaQuant/rsem_test_data.tsv')
+
 # misc.
 landingMessageHtml = os.path.join(testDataDir, "test.html")
@@ -7,11 +7,17 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import json
+import mock
 import unittest
 
+import pysam
+
 import ga4gh.exceptions as exceptions
 import ga4gh.backend as backend
+import ga4gh.protocol as protocol
 import ga4gh.datarepo as datarepo
+import ga4gh.datamodel as datamodel
 import ga4gh.datamodel.datasets as datasets
 import ga4gh.datamodel.references as references
 
@@ -176,6 +182,269 @@ class TestSqlRepoTestData(unittest.TestCase):
             self.assertEqual(self._dataRepo.getReferenceSet(rs.getId()), rs)
             self.assertEqual(self._dataRepo.getReferenceSetByName(name), rs)
 
+    def _searchReads(self, theBackend, request, **kwargs):
+        # Returns the IDs of all the reads found, fetching a read per page
+        readIds = []
+        request.page_size = 1
+        while True:
+            requestDict = json.loads(protocol.toJson(request))
+            requestDict.update(kwargs)
+            response = protocol.fromJson(
+                theBackend.runSearchReads(json.dumps(requestDict)),
+                protocol.SearchReadsResponse)
+            readIds.extend(
+                alignment.id for alignment in response.alignments)
+            if not response.next_page_token:
+                return readIds
+            request.page_token = response.next_page_token
+
+    def testSearchReadsDownsampled(self):
+        theBackend = backend.Backend(self._dataRepo)
+        dataset = self._dataRepo.getDatasetByName("dataset1")
+        readGroupSet = dataset.getReadGroupSetByName("chr17")
+        reference = readGroupSet.getReferenceSet().getReferenceByName(
+            "chr17")
+        request = protocol.SearchReadsRequest()
+        request.read_group_ids.extend(readGroupSet.getReadGroupIds())
+        request.reference_id = reference.getId()
+        request.end = 2**30
+        readIds = self._searchReads(theBackend, request)
+        for kwargs in [
+                {"downsampleFraction": 0.5},
+                {"maxReadsPerWindow": 1, "windowSize": 100}]:
+            request.page_token = ""
+            downsampledIds = self._searchReads(theBackend, request, **kwargs)
+            self.assertGreater(len(downsampledIds), 0)
+            self.assertLess(len(downsampledIds), len(readIds))
+            # The downsampled reads are a subsequence of all the reads
+            remainingIds = iter(readIds)
+            self.assertTrue(all(
+                id_ in remainingIds for id_ in downsampledIds))
+        for kwargs in [
+                {"downsampleFraction": 0}, {"downsampleFraction": "x"},
+                {"maxReadsPerWindow": 0}, {"windowSize": -1},
+                {"maxReadsPerWindow": 1.5}, {"windowSize": True},
+                {"downsampleFraction": True}]:
+            request.page_token = ""
+            with self.assertRaises(
+                    exceptions.BadRequestExtensionException):
+                self._searchReads(theBackend, request, **kwargs)
+
+    def testSearchReadsWithoutReference(self):
+        theBackend = backend.Backend(self._dataRepo)
+        dataset = self._dataRepo.getDatasetByName("dataset1")
+        readGroupSet = dataset.getReadGroupSetByName("chr17")
+        reference = readGroupSet.getReferenceSet().getReferenceByName(
+            "chr17")
+        request = protocol.SearchReadsRequest()
+        request.read_group_ids.extend(readGroupSet.getReadGroupIds())
+        request.reference_id = reference.getId()
+        request.end = 2**30
+        mappedReadIds = self._searchReads(theBackend, request)
+        request.reference_id = ""
+        request.end = 0
+        request.page_token = ""
+        readIds = self._searchReads(theBackend, request)
+        request.page_token = ""
+        unmappedReadIds = self._searchReads(
+            theBackend, request, unmappedOnly=True)
+        self.assertEqual(len(unmappedReadIds), 1)
+        self.assertEqual(readIds, mappedReadIds + unmappedReadIds)
+        request.page_token = ""
+        with self.assertRaises(exceptions.BadRequestException):
+            self._searchReads(theBackend, request, downsampleFraction=0.5)
+        with self.assertRaises(exceptions.BadRequestExtensionException):
+            self._searchReads(theBackend, request, unmappedOnly=1)
+        request.reference_id = reference.getId()
+        request.page_token = ""
+        with self.assertRaises(exceptions.BadRequestException):
+            self._searchReads(theBackend, request, unmappedOnly=True)
+
+    def testSearchReadsIncludeMates(self):
+        theBackend = backend.Backend(self._dataRepo)
+        dataset = self._dataRepo.getDatasetByName("dataset1")
+        readGroupSet = dataset.getReadGroupSetByName("chr17")
+        reference = readGroupSet.getReferenceSet().getReferenceByName(
+            "chr17")
+        request = protocol.SearchReadsRequest()
+        request.read_group_ids.extend(readGroupSet.getReadGroupIds())
+        request.reference_id = reference.getId()
+        request.end = 2**30
+        for readFilter in [{}, {"excludeFlags": 0x10}]:
+            request.start = 0
+            request.end = 2**30
+            requestDict = protocol.toJsonDict(request)
+            requestDict.update(readFilter)
+            allAlignments = protocol.fromJson(
+                theBackend.runSearchReads(json.dumps(requestDict)),
+                protocol.SearchReadsResponse).alignments
+            for start, end in [(0, 30), (70, 100), (200, 300)]:
+                request.start = start
+                request.end = end
+                requestDict = protocol.toJsonDict(request)
+                requestDict.update(readFilter)
+                requestDict["includeMates"] = True
+                responseDict = json.loads(
+                    theBackend.runSearchReads(json.dumps(requestDict)))
+                mates = [
+                    protocol.fromJson(
+                        json.dumps(mate), protocol.ReadAlignment)
+                    for mate in responseDict.pop("mates")]
+                alignments = protocol.fromJson(
+                    json.dumps(responseDict),
+                    protocol.SearchReadsResponse).alignments
+                expected = [
+                    mate for mate in allAlignments
+                    if not start <= mate.alignment.position.position < end and
+                    any(alignment.fragment_name == mate.fragment_name and
+                        alignment.next_mate_position.position ==
+                        mate.alignment.position.position and
+                        alignment.read_number == 1 - mate.read_number
+                        for alignment in alignments)]
+                self.assertEqual(mates, expected)
+                if readFilter:
+                    self.assertTrue(all(
+                        mate.alignment.position.strand ==
+                        protocol.POS_STRAND for mate in mates))
+        requestDict["includeMates"] = "x"
+        with self.assertRaises(exceptions.BadRequestExtensionException):
+            theBackend.runSearchReads(json.dumps(requestDict))
+        requestDict["includeMates"] = True
+        requestDict["referenceId"] = ""
+        with self.assertRaises(exceptions.BadRequestException):
+            theBackend.runSearchReads(json.dumps(requestDict))
+
+    def testGetReadAlignmentsWithoutNameIndex(self):
+        theBackend = backend.Backend(self._dataRepo)
+        dataset = self._dataRepo.getDatasetByName("dataset1")
+        readGroupSet = dataset.getReadGroupSetByName("chr17")
+        readAlignmentId = str(datamodel.ReadAlignmentCompoundId(
+            readGroupSet.getCompoundId(), "r000"))
+        with self.assertRaises(exceptions.NotImplementedException):
+            theBackend.runGetReadAlignments(readAlignmentId)
+
+    def testSearchReadsFiltered(self):
+        theBackend = backend.Backend(self._dataRepo)
+        dataset = self._dataRepo.getDatasetByName("dataset1")
+        readGroupSet = dataset.getReadGroupSetByName("chr17")
+        reference = readGroupSet.getReferenceSet().getReferenceByName(
+            "chr17")
+        samFile = pysam.AlignmentFile(readGroupSet.getDataUrl())
+        request = protocol.SearchReadsRequest()
+        request.read_group_ids.extend(readGroupSet.getReadGroupIds())
+        request.reference_id = reference.getId()
+        request.end = 2**30
+        for kwargs, isSelected in [
+                ({"excludeFlags": 0x10}, lambda read: not read.is_reverse),
+                ({"requireFlags": 0x10}, lambda read: read.is_reverse),
+                ({"minMappingQuality": 30},
+                 lambda read: read.mapping_quality >= 30),
+                ({"minMappingQuality": 31},
+                 lambda read: read.mapping_quality >= 31)]:
+            request.page_token = ""
+            readIds = self._searchReads(theBackend, request, **kwargs)
+            expectedReads = [
+                read for read in samFile.fetch(b"chr17") if isSelected(read)]
+            self.assertEqual(len(readIds), len(expectedReads))
+        request.page_token = ""
+        self.assertEqual(
+            self._searchReads(theBackend, request, minMappingQuality=31.0),
+            readIds)
+        for kwargs in [
+                {"minMappingQuality": -1}, {"minMappingQuality": 2.7},
+                {"excludeFlags": True}, {"requireFlags": "16"}]:
+            request.page_token = ""
+            with self.assertRaises(
+                    exceptions.BadRequestExtensionException):
+                self._searchReads(theBackend, request, **kwargs)
+
+    def testSearchFeaturesNameMatch(self):
+        theBackend = backend.Backend(self._dataRepo)
+        dataset = self._dataRepo.getDatasetByName("dataset1")
+        featureSet = dataset.getFeatureSetByName("gencodeV21Set1")
+        request = protocol.SearchFeaturesRequest()
+        request.feature_set_id = featureSet.getId()
+        request.gene_symbol = "DDX11"
+        request.page_size = 1000
+        requestDict = protocol.toJsonDict(request)
+
+        def searchGeneSymbols(**kwargs):
+            requestDict.update(kwargs)
+            response = protocol.fromJson(
+                theBackend.runSearchFeatures(json.dumps(requestDict)),
+                protocol.SearchFeaturesResponse)
+            return set(feature.gene_symbol for feature in response.features)
+
+        self.assertEqual(searchGeneSymbols(), set())
+        genes = {"DDX11L1", "DDX11L16"}
+        self.assertEqual(searchGeneSymbols(nameMatch="prefix"), genes)
+        self.assertEqual(
+            searchGeneSymbols(geneSymbol="DX11L", nameMatch="substring"),
+            genes)
+        self.assertEqual(
+            searchGeneSymbols(geneSymbol="DDX11L1", nameMatch="exact"),
+            {"DDX11L1"})
+        for nameMatch in ["glob", 1]:
+            with self.assertRaises(exceptions.BadRequestExtensionException):
+                searchGeneSymbols(nameMatch=nameMatch)
+
+    def testListReferenceBasesBatchChecksIntervals(self):
+        theBackend = backend.Backend(self._dataRepo)
+        theBackend.setMaxResponseLength(6)
+        dataset = self._dataRepo.getDatasetByName("dataset1")
+        reference = dataset.getReadGroupSetByName(
+            "chr17").getReferenceSet().getReferenceByName("chr17")
+
+        def runBatch(intervals):
+            return json.loads(theBackend.runListReferenceBasesBatch(
+                json.dumps({"intervals": [
+                    {"referenceId": reference.getId(), "start": start,
+                     "end": end}
+                    for start, end in intervals]})))["sequences"]
+
+        self.assertEqual(
+            runBatch([(2, 5), (0, 3)]),
+            [reference.getBases(2, 5), reference.getBases(0, 3)])
+        with self.assertRaises(exceptions.BasesBatchTooLargeException):
+            runBatch([(0, 5), (0, 3)])
+        # A reversed interval does not offset the length of the others,
+        # and no bases are read before it is rejected
+        with mock.patch.object(
+                reference, "getBases",
+                side_effect=AssertionError("bases read")):
+            with self.assertRaises(AssertionError):
+                runBatch([(0, 3)])
+            for intervals in [[(0, 9), (8, 4)], [(0, 3), (-2, 2)]]:
+                with self.assertRaises(
+                        exceptions.ReferenceRangeErrorException):
+                    runBatch(intervals)
+
+    def testGetCoverage(self):
+        theBackend = backend.Backend(self._dataRepo)
+        dataset = self._dataRepo.getDatasetByName("dataset1")
+        readGroupSet = dataset.getReadGroupSetByName("chr17")
+        reference = readGroupSet.getReferenceSet().getReferenceByName(
+            "chr17")
+        length = reference.getLength()
+        args = {"referenceId": reference.getId(), "numBins": 3}
+        for readsObject, runGetCoverage in [
+                (readGroupSet, theBackend.runGetReadGroupSetCoverage),
+                (readGroupSet.getReadGroups()[0],
+                 theBackend.runGetReadGroupCoverage)]:
+            binSize = -(-length // 3)
+            _, _, depths = readsObject.getCoverage(
+                reference, 0, length, binSize)
+            response = json.loads(runGetCoverage(readsObject.getId(), args))
+            self.assertEqual(response, {
+                "referenceId": reference.getId(), "start": 0,
+                "binSize": binSize, "depths": depths})
+        for numBins in [0, 2**20]:
+            args["numBins"] = numBins
+            with self.assertRaises(
+                    exceptions.BadCoverageBinCountException):
+                theBackend.runGetReadGroupSetCoverage(
+                    readGroupSet.getId(), args)
+
 
 class TestTopLevelObjectGenerator(unittest.TestCase):
     """
@@ -237,3 +506,20 @@ class TestPrivateBackendMethods(unittest.TestCase):
         for key in bad:
             with self.assertRaises(exceptions.BadRequestIntegerException):
                 backend._parseIntegerArgument(bad, key, 0)
+
+    def testParseExtensions(self):
+        self.assertEqual(backend._parseIntegerExtension(2), 2)
+        self.assertEqual(backend._parseIntegerExtension(2.0), 2)
+        self.assertEqual(backend._parseFloatExtension(1), 1.0)
+        self.assertEqual(backend._parseBooleanExtension(False), False)
+        self.assertEqual(backend._parseStringExtension("x"), "x")
+        for parse, value in [
+                (backend._parseIntegerExtension, True),
+                (backend._parseIntegerExtension, 2.7),
+                (backend._parseIntegerExtension, "2"),
+                (backend._parseFloatExtension, False),
+                (backend._parseFloatExtension, "0.5"),
+                (backend._parseBooleanExtension, 1),
+                (backend._parseStringExtension, 1)]:
+            with self.assertRaises(ValueError):
+                parse(value)
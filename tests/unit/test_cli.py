@@ -491,8 +491,8 @@ class TestRepoManagerCli(unittest.TestCase):
         args = self.parser.parse_args(cliInput.split())
         self.assertEquals(args.registryPath, self.registryPath)
         self.assertEquals(args.datasetName, self.datasetName)
-        self.assertEquals(args.dataFile, self.filePath)
-        self.assertEquals(args.indexFile, None)
+        self.assertEquals(args.dataFiles, [self.filePath])
+        self.assertEquals(args.indexFiles, None)
         self.assertEquals(args.runner, "addReadGroupSet")
 
     def testAddReadGroupSetWithIndexFile(self):
@@ -503,8 +503,8 @@ class TestRepoManagerCli(unittest.TestCase):
         args = self.parser.parse_args(cliInput.split())
         self.assertEquals(args.registryPath, self.registryPath)
         self.assertEquals(args.datasetName, self.datasetName)
-        self.assertEquals(args.dataFile, self.filePath)
-        self.assertEquals(args.indexFile, indexPath)
+        self.assertEquals(args.dataFiles, [self.filePath])
+        self.assertEquals(args.indexFiles, [indexPath])
         self.assertEquals(args.runner, "addReadGroupSet")
 
     def testRemoveReadGroupSet(self):
@@ -9,6 +9,7 @@ from __future__ import unicode_literals
 import os
 import shutil
 import tempfile
+import threading
 import unittest
 import uuid
 
@@ -24,10 +25,21 @@ class TestFileHandleCache(datamodel.PysamFileHandleCache, unittest.TestCase):
         self._tempdir = tempfile.mkdtemp(prefix="ga4gh_file_cache",
                                          dir=tempfile.gettempdir())
 
-    def _getFileHandle(self, dataFile):
-        def openMethod(dataFile):
-            return open(dataFile, 'w')
-        return self.getFileHandle(dataFile, openMethod)
+    def _openMethod(self, dataFile):
+        return open(dataFile, 'w')
+
+    def _getFileHandle(self, dataFile, handleType=None):
+        with self.fileHandle(
+                dataFile, self._openMethod, handleType) as handle:
+            return handle
+
+    def _getCachedHandles(self, handleType=None):
+        return [
+            handle for handles in self._idleHandles[handleType].values()
+            for handle in handles]
+
+    def _getCachedFileNames(self, handleType=None):
+        return list(self._idleHandles[handleType].keys())
 
     def testGetFileHandle(self):
         def genFileName(x):
@@ -39,24 +51,119 @@ class TestFileHandleCache(datamodel.PysamFileHandleCache, unittest.TestCase):
         # Build a list of 10 files and add their handles to the cache
         fileList = map(genFileName, range(0, 10))
 
+        handles = []
         for f in fileList:
             handle = self._getFileHandle(f)
-            self.assertEquals(self._cache.count((f, handle)), 1)
+            handles.append(handle)
+            self.assertEquals(self._getCachedHandles().count(handle), 1)
 
-        self.assertEquals(len(self._memoTable), len(self._cache))
+        self.assertEquals(len(self._getCachedHandles()), 9)
 
         # Ensure that the first added file has been removed from the cache
-        self.assertEquals(filter(lambda x: x[0] == fileList[0], self._cache),
-                          [])
-
-        topIndex = len(self._cache) - 1
+        # and its handle closed
+        self.assertNotIn(fileList[0], self._getCachedFileNames())
+        self.assertTrue(handles[0].closed)
+        self.assertFalse(handles[1].closed)
 
         # Update priority of this file and ensure it's no longer the
         # least recently used
-        self.assertEquals(self._cache[topIndex][0], fileList[1])
+        self.assertEquals(self._getCachedFileNames()[0], fileList[1])
         self._getFileHandle(fileList[1])
-        self.assertNotEqual(self._cache[topIndex][0], fileList[1])
-        self.assertEquals(self._cache[0][0], fileList[1])
+        self.assertNotEqual(self._getCachedFileNames()[0], fileList[1])
+        self.assertEquals(self._getCachedFileNames()[-1], fileList[1])
+
+    def testMetrics(self):
+        self.setMaxCacheSize(2)
+        fileList = [
+            os.path.join(self._tempdir, str(uuid.uuid4())) for _ in range(3)]
+        for f in fileList:
+            self._getFileHandle(f)
+        self._getFileHandle(fileList[2])
+        metrics = self.getMetrics()[None]
+        self.assertEquals(metrics["misses"], 3)
+        self.assertEquals(metrics["hits"], 1)
+        self.assertEquals(metrics["evictions"], 1)
+        self.assertEquals(metrics["size"], 2)
+        self.assertEquals(metrics["checkedOut"], 0)
+        self.assertEquals(metrics["maxSize"], 2)
+        self.assertGreaterEqual(metrics["openSeconds"], 0)
+
+    def testPerTypeMaxCacheSize(self):
+        self.setMaxCacheSize(1, "small")
+        self.setMaxCacheSize(3)
+        self.assertEquals(self.getMaxCacheSize("small"), 1)
+        self.assertEquals(self.getMaxCacheSize("other"), 3)
+        fileList = [
+            os.path.join(self._tempdir, str(uuid.uuid4())) for _ in range(3)]
+        for f in fileList:
+            self._getFileHandle(f, "small")
+            self._getFileHandle(f, "other")
+        self.assertEquals(len(self._getCachedHandles("small")), 1)
+        self.assertEquals(len(self._getCachedHandles("other")), 3)
+        self.assertEquals(self.getMetrics()["small"]["evictions"], 2)
+        self.assertEquals(self.getMetrics()["other"]["evictions"], 0)
+
+    def testCheckedOutHandlesAreExclusive(self):
+        dataFile = os.path.join(self._tempdir, str(uuid.uuid4()))
+        with self.fileHandle(dataFile, self._openMethod) as handle1:
+            with self.fileHandle(dataFile, self._openMethod) as handle2:
+                self.assertIsNot(handle1, handle2)
+                self.assertEquals(self.getMetrics()[None]["checkedOut"], 2)
+                self.assertEquals(self.getCachedFiles(), [])
+        self.assertEquals(self.getMetrics()[None]["checkedOut"], 0)
+        self.assertEquals(
+            sorted(self._getCachedHandles()), sorted([handle1, handle2]))
+
+    def testHandlesAreSharedByThreads(self):
+        dataFile = os.path.join(self._tempdir, str(uuid.uuid4()))
+        handles = []
+
+        def getHandle():
+            handles.append(self._getFileHandle(dataFile))
+        thread = threading.Thread(target=getHandle)
+        thread.start()
+        thread.join()
+        getHandle()
+        self.assertEquals(len(handles), 2)
+        self.assertIs(handles[0], handles[1])
+        self.assertEquals(self.getMetrics()[None]["misses"], 1)
+        self.assertEquals(self.getCachedFiles(), [dataFile])
+
+    def testCheckedOutHandlesAreNotClosed(self):
+        self.setMaxCacheSize(1)
+        fileList = [
+            os.path.join(self._tempdir, str(uuid.uuid4())) for _ in range(2)]
+        with self.fileHandle(fileList[0], self._openMethod) as handle:
+            self._getFileHandle(fileList[1])
+            self._getFileHandle(fileList[1])
+            self.assertFalse(handle.closed)
+        self.assertFalse(handle.closed)
+        self.assertEquals(self._getCachedHandles(), [handle])
+
+    def testPreloadFileHandle(self):
+        dataFile = os.path.join(self._tempdir, str(uuid.uuid4()))
+        self.preloadFileHandle(dataFile, self._openMethod)
+        self.preloadFileHandle(dataFile, self._openMethod)
+        self.assertEquals(self.getMetrics()[None]["misses"], 0)
+        handle = self._getCachedHandles()[0]
+        handles = []
+        thread = threading.Thread(
+            target=lambda: handles.append(self._getFileHandle(dataFile)))
+        thread.start()
+        thread.join()
+        self.assertIs(handles[0], handle)
+        self.assertEquals(self.getMetrics()[None]["hits"], 1)
+        self.assertEquals(self.getAccessCounts(), {dataFile: 1})
+
+    def testForkedProcessDropsInheritedHandles(self):
+        dataFile = os.path.join(self._tempdir, str(uuid.uuid4()))
+        handle = self._getFileHandle(dataFile)
+        # Pretend that this process was forked from the one the handle
+        # was opened in
+        self._pid = -1
+        self.assertIsNot(self._getFileHandle(dataFile), handle)
+        self.assertTrue(handle.closed)
+        self.assertEquals(self.getMetrics()[None]["misses"], 2)
 
     def testSetCacheMaxSize(self):
         self.assertRaises(ValueError, self.setMaxCacheSize, 0)
@@ -0,0 +1,100 @@
+"""
+Tests the feature set DBs built by scripts/generate_gff3_db.py.
+"""
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import tests.utils as utils
+
+_testDataDir = "tests/data/datasets/dataset1/sequenceAnnotations/"
+_featureSetNames = [
+    "discontinuous", "gencodeV21Set1", "sacCerTest", "specialCasesTest"]
+
+
+def _getFeatures(dbFilePath):
+    """
+    Returns the sorted list of the features of the specified DB, with
+    their parent and children given by their columns rather than their
+    IDs, which differ between builds.
+    """
+    dbConn = sqlite3.connect(dbFilePath)
+    dbConn.row_factory = sqlite3.Row
+    try:
+        rows = dbConn.execute("SELECT * FROM FEATURE").fetchall()
+    finally:
+        dbConn.close()
+    keys = {}
+    for row in rows:
+        keys[row[b'id']] = (
+            row[b'reference_name'], row[b'start'], row[b'end'],
+            row[b'type'], row[b'name'], row[b'strand'])
+    features = []
+    for row in rows:
+        parentKey = None
+        if row[b'parent_id'] not in (None, ''):
+            parentKey = keys[row[b'parent_id']]
+        features.append((
+            keys[row[b'id']], row[b'source'], row[b'score'],
+            row[b'gene_name'], row[b'transcript_name'],
+            json.loads(row[b'attributes']), parentKey,
+            sorted(keys[childId]
+                   for childId in json.loads(row[b'child_ids']))))
+    return sorted(features)
+
+
+class TestGff32Db(unittest.TestCase):
+    """
+    Builds the DBs of the test GFF3 files and compares them with the
+    test DBs built from the same files.
+    """
+    def setUp(self):
+        self._tempDir = tempfile.mkdtemp(prefix="ga4gh_gff3_db_test")
+
+    def tearDown(self):
+        shutil.rmtree(self._tempDir)
+
+    def testBuild(self):
+        for featureSetName in _featureSetNames:
+            expected = _getFeatures(
+                os.path.join(_testDataDir, featureSetName + ".db"))
+            for numProcesses in [1, 3]:
+                dbFilePath = os.path.join(
+                    self._tempDir, "{}{}.db".format(
+                        featureSetName, numProcesses))
+                utils.getFeatureSetDbBuilder(
+                    os.path.join(_testDataDir, featureSetName + ".gff3"),
+                    dbFilePath, numProcesses).run()
+                self.assertEqual(_getFeatures(dbFilePath), expected)
+                dbConn = sqlite3.connect(dbFilePath)
+                try:
+                    ids = [row[0] for row in dbConn.execute(
+                        "SELECT id FROM FEATURE ORDER BY id")]
+                    numPayloads = dbConn.execute(
+                        "SELECT COUNT(*) FROM FEATURE "
+                        "WHERE payload IS NOT NULL").fetchone()[0]
+                finally:
+                    dbConn.close()
+                # Features are numbered in file order, from 1
+                self.assertEqual(ids, range(1, len(expected) + 1))
+                self.assertEqual(numPayloads, len(expected))
+
+    def testSmallBatches(self):
+        # Features and their links span several batches of both passes
+        featureSetName = "gencodeV21Set1"
+        dbFilePath = os.path.join(self._tempDir, "batched.db")
+        builder = utils.getFeatureSetDbBuilder(
+            os.path.join(_testDataDir, featureSetName + ".gff3"),
+            dbFilePath, 2)
+        builder.batchSize = 7
+        builder.run()
+        self.assertEqual(
+            _getFeatures(dbFilePath),
+            _getFeatures(os.path.join(_testDataDir, featureSetName + ".db")))
@@ -65,6 +65,37 @@ class TestGff3ParserOnTypicalFile(unittest.TestCase):
                         len(childLookup), 1,
                         "child feature not in set")
 
+    def testIterFeaturesYieldsUnlinkedFeatures(self):
+        parser = gff3.Gff3Parser(self.gff3Parser.fileName)
+        features = list(parser.iterFeatures())
+        self.assertEqual(
+            len(features),
+            sum(map(len, self.gff3Data.byFeatureName.values())))
+        for feature in features:
+            self.assertEqual(len(feature.parents), 0)
+            self.assertEqual(len(feature.children), 0)
+        starts = [(f.featureName, f.start) for f in features]
+        parsedStarts = [
+            (f.featureName, f.start)
+            for featureParts in self.gff3Data.byFeatureName.values()
+            for f in featureParts]
+        self.assertEqual(sorted(starts), sorted(parsedStarts))
+
+    def testParallelParseMatchesSerialParse(self):
+        def recordKey(feature):
+            return (
+                feature.seqname, feature.source, feature.type,
+                feature.start, feature.end, feature.score, feature.strand,
+                feature.frame, feature.attributes)
+        serialParser = gff3.Gff3Parser(self.gff3Parser.fileName)
+        parallelParser = gff3.Gff3Parser(
+            self.gff3Parser.fileName, numProcesses=2)
+        parallelParser.chunkSize = 7
+        self.assertEqual(
+            map(recordKey, parallelParser.iterFeatures()),
+            map(recordKey, serialParser.iterFeatures()))
+        self.assertEqual(parallelParser.lineNumber, serialParser.lineNumber)
+
 
 class TestGff3ParserOnDiscontinuousFeatureFile(TestGff3ParserOnTypicalFile):
     """
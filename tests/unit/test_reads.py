@@ -6,9 +6,18 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import collections
+import os
+import random
+import shutil
+import tempfile
 import unittest
 
+import pysam
+
+import ga4gh.datamodel.datasets as datasets
 import ga4gh.datamodel.reads as reads
+import ga4gh.datamodel.references as references
 import ga4gh.protocol as protocol
 
 
@@ -247,3 +256,407 @@ class TestSamFlags(unittest.TestCase):
             self.flag, reads.SamFlags.FIRST_IN_PAIR))
         self.assertTrue(reads.SamFlags.isFlagSet(
             self.flag, reads.SamFlags.FAILED_QUALITY_CHECK))
+
+
+FakeRead = collections.namedtuple(
+    "FakeRead", ["query_name", "reference_start"])
+
+
+FakeFlaggedRead = collections.namedtuple(
+    "FakeFlaggedRead", ["flag", "mapping_quality"])
+
+
+class TestReadFilter(unittest.TestCase):
+    """
+    Tests the selection of reads by ReadFilter.
+    """
+    def testFlags(self):
+        duplicate = reads.SamFlags.DUPLICATE_READ
+        paired = reads.SamFlags.READ_PAIRED
+        readFilter = reads.ReadFilter(excludeFlags=duplicate)
+        self.assertTrue(readFilter.isSelected(FakeFlaggedRead(paired, 0)))
+        self.assertFalse(readFilter.isSelected(
+            FakeFlaggedRead(paired | duplicate, 0)))
+        readFilter = reads.ReadFilter(requireFlags=paired)
+        self.assertTrue(readFilter.isSelected(
+            FakeFlaggedRead(paired | duplicate, 0)))
+        self.assertFalse(readFilter.isSelected(FakeFlaggedRead(0, 0)))
+
+    def testMinMappingQuality(self):
+        readFilter = reads.ReadFilter(minMappingQuality=20)
+        self.assertTrue(readFilter.isSelected(FakeFlaggedRead(0, 20)))
+        self.assertFalse(readFilter.isSelected(FakeFlaggedRead(0, 19)))
+        self.assertTrue(reads.ReadFilter().isSelected(FakeFlaggedRead(0, 0)))
+
+
+class TestReadDownsampler(unittest.TestCase):
+    """
+    Tests the deterministic selection of reads by ReadDownsampler.
+    """
+    def _getReads(self, positions):
+        return [
+            FakeRead("read{}".format(index), position)
+            for index, position in enumerate(positions)]
+
+    def testFraction(self):
+        fakeReads = self._getReads(range(1000))
+        downsampler = reads.ReadDownsampler(0.25)
+        selected = list(downsampler.filterReads(fakeReads))
+        self.assertEqual(selected, list(downsampler.filterReads(fakeReads)))
+        self.assertGreater(len(selected), 200)
+        self.assertLess(len(selected), 300)
+        for read in selected:
+            key = reads.ReadDownsampler.getKey(read.query_name)
+            self.assertLess(key, 0.25)
+        moreSelected = list(
+            reads.ReadDownsampler(0.5).filterReads(fakeReads))
+        self.assertTrue(set(selected) < set(moreSelected))
+
+    def testMaxReadsPerWindow(self):
+        fakeReads = self._getReads([5] * 100 + [12] * 3 + [25] * 20)
+        downsampler = reads.ReadDownsampler(
+            maxReadsPerWindow=10, windowSize=10)
+        selected = list(downsampler.filterReads(fakeReads))
+        self.assertEqual(len(selected), 23)
+        self.assertEqual(
+            selected, [read for read in fakeReads if read in selected])
+        for window in [0, 20]:
+            windowReads = [
+                read for read in fakeReads
+                if read.reference_start // 10 == window // 10]
+            expected = sorted(
+                windowReads, key=lambda read: reads.ReadDownsampler.getKey(
+                    read.query_name))[:10]
+            self.assertEqual(
+                set(read for read in selected
+                    if read.reference_start // 10 == window // 10),
+                set(expected))
+
+    def testGetWindowedRange(self):
+        downsampler = reads.ReadDownsampler(
+            maxReadsPerWindow=1, windowSize=10)
+        self.assertEqual(downsampler.getWindowedRange(15, 21), (10, 30))
+        self.assertEqual(downsampler.getWindowedRange(20, 30), (20, 30))
+        self.assertEqual(
+            downsampler.getWindowedRange(None, None), (None, None))
+        self.assertEqual(
+            reads.ReadDownsampler(0.5).getWindowedRange(15, 21), (15, 21))
+
+
+class TestCramReadGroupSet(unittest.TestCase):
+    """
+    Tests reading a CRAM file against the BAM file holding the same reads.
+    """
+    referenceLength = 5000
+    numUnmappedReads = 3
+
+    def setUp(self):
+        self._tempDir = tempfile.mkdtemp(prefix="ga4gh_cram_test")
+        randomNumberGenerator = random.Random(5)
+        bases = "".join(
+            randomNumberGenerator.choice("ACGT")
+            for _ in range(self.referenceLength))
+        self._fastaFilePath = os.path.join(self._tempDir, "test.fa")
+        with open(self._fastaFilePath, "w") as fastaFile:
+            fastaFile.write(">ref1\n{}\n".format(bases))
+        pysam.faidx(self._fastaFilePath)
+        header = {
+            "HD": {"VN": "1.5", "SO": "coordinate"},
+            "SQ": [{"SN": "ref1", "LN": self.referenceLength}],
+            "RG": [{"ID": "rg1", "SM": "sample1"}]}
+        self._bamFilePath = os.path.join(self._tempDir, "test.bam")
+        self._cramFilePath = os.path.join(self._tempDir, "test.cram")
+        bamFile = pysam.AlignmentFile(self._bamFilePath, "wb", header=header)
+        cramFile = pysam.AlignmentFile(
+            self._cramFilePath, "wc", header=header,
+            reference_filename=self._fastaFilePath)
+        # Pairs of reads, each pointing to the position of its mate
+        reads = []
+        for index in range(150):
+            readStarts = [
+                randomNumberGenerator.randint(0, self.referenceLength - 1000)
+                for _ in range(2)]
+            for readNumber in range(2):
+                # Some reads span a long deletion, across several slices
+                hasDeletion = index % 10 == 0 and readNumber == 0
+                reads.append((
+                    readStarts[readNumber], "read{}".format(index),
+                    readNumber, readStarts[1 - readNumber], hasDeletion))
+        for start, name, readNumber, mateStart, hasDeletion in sorted(reads):
+            length = 50
+            cigar = [(0, length)]
+            if hasDeletion:
+                cigar = [(0, 25), (2, 700), (0, 25)]
+            read = pysam.AlignedSegment()
+            read.query_name = name
+            read.flag = 0x1 | (0x40 if readNumber == 0 else 0x80)
+            read.reference_id = 0
+            read.reference_start = start
+            read.next_reference_id = 0
+            read.next_reference_start = mateStart
+            read.mapping_quality = 30
+            read.cigar = cigar
+            read.query_sequence = bases[start:start + length]
+            read.query_qualities = pysam.qualitystring_to_array("I" * length)
+            read.tags = [(b"RG", b"rg1")]
+            bamFile.write(read)
+            cramFile.write(read)
+        for index in range(self.numUnmappedReads):
+            read = pysam.AlignedSegment()
+            read.query_name = "unmapped{}".format(index)
+            read.flag = 4
+            read.reference_id = -1
+            read.reference_start = -1
+            read.query_sequence = "ACGT"
+            read.query_qualities = pysam.qualitystring_to_array("IIII")
+            read.tags = [(b"RG", b"rg1")]
+            bamFile.write(read)
+            cramFile.write(read)
+        bamFile.close()
+        cramFile.close()
+        pysam.index(self._bamFilePath)
+        pysam.index(self._cramFilePath)
+        self._referenceSet = references.HtslibReferenceSet("test")
+        self._referenceSet.populateFromFile(self._fastaFilePath)
+        self._reference = self._referenceSet.getReferenceByName("ref1")
+
+    def tearDown(self):
+        shutil.rmtree(self._tempDir)
+
+    def _getReadGroupSet(self, dataUrl):
+        readGroupSet = reads.HtslibReadGroupSet(
+            datasets.Dataset("dataset"), "readGroupSet")
+        readGroupSet.populateFromFile(dataUrl)
+        readGroupSet.setReferenceSet(self._referenceSet)
+        return readGroupSet
+
+    def testDefaultIndexFile(self):
+        self.assertEqual(
+            reads.getDefaultIndexFile(self._cramFilePath),
+            self._cramFilePath + ".crai")
+        self.assertEqual(
+            reads.getDefaultIndexFile(self._bamFilePath),
+            self._bamFilePath + ".bai")
+
+    def testReadAlignments(self):
+        bamReadGroupSet = self._getReadGroupSet(self._bamFilePath)
+        cramReadGroupSet = self._getReadGroupSet(self._cramFilePath)
+        self.assertEqual(
+            cramReadGroupSet.getIndexFile(), self._cramFilePath + ".crai")
+        self.assertEqual(
+            [readGroup.getLocalId()
+             for readGroup in cramReadGroupSet.getReadGroups()], ["rg1"])
+        for start, end in [(None, None), (0, 10), (1000, 1200), (0, 5000)]:
+            for bamReadGroup, cramReadGroup in zip(
+                    bamReadGroupSet.getReadGroups(),
+                    cramReadGroupSet.getReadGroups()):
+                bamReadAlignments = list(bamReadGroup.getReadAlignments(
+                    self._reference, start, end))
+                cramReadAlignments = list(cramReadGroup.getReadAlignments(
+                    self._reference, start, end))
+                # htslib generates the MD and NM tags of CRAM records
+                for readAlignment in cramReadAlignments:
+                    del readAlignment.info["MD"]
+                    del readAlignment.info["NM"]
+                self.assertEqual(bamReadAlignments, cramReadAlignments)
+
+    def testSliceCache(self):
+        cramSliceCache = reads.CramSliceCache(
+            maxCacheSize=2, sliceLength=500)
+        samFile = pysam.AlignmentFile(
+            self._cramFilePath, reference_filename=self._fastaFilePath)
+        for start, end in [
+                (None, None), (0, 1), (499, 501), (700, 2300), (4000, 5000),
+                (600, 601), (2000, 2000)]:
+            self.assertEqual(
+                [read.query_name for read in cramSliceCache.fetch(
+                    samFile, self._cramFilePath, b"ref1", start, end)],
+                [read.query_name for read in samFile.fetch(
+                    b"ref1", start, end)])
+        metrics = cramSliceCache.getMetrics()
+        list(cramSliceCache.fetch(
+            samFile, self._cramFilePath, b"ref1", 510, 520))
+        self.assertEqual(
+            cramSliceCache.getMetrics()["hits"], metrics["hits"] + 1)
+        self.assertEqual(cramSliceCache.getMetrics()["size"], 2)
+
+    def testScanReadAlignments(self):
+        for dataUrl in [self._bamFilePath, self._cramFilePath]:
+            readGroupSet = self._getReadGroupSet(dataUrl)
+            scan = list(readGroupSet.scanReadAlignments())
+            readAlignments = [readAlignment for readAlignment, _ in scan]
+            self.assertEqual(len(readAlignments), 300 + self.numUnmappedReads)
+            unmappedReadAlignments = [
+                readAlignment for readAlignment, _ in
+                readGroupSet.scanReadAlignments(unmappedOnly=True)]
+            self.assertEqual(
+                unmappedReadAlignments,
+                readAlignments[-self.numUnmappedReads:])
+            for index in range(0, len(scan), 23) + [len(scan) - 2]:
+                self.assertEqual(
+                    [readAlignment for readAlignment, _ in
+                     readGroupSet.scanReadAlignments(offset=scan[index][1])],
+                    readAlignments[index + 1:])
+
+    def testGetMateAlignments(self):
+        for dataUrl in [self._bamFilePath, self._cramFilePath]:
+            readGroupSet = self._getReadGroupSet(dataUrl)
+            readAlignments = list(
+                readGroupSet.getReadAlignments(self._reference))
+            numMates = 0
+            for start, end in [(0, 100), (1000, 1500), (3000, 5000)]:
+                windowReadAlignments = list(readGroupSet.getReadAlignments(
+                    self._reference, start, end))
+                mates = readGroupSet.getMateAlignments(
+                    windowReadAlignments, self._reference, start, end)
+                expected = [
+                    readAlignment for readAlignment in readAlignments
+                    if not start <=
+                    readAlignment.alignment.position.position < end and
+                    any(windowReadAlignment.fragment_name ==
+                        readAlignment.fragment_name and
+                        windowReadAlignment.read_number ==
+                        1 - readAlignment.read_number
+                        for windowReadAlignment in windowReadAlignments)]
+                self.assertEqual(
+                    sorted(mate.fragment_name for mate in mates),
+                    sorted(mate.fragment_name for mate in expected))
+                self.assertEqual(
+                    [(mate.alignment.position.position, mate.read_number)
+                     for mate in mates],
+                    [(mate.alignment.position.position, mate.read_number)
+                     for mate in expected])
+                numMates += len(mates)
+                # The mates are selected by the filter of the reads
+                self.assertEqual(
+                    readGroupSet.getMateAlignments(
+                        windowReadAlignments, self._reference, start, end,
+                        reads.ReadFilter(excludeFlags=0x40)),
+                    [mate for mate in mates if mate.read_number == 1])
+            self.assertGreater(numMates, 0)
+
+    def testReadNameIndex(self):
+        for dataUrl in [self._bamFilePath, self._cramFilePath]:
+            readGroupSet = self._getReadGroupSet(dataUrl)
+            self.assertIsNone(readGroupSet.getReadNameIndexFiles())
+            reads.ReadNameIndexFile.build(
+                dataUrl, readGroupSet.getIndexFile(),
+                dataUrl + readGroupSet.readNameIndexFileSuffix,
+                referenceFilePath=self._fastaFilePath, runSize=37)
+            readGroupSet = self._getReadGroupSet(dataUrl)
+            readAlignments = [
+                readAlignment for readAlignment, _ in
+                readGroupSet.scanReadAlignments()]
+            names = set(
+                readAlignment.fragment_name
+                for readAlignment in readAlignments)
+            for name in sorted(names)[::7] + ["unmapped2"]:
+                self.assertEqual(
+                    list(readGroupSet.getReadAlignmentsByName(name)),
+                    [readAlignment for readAlignment in readAlignments
+                     if readAlignment.fragment_name == name])
+            self.assertEqual(
+                list(readGroupSet.getReadAlignmentsByName("none")), [])
+
+    def testCoverageTiles(self):
+        bamReadGroupSet = self._getReadGroupSet(self._bamFilePath)
+        reads.CoverageTileFile.build(
+            self._bamFilePath, bamReadGroupSet.getIndexFile(),
+            self._bamFilePath + bamReadGroupSet.coverageTileFileSuffix,
+            minBinSize=16, zoomFactor=4)
+        tileReadGroupSet = self._getReadGroupSet(self._bamFilePath)
+        self.assertIsNotNone(tileReadGroupSet.getCoverageTileFiles())
+        for start, end, binSize in [
+                (0, self.referenceLength, 100), (1010, 3333, 100),
+                (0, self.referenceLength, 64), (4321, 4322, 5),
+                (0, self.referenceLength, 10**6)]:
+            tileBinSize, binStart, depths = tileReadGroupSet.getCoverage(
+                self._reference, start, end, binSize)
+            self.assertGreaterEqual(tileBinSize, binSize)
+            self.assertLess(tileBinSize, 2 * binSize)
+            self.assertEqual(binStart, start - start % tileBinSize)
+            self.assertLessEqual(
+                len(depths), (end - 1) // binSize - start // binSize + 1)
+            expected = bamReadGroupSet.getCoverage(
+                self._reference, start, end, tileBinSize)
+            self.assertEqual(expected[:2], (tileBinSize, binStart))
+            self.assertEqual(len(depths), len(expected[2]))
+            for depth, expectedDepth in zip(depths, expected[2]):
+                self.assertAlmostEqual(depth, expectedDepth, places=4)
+
+    def testMultipleFiles(self):
+        # The reads are split into the files of two lanes, each holding
+        # the pairs of one read group
+        laneFilePaths = []
+        for lane in range(2):
+            laneFilePaths.append(
+                os.path.join(self._tempDir, "lane{}.bam".format(lane)))
+            header = {
+                "HD": {"VN": "1.5", "SO": "coordinate"},
+                "SQ": [{"SN": "ref1", "LN": self.referenceLength}],
+                "RG": [{"ID": "lane{}".format(lane)}]}
+            laneFile = pysam.AlignmentFile(
+                laneFilePaths[-1], "wb", header=header)
+            bamFile = pysam.AlignmentFile(self._bamFilePath)
+            for read in bamFile.fetch(until_eof=True):
+                if (read.query_name.startswith("read") and
+                        int(read.query_name[4:]) % 2 == lane):
+                    read.tags = [(b"RG", "lane{}".format(lane).encode())]
+                    laneFile.write(read)
+            bamFile.close()
+            laneFile.close()
+            pysam.index(laneFilePaths[-1])
+        readGroupSet = reads.HtslibReadGroupSet(
+            datasets.Dataset("dataset"), "readGroupSet")
+        readGroupSet.populateFromFiles(laneFilePaths)
+        readGroupSet.setReferenceSet(self._referenceSet)
+        self.assertEqual(readGroupSet.getDataUrls(), laneFilePaths)
+        self.assertEqual(
+            [readGroup.getLocalId()
+             for readGroup in readGroupSet.getReadGroups()],
+            ["lane0", "lane1"])
+        self.assertEqual(
+            readGroupSet.getReadGroupDataUrls("lane1"), laneFilePaths[1:])
+        self.assertEqual(
+            readGroupSet.getStats().aligned_read_count, 300)
+        bamReadGroupSet = self._getReadGroupSet(self._bamFilePath)
+
+        def getKeys(readAlignments):
+            return [
+                (readAlignment.alignment.position.position,
+                 readAlignment.fragment_name, readAlignment.read_number)
+                for readAlignment in readAlignments]
+
+        for start, end in [(None, None), (0, 10), (1000, 1200)]:
+            readAlignments = list(readGroupSet.getReadAlignments(
+                self._reference, start, end))
+            positions = [key[0] for key in getKeys(readAlignments)]
+            self.assertEqual(positions, sorted(positions))
+            self.assertEqual(
+                sorted(getKeys(readAlignments)),
+                sorted(getKeys(bamReadGroupSet.getReadAlignments(
+                    self._reference, start, end))))
+            for lane, readGroup in enumerate(readGroupSet.getReadGroups()):
+                self.assertEqual(
+                    getKeys(readGroup.getReadAlignments(
+                        self._reference, start, end)),
+                    [key for key in getKeys(readAlignments)
+                     if int(key[1][4:]) % 2 == lane])
+        self.assertEqual(
+            readGroupSet.getCoverage(self._reference, 0, 5000, 100),
+            bamReadGroupSet.getCoverage(self._reference, 0, 5000, 100))
+        scan = list(readGroupSet.scanReadAlignments())
+        self.assertEqual(len(scan), 300)
+        self.assertEqual(
+            [readAlignment for readAlignment, _ in
+             readGroupSet.scanReadAlignments(offset=scan[200][1])],
+            [readAlignment for readAlignment, _ in scan[201:]])
+        readAlignments = list(
+            readGroupSet.getReadAlignments(self._reference, 0, 1000))
+        self.assertEqual(
+            sorted(getKeys(readGroupSet.getMateAlignments(
+                readAlignments, self._reference, 0, 1000))),
+            sorted(getKeys(bamReadGroupSet.getMateAlignments(
+                list(bamReadGroupSet.getReadAlignments(
+                    self._reference, 0, 1000)),
+                self._reference, 0, 1000))))
@@ -6,8 +6,13 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import os
+import shutil
+import tempfile
 import unittest
 
+import pysam
+
 import ga4gh.backend as backend
 import ga4gh.datamodel.references as references
 import ga4gh.exceptions as exceptions
@@ -61,6 +66,35 @@ class TestAbstractReferenceSet(unittest.TestCase):
                 self._referenceSet.getReference(reference.getId()), reference)
             self.assertEqual(self._referenceSet.getReferences(), referenceList)
 
+    def testReferenceIndexes(self):
+        references_ = []
+        for name, md5checksum, accessions in [
+                ("ref1", "md5a", ["acc1"]),
+                ("ref2", "md5b", ["acc1", "acc2"]),
+                ("ref3", "md5a", [])]:
+            reference = references.AbstractReference(
+                self._referenceSet, name)
+            reference.setMd5checksum(md5checksum)
+            reference.setSourceAccessions(accessions)
+            self._referenceSet.addReference(reference)
+            references_.append(reference)
+        self.assertEqual(
+            [references_[0], references_[2]],
+            self._referenceSet.getReferencesByMd5Checksum("md5a"))
+        self.assertEqual(
+            [references_[0], references_[1]],
+            self._referenceSet.getReferencesByAccession("acc1"))
+        self.assertEqual(
+            [], self._referenceSet.getReferencesByMd5Checksum("md5c"))
+        md5checksum = self._referenceSet.getMd5Checksum()
+        reference = references.AbstractReference(self._referenceSet, "ref4")
+        reference.setMd5checksum("md5c")
+        self._referenceSet.addReference(reference)
+        self.assertEqual(
+            [reference],
+            self._referenceSet.getReferencesByMd5Checksum("md5c"))
+        self.assertNotEqual(md5checksum, self._referenceSet.getMd5Checksum())
+
     def testReferenceNameNotFound(self):
         for badName in ["", None, "NO SUCH NAME"]:
             self.assertRaises(
@@ -91,3 +125,42 @@ class TestAbstractReference(unittest.TestCase):
             self.assertRaises(
                 exceptions.ReferenceRangeErrorException,
                 self._reference.checkQueryRange, badRange[0], badRange[1])
+
+
+class TestPackedSequenceFile(unittest.TestCase):
+    """
+    Tests the 2-bit packed copy of a FASTA file against the FASTA file.
+    """
+    def setUp(self):
+        self._tempDir = tempfile.mkdtemp(prefix="ga4gh_packed_test")
+        self._fastaFilePath = os.path.join(self._tempDir, "test.fa")
+        with open(self._fastaFilePath, "w") as fastaFile:
+            fastaFile.write(">ref1\nNNNNACGTacgtnnNNRYCGTAGGGGatcNN\nAC\n")
+            fastaFile.write(">ref2\nA\n>ref3\nttttTTTTttttGGGGNa\n")
+        pysam.faidx(self._fastaFilePath)
+        self._packedFilePath = self._fastaFilePath + ".packed"
+        references.PackedSequenceFile.build(
+            self._fastaFilePath, self._packedFilePath, chunkSize=8)
+
+    def tearDown(self):
+        shutil.rmtree(self._tempDir)
+
+    def testGetBases(self):
+        packedSequenceFile = references.PackedSequenceFile(
+            self._packedFilePath)
+        fastaFile = pysam.FastaFile(self._fastaFilePath)
+        for referenceName, length in zip(
+                fastaFile.references, fastaFile.lengths):
+            for start in range(length):
+                for end in range(start, length + 1):
+                    self.assertEqual(
+                        fastaFile.fetch(referenceName, start, end),
+                        packedSequenceFile.getBases(
+                            referenceName, start, end))
+
+    def testReferenceSetUsesPackedSequenceFile(self):
+        referenceSet = references.HtslibReferenceSet("test")
+        referenceSet.populateFromFile(self._fastaFilePath)
+        self.assertIsNotNone(referenceSet.getPackedSequenceFile())
+        reference = referenceSet.getReferenceByName("ref3")
+        self.assertEqual("tTTTTttttGG", reference.getBases(3, 14))
@@ -15,6 +15,7 @@ import ga4gh.exceptions as exceptions
 import ga4gh.datarepo as datarepo
 import ga4gh.cli as cli
 import ga4gh.datamodel as datamodel
+import ga4gh.rnaseqLoader as rnaseqLoader
 import tests.paths as paths
 
 
@@ -187,6 +188,85 @@ class TestAddFeatureSet(AbstractRepoManagerTest):
             exceptions.RepoManagerException, self.runCommand, cmd)
 
 
+class TestLoadRnaQuantificationSet(AbstractRepoManagerTest):
+
+    def setUp(self):
+        super(TestLoadRnaQuantificationSet, self).setUp()
+        self.init()
+        self.addDataset()
+        self.addOntology()
+        self.addReferenceSet()
+        self.addReadGroupSet()
+        self.addFeatureSet()
+        self._tempDir = tempfile.mkdtemp(prefix="ga4gh_repoman_test")
+        self._controlFile = os.path.join(self._tempDir, "control.tsv")
+        with open(self._controlFile, "w") as controlFile:
+            controlFile.write("header\n")
+            for name in ["rnaQuant1", "rnaQuant2"]:
+                controlFile.write("\t".join([
+                    name, os.path.abspath(paths.rnaQuantPath), "rsem",
+                    self._featureSetName, self._readGroupSetName,
+                    "description", "programs"]) + "\n")
+        self._dbFile = os.path.join(self._tempDir, "rnaseq.db")
+
+    def tearDown(self):
+        super(TestLoadRnaQuantificationSet, self).tearDown()
+        shutil.rmtree(self._tempDir)
+
+    def testLoadRnaQuantificationSet(self):
+        cmd = (
+            "load-rnaquantificationset {} {} {} {} --referenceSetName={} "
+            "--name=test_rqs --numProcesses=2").format(
+            self._repoPath, self._datasetName, self._controlFile,
+            self._dbFile, self._referenceSetName)
+        self.runCommand(cmd)
+        repo = self.readRepo()
+        dataset = repo.getDatasetByName(self._datasetName)
+        rnaQuantificationSet = dataset.getRnaQuantificationSetByName(
+            "test_rqs")
+        rnaQuantifications = rnaQuantificationSet.getRnaQuantifications()
+        self.assertEqual(
+            ["rnaQuant1", "rnaQuant2"],
+            [rnaQuant.getLocalId() for rnaQuant in rnaQuantifications])
+        for rnaQuantification in rnaQuantifications:
+            self.assertEqual(
+                2, len(rnaQuantification.getExpressionLevels()))
+        self.assertTrue(os.path.exists(self._dbFile + ".matrix"))
+        self.assertRaises(
+            exceptions.RepoManagerException, self.runCommand, cmd)
+
+    def testLoadRnaQuantificationSetInChunks(self):
+        with open(paths.rnaQuantPath, "rb") as quantFile:
+            contents = quantFile.read()
+        chunkSize = rnaseqLoader._chunkSize
+        rnaseqLoader._chunkSize = 16
+        try:
+            chunks = list(rnaseqLoader._getFileChunks(paths.rnaQuantPath))
+            self.assertGreater(len(chunks), 1)
+            self.assertEqual(contents.index(b"\n") + 1, chunks[0][0])
+            self.assertEqual(len(contents), chunks[-1][1])
+            for (_, end), (start, _) in zip(chunks, chunks[1:]):
+                self.assertEqual(end, start)
+                self.assertEqual(b"\n", contents[end - 1:end])
+            cmd = (
+                "load-rnaquantificationset {} {} {} {} "
+                "--referenceSetName={} --name=test_rqs "
+                "--numProcesses=2").format(
+                self._repoPath, self._datasetName, self._controlFile,
+                self._dbFile, self._referenceSetName)
+            self.runCommand(cmd)
+        finally:
+            rnaseqLoader._chunkSize = chunkSize
+        repo = self.readRepo()
+        dataset = repo.getDatasetByName(self._datasetName)
+        rnaQuantificationSet = dataset.getRnaQuantificationSetByName(
+            "test_rqs")
+        for rnaQuantification in \
+                rnaQuantificationSet.getRnaQuantifications():
+            self.assertEqual(
+                2, len(rnaQuantification.getExpressionLevels()))
+
+
 class TestRemoveFeatureSet(AbstractRepoManagerTest):
 
     def setUp(self):
@@ -98,7 +98,8 @@ class MockReadGroup(reads.AbstractReadGroup):
         self.numAlignments = numAlignments
 
     def getReadAlignments(self, referenceName=None, referenceId=None,
-                          start=None, end=None):
+                          start=None, end=None, downsampler=None,
+                          readFilter=None):
         for i in range(self.numAlignments):
             yield generateReadAlignment(i)
 
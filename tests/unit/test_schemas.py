@@ -2,6 +2,7 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import json
 import unittest
 
 import ga4gh.protocol as protocol
@@ -92,6 +93,24 @@ class SearchResponseBuilderTest(unittest.TestCase):
             valueList = getattr(instance, getValueListName(responseClass))
             self.assertEqual(len(valueList), numValues)
 
+    def testExtensionValues(self):
+        responseClass = protocol.SearchReadsResponse
+        builder = protocol.SearchResponseBuilder(
+            responseClass, 100, 2 ** 32)
+        alignment = protocol.ReadAlignment()
+        alignment.fragment_name = "read"
+        builder.addValue(alignment)
+        self.assertEqual(list(builder.getValues()), [alignment])
+        mate = protocol.ReadAlignment()
+        mate.fragment_name = "mate"
+        builder.setExtensionValues("mates", [mate])
+        responseDict = json.loads(builder.getSerializedResponse())
+        self.assertEqual(
+            [protocol.fromJson(json.dumps(value), protocol.ReadAlignment)
+             for value in responseDict.pop("mates")], [mate])
+        instance = protocol.fromJson(json.dumps(responseDict), responseClass)
+        self.assertEqual(list(instance.alignments), [alignment])
+
     def testNextPageToken(self):
         responseClass = protocol.SearchVariantsResponse
         builder = protocol.SearchResponseBuilder(
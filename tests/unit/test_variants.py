@@ -6,11 +6,20 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import json
+import os
+import shutil
+import tempfile
 import unittest
 
+import pysam
+
+import ga4gh.datamodel as datamodel
 import ga4gh.exceptions as exceptions
 import ga4gh.datamodel.variants as variants
 import ga4gh.datamodel.datasets as datasets
+import ga4gh.protocol as protocol
+import tests.paths as paths
 
 
 class TestAbstractVariantSet(unittest.TestCase):
@@ -81,3 +90,238 @@ class TestAbstractVariantSet(unittest.TestCase):
     def testVariantSetProtocolElement(self):
         self.assertRaises(AttributeError,
                           self._variantSet.toProtocolElement)
+
+
+class TestShardedVariantSet(unittest.TestCase):
+    """
+    Tests a variant set whose contig is sharded by position across
+    several VCF files, against the unsharded VCF file.
+    """
+    numShards = 4
+
+    def setUp(self):
+        self._tempDir = tempfile.mkdtemp(prefix="ga4gh_shard_test")
+        self._vcfFilePath = os.path.join(
+            paths.testDataDir, "datasets/dataset1/variants/1kgPhase1",
+            "chr1.vcf.gz")
+        vcfFile = pysam.VariantFile(self._vcfFilePath)
+        records = list(vcfFile.fetch())
+        shardSize = len(records) // self.numShards + 1
+        self._shardSize = shardSize
+        self._shardFilePaths = []
+        for index in range(self.numShards):
+            shardFilePath = os.path.join(
+                self._tempDir, "shard{}.vcf".format(index))
+            shardFile = pysam.VariantFile(
+                shardFilePath, "w", header=vcfFile.header)
+            for record in records[index * shardSize:(index + 1) * shardSize]:
+                shardFile.write(record)
+            shardFile.close()
+            self._shardFilePaths.append(
+                pysam.tabix_index(shardFilePath, preset="vcf"))
+        vcfFile.close()
+        self._starts = [record.start for record in records]
+
+    def tearDown(self):
+        shutil.rmtree(self._tempDir)
+
+    def _getVariantSet(self, dataUrls):
+        variantSet = variants.HtslibVariantSet(
+            datasets.Dataset("dataset"), "variantSet")
+        variantSet.populateFromFile(
+            dataUrls, [dataUrl + ".tbi" for dataUrl in dataUrls])
+        return variantSet
+
+    def testGetVariants(self):
+        # The shards are given out of order
+        shardedVariantSet = self._getVariantSet(self._shardFilePaths[::-1])
+        variantSet = self._getVariantSet([self._vcfFilePath])
+        self.assertEqual(
+            [shard[2] for shard in
+             shardedVariantSet.getReferenceToDataUrlIndexMap()["1"]],
+            self._shardFilePaths)
+        first, last = self._starts[0], self._starts[-1]
+        # The first record of the third shard
+        middle = self._starts[2 * self._shardSize]
+        for start, end in [
+                (0, first), (first, last + 1), (middle, middle + 1),
+                (first, middle), (middle - 1000, middle + 1000),
+                (last + 1, last + 1000)]:
+            self.assertEqual(
+                list(shardedVariantSet.getVariants("1", start, end)),
+                list(variantSet.getVariants("1", start, end)))
+        self.assertEqual(shardedVariantSet.getShards("1", 0, first), [])
+        self.assertEqual(
+            [shard[2] for shard in
+             shardedVariantSet.getShards("1", middle, middle + 1)],
+            [self._shardFilePaths[2]])
+        self.assertEqual(shardedVariantSet.getShards("2"), [])
+
+    def testOverlappingShards(self):
+        with self.assertRaises(exceptions.OverlappingVcfException):
+            self._getVariantSet(self._shardFilePaths + [self._vcfFilePath])
+
+    def testPopulateFromRow(self):
+        shardedVariantSet = self._getVariantSet(self._shardFilePaths)
+        row = {
+            b"created": None, b"updated": None, b"metadata": "[]",
+            b"dataUrlIndexMap": json.dumps(
+                shardedVariantSet.getReferenceToDataUrlIndexMap())}
+        variantSet = variants.HtslibVariantSet(
+            datasets.Dataset("dataset"), "variantSet")
+        variantSet.populateFromRow(row)
+        self.assertEqual(
+            variantSet.getReferenceToDataUrlIndexMap(),
+            shardedVariantSet.getReferenceToDataUrlIndexMap())
+        # Contigs of older repositories are held in a single file
+        row[b"dataUrlIndexMap"] = json.dumps(
+            {"1": [self._vcfFilePath, self._vcfFilePath + ".tbi"]})
+        variantSet.populateFromRow(row)
+        self.assertEqual(
+            [shard[2] for shard in variantSet.getShards("1", 0, 1)],
+            [self._vcfFilePath])
+
+
+class TestPartitionedVariantSet(unittest.TestCase):
+    """
+    Tests a variant set whose call sets are partitioned across VCF files
+    covering the same sites, against the unpartitioned VCF file.
+    """
+    def setUp(self):
+        self._tempDir = tempfile.mkdtemp(prefix="ga4gh_partition_test")
+        self._vcfFilePath = os.path.join(
+            paths.testDataDir, "datasets/dataset1/variants/1kgPhase1",
+            "chr1.vcf.gz")
+        vcfFile = pysam.VariantFile(self._vcfFilePath)
+        samples = list(vcfFile.header.samples)
+        vcfFile.close()
+        half = len(samples) // 2
+        self._partitions = [samples[:half], samples[half:]]
+        # The second partition is also sharded by position
+        self._partitionFilePaths = [
+            self._writePartition(0, self._partitions[0], 0, None),
+            self._writePartition(1, self._partitions[1], 0, 50),
+            self._writePartition(2, self._partitions[1], 50, None)]
+
+    def tearDown(self):
+        shutil.rmtree(self._tempDir)
+
+    def _writePartition(self, index, samples, first, last):
+        vcfFile = pysam.VariantFile(self._vcfFilePath)
+        vcfFile.subset_samples(samples)
+        filePath = os.path.join(
+            self._tempDir, "partition{}.vcf".format(index))
+        partitionFile = pysam.VariantFile(
+            filePath, "w", header=vcfFile.header)
+        for record in list(vcfFile.fetch())[first:last]:
+            partitionFile.write(record)
+        partitionFile.close()
+        vcfFile.close()
+        return pysam.tabix_index(filePath, preset="vcf")
+
+    def _getVariantSet(self, dataUrls):
+        variantSet = variants.HtslibVariantSet(
+            datasets.Dataset("dataset"), "variantSet")
+        variantSet.populateFromFile(
+            dataUrls, [dataUrl + ".tbi" for dataUrl in dataUrls])
+        return variantSet
+
+    def testGetVariants(self):
+        partitionedVariantSet = self._getVariantSet(self._partitionFilePaths)
+        variantSet = self._getVariantSet([self._vcfFilePath])
+        self.assertEqual(
+            partitionedVariantSet.getCallSetPartitions(), self._partitions)
+        self.assertEqual(
+            [callSet.getId() for callSet in
+             partitionedVariantSet.getCallSets()],
+            [callSet.getId() for callSet in variantSet.getCallSets()])
+        partitionedVariantSet.checkConsistency()
+        callSetIds = [
+            callSet.getId() for callSet in variantSet.getCallSets()]
+        for searchCallSetIds in [
+                None, [], callSetIds[:1], callSetIds[-1:],
+                callSetIds[::-1]]:
+            variantList = list(variantSet.getVariants(
+                "1", 0, 2**31, searchCallSetIds))
+            self.assertEqual(
+                list(partitionedVariantSet.getVariants(
+                    "1", 0, 2**31, searchCallSetIds)),
+                variantList)
+        for variant in variantList:
+            self.assertEqual(
+                partitionedVariantSet.getVariant(
+                    datamodel.VariantCompoundId.parse(variant.id)),
+                variantSet.getVariant(
+                    datamodel.VariantCompoundId.parse(variant.id)))
+
+    def testFilesRead(self):
+        variantSet = self._getVariantSet(self._partitionFilePaths)
+        callSetId = variantSet.getCallSetByName(
+            self._partitions[1][0]).getId()
+        dataUrls = set()
+        fileHandle = variantSet.fileHandle
+
+        def recordFileHandle(dataFile):
+            dataUrls.add(dataFile[0])
+            return fileHandle(dataFile)
+
+        variantSet.fileHandle = recordFileHandle
+        self.assertEqual(variantSet.getCallSetPartition(callSetId), 1)
+        list(variantSet.getVariants("1", 0, 2**31, [callSetId]))
+        self.assertEqual(dataUrls, set(self._partitionFilePaths[1:]))
+
+    def testMissingVariants(self):
+        # The second shard of the second partition is left out
+        variantSet = self._getVariantSet(self._partitionFilePaths[:2])
+        callSetIds = [callSet.getId() for callSet in variantSet.getCallSets()]
+        variantList = list(variantSet.getVariants("1", 0, 2**31, None))
+        self.assertEqual(
+            [len(variant.calls) for variant in variantList],
+            [len(callSetIds)] * 50 + [len(self._partitions[0])] * 50)
+
+    def testPopulateFromRow(self):
+        partitionedVariantSet = self._getVariantSet(self._partitionFilePaths)
+        row = {
+            b"created": None, b"updated": None, b"metadata": "[]",
+            b"dataUrlIndexMap": json.dumps(
+                partitionedVariantSet.getReferenceToDataUrlIndexMap()),
+            b"callSetPartitions": json.dumps(
+                partitionedVariantSet.getCallSetPartitions())}
+        variantSet = variants.HtslibVariantSet(
+            datasets.Dataset("dataset"), "variantSet")
+        variantSet.populateFromRow(row)
+        self.assertEqual(
+            variantSet.getReferenceToDataUrlIndexMap(),
+            partitionedVariantSet.getReferenceToDataUrlIndexMap())
+        self.assertEqual(
+            variantSet.getCallSetPartitions(), self._partitions)
+        callSet = partitionedVariantSet.getCallSetByName(
+            self._partitions[1][0])
+        self.assertEqual(variantSet.getCallSetPartition(callSet.getId()), 1)
+
+    def testPopulateFromLegacyRow(self):
+        # Rows written before call sets could be partitioned have no
+        # callSetPartitions, and all their call sets are in one partition
+        unpartitionedVariantSet = self._getVariantSet([self._vcfFilePath])
+        row = {
+            b"created": None, b"updated": None,
+            b"metadata": json.dumps([
+                protocol.toJsonDict(metadata) for metadata in
+                unpartitionedVariantSet.getMetadata()]),
+            b"dataUrlIndexMap": json.dumps(
+                unpartitionedVariantSet.getReferenceToDataUrlIndexMap())}
+        variantSet = variants.HtslibVariantSet(
+            datasets.Dataset("dataset"), "variantSet")
+        variantSet.populateFromRow(row)
+        samples = self._partitions[0] + self._partitions[1]
+        for sample in samples:
+            variantSet.addCallSetFromName(sample)
+        self.assertEqual(variantSet.getCallSetPartitions(), [samples])
+        self.assertEqual(
+            variantSet.getCallSetPartition(
+                variantSet.getCallSetByName(samples[-1]).getId()), 0)
+        variantSet.checkConsistency()
+        variantSet.populateFromFile(
+            [self._vcfFilePath], [self._vcfFilePath + ".tbi"])
+        self.assertEqual(variantSet.getCallSetPartitions(), [samples])
+        self.assertEqual(variantSet.getNumCallSets(), len(samples))
@@ -8,10 +8,14 @@ from __future__ import unicode_literals
 
 import unittest
 import logging
+import json
+import gzip
+import StringIO
 
 import tests.paths as paths
 
 import ga4gh.datamodel as datamodel
+import ga4gh.datarepo as datarepo
 import ga4gh.frontend as frontend
 import ga4gh.protocol as protocol
 
@@ -69,6 +73,8 @@ class TestFrontend(unittest.TestCase):
         cls.expressionLevel = cls.rnaQuantification.getExpressionLevels(
             1, 2)[0]
         cls.expressionLevelId = cls.expressionLevel.getId()
+        cls.featureSet = cls.dataset.getFeatureSets()[0]
+        cls.featureId = cls.featureSet.getCompoundIdForFeatureId(0)
 
     def sendPostRequest(self, path, request):
         """
@@ -334,6 +340,11 @@ class TestFrontend(unittest.TestCase):
         self.assertEqual("text/html", response.mimetype)
         self.assertGreater(len(response.data), 0)
 
+    def testReady(self):
+        response = self.app.get("/ready")
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(json.loads(response.data)["ready"])
+
     def testVariantsSearch(self):
         response = self.sendVariantsSearch()
         self.assertEqual(200, response.status_code)
@@ -484,3 +495,153 @@ class TestFrontend(unittest.TestCase):
         rnaQuantificationSets = list(responseData.rna_quantification_sets)
         self.assertEqual(
             self.rnaQuantificationSetId, rnaQuantificationSets[0].id)
+
+    def testListFeatureSubtree(self):
+        path = "/features/{}/subtree".format(self.featureId)
+        response = self.sendGetRequest(path)
+        self.assertEqual(200, response.status_code)
+        responseData = protocol.fromJson(
+            response.data, protocol.SearchFeaturesResponse)
+        self.assertEqual(
+            [self.featureId], [f.id for f in responseData.features])
+        self.assertEqual("", responseData.next_page_token)
+        response = self.sendGetRequest(path + "?pageSize=0")
+        self.assertEqual(400, response.status_code)
+
+    def testGetExpressionMatrix(self):
+        path = "/rnaquantificationsets/{}/expressionmatrix".format(
+            self.rnaQuantificationSetId)
+        response = self.sendGetRequest(path)
+        self.assertEqual(200, response.status_code)
+        responseData = json.loads(response.data)
+        self.assertEqual(
+            [rnaQuant.getId() for rnaQuant in
+             self.rnaQuantificationSet.getRnaQuantifications()],
+            responseData["rnaQuantificationIds"])
+        self.assertEqual(
+            len(responseData["featureIds"]),
+            len(responseData["expression"]))
+        response = self.sendGetRequest(path + "?threshold=high")
+        self.assertEqual(400, response.status_code)
+
+    def testStreamReferenceBases(self):
+        path = "/references/{}/rawbases".format(self.referenceId)
+        bases = self.reference.getBases(0, self.reference.getLength())
+        response = self.sendGetRequest(path)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual("text/plain", response.mimetype)
+        self.assertEqual(bases, response.data)
+        response = self.sendGetRequest(path + "?start=2&end=9")
+        self.assertEqual(bases[2:9], response.data)
+        response = self.app.get(path + "?start=2", headers={
+            "Range": "bytes=1-3"})
+        self.assertEqual(206, response.status_code)
+        self.assertEqual(bases[3:6], response.data)
+        self.assertEqual(
+            "bytes 1-3/{}".format(len(bases) - 2),
+            response.headers["Content-Range"])
+        response = self.app.get(path, headers={
+            "Range": "bytes={}-".format(len(bases))})
+        self.assertEqual(416, response.status_code)
+        response = self.app.get(path, headers={"Accept-Encoding": "gzip"})
+        self.assertEqual("gzip", response.headers["Content-Encoding"])
+        self.assertEqual(bases, gzip.GzipFile(
+            fileobj=StringIO.StringIO(response.data)).read())
+        response = self.sendGetRequest(
+            path + "?end={}".format(len(bases) + 1))
+        self.assertEqual(416, response.status_code)
+
+    def testStreamSequence(self):
+        path = "/sequences/{}".format(self.reference.getMd5Checksum())
+        bases = self.reference.getBases(0, self.reference.getLength())
+        response = self.sendGetRequest(path)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(bases, response.data)
+        response = self.sendGetRequest(path + "?start=1&end=4")
+        self.assertEqual(bases[1:4], response.data)
+        response = self.sendGetRequest("/sequences/notachecksum")
+        self.assertEqual(404, response.status_code)
+
+    def testListReferenceBasesBatch(self):
+        path = "/referencebases/batch"
+        headers = {'Content-type': 'application/json'}
+        bases = self.reference.getBases(0, self.reference.getLength())
+        intervals = [(5, 9), (0, 3), (5, 6), (1, 2)]
+        request = {"intervals": [
+            {"referenceId": self.referenceId, "start": start, "end": end}
+            for start, end in intervals]}
+        response = self.app.post(
+            path, headers=headers, data=json.dumps(request))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(
+            [bases[start:end] for start, end in intervals],
+            json.loads(response.data)["sequences"])
+        request["intervals"].append({"referenceId": self.referenceId})
+        response = self.app.post(
+            path, headers=headers, data=json.dumps(request))
+        self.assertEqual(400, response.status_code)
+        request = {"intervals": [{
+            "referenceId": self.referenceId, "start": 0,
+            "end": len(bases) + 1}]}
+        response = self.app.post(
+            path, headers=headers, data=json.dumps(request))
+        self.assertEqual(416, response.status_code)
+
+
+class TestDataFileWarmUp(unittest.TestCase):
+    """
+    Tests the warm up of the data files of a repository.
+    """
+    def setUp(self):
+        self._dataRepo = datarepo.SqlDataRepository(paths.testDataRepo)
+        self._dataRepo.open(datarepo.MODE_READ)
+        self._dataFiles = self._dataRepo.getDataFiles()
+        self._filePaths = [
+            datamodel.getDataFilePath(dataFile)
+            for dataFile, _ in self._dataFiles]
+        datamodel.fileHandleCache = datamodel.PysamFileHandleCache()
+
+    def _warmUp(self, **kwargs):
+        warmUp = frontend.DataFileWarmUp(self._dataRepo, **kwargs)
+        warmUp.start()
+        warmUp.waitUntilReady(60)
+        return warmUp
+
+    def testWarmUpListedFiles(self):
+        filePaths = self._filePaths[:2] + ["/no/such/file"]
+        progress = self._warmUp(dataFilePaths=filePaths).getProgress()
+        self.assertTrue(progress["ready"])
+        self.assertEqual(progress["filesTotal"], 2)
+        self.assertEqual(progress["filesWarmed"], 2)
+        self.assertEqual(progress["filesFailed"], [])
+        self.assertEqual(
+            sorted(datamodel.fileHandleCache.getCachedFiles()),
+            sorted(dataFile for dataFile, _ in self._dataFiles[:2]))
+
+    def testWarmUpMostUsedFiles(self):
+        accessCounts = dict(
+            (filePath, index) for index, filePath in
+            enumerate(self._filePaths))
+        progress = self._warmUp(
+            numDataFiles=3, accessCounts=accessCounts).getProgress()
+        self.assertEqual(progress["filesTotal"], 3)
+        self.assertEqual(
+            sorted(datamodel.fileHandleCache.getCachedFiles()),
+            sorted(dataFile for dataFile, _ in self._dataFiles[-3:]))
+
+    def testRestartAfterFork(self):
+        warmUp = self._warmUp(dataFilePaths=self._filePaths[:2])
+        finished = warmUp._finished
+        warmUp.restartAfterFork()
+        self.assertIs(warmUp._finished, finished)
+        # Pretend that this process was forked from the one the warm up
+        # was started in
+        warmUp._pid = -1
+        datamodel.fileHandleCache = datamodel.PysamFileHandleCache()
+        warmUp.restartAfterFork()
+        warmUp.waitUntilReady(60)
+        self.assertIsNot(warmUp._finished, finished)
+        self.assertEqual(warmUp.getProgress()["filesWarmed"], 2)
+        self.assertEqual(
+            sorted(datamodel.fileHandleCache.getCachedFiles()),
+            sorted(dataFile for dataFile, _ in self._dataFiles[:2]))
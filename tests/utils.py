@@ -70,6 +70,20 @@ def getGa4ghFilePath():
     return os.path.join(getProjectRootFilePath(), packageName)
 
 
+def getFeatureSetDbBuilder(gff3FilePath, dbFilePath, numProcesses=1):
+    """
+    Returns the Gff32Db of scripts/generate_gff3_db.py, with which the
+    server's DBs are built, building the feature set DB for the specified
+    GFF3 file at the specified path when it is run.
+    """
+    scriptsDir = os.path.abspath(
+        os.path.join(getProjectRootFilePath(), "scripts"))
+    if scriptsDir not in sys.path:
+        sys.path.append(scriptsDir)
+    import generate_gff3_db
+    return generate_gff3_db.Gff32Db(gff3FilePath, dbFilePath, numProcesses)
+
+
 def powerset(iterable, maxSets=None):
     """
     powerset([1,2,3]) --> () (1,) (2,) (3,) (1,2) (1,3) (2,3) (1,2,3)